@@ -7,157 +7,282 @@ Noms et numéros étudiants:
 """
 
 import argparse
+import codecs
 import getpass
-import json
+import os
 import socket
 import sys
 
+import gloclient
+import glocodec
 import glosocket
 import gloutils
 
 
 class Client:
-    """Client pour le serveur mail @glo2000.ca."""
+    """
+    Client interactif pour le serveur mail @glo2000.ca. Les échanges avec
+    le serveur passent par une gloclient.Connection.
+    """
 
     def __init__(self, destination: str) -> None:
         """
-        Prépare et connecte le socket du client `_socket`.
+        Prépare la connexion `_connection` au serveur, qui négocie
+        l'encodage, la compression et les flux.
 
-        Prépare un attribut `_username` pour stocker le nom d'utilisateur
-        courant. Laissé vide quand l'utilisateur n'est pas connecté.
+        Le nom de l'utilisateur courant est celui de la connexion, vide
+        quand l'utilisateur n'est pas connecté.
         """
-
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._username = None
-
         try:
-            self._socket.connect((destination, gloutils.APP_PORT))
-        except (socket.error, TimeoutError, InterruptedError):
+            self._connection = gloclient.Connection(destination, streaming=True)
+        except (socket.error, TimeoutError, InterruptedError,
+                glosocket.GLOSocketError, glocodec.GLOCodecError):
             sys.exit(1)
 
+    def _subscribe(self) -> None:
+        """
+        Demande les notifications des nouveaux courriels. Un serveur qui ne
+        connaît pas l'entête `SUBSCRIBE` répond par une erreur, sans
+        conséquence.
+        """
+        try:
+            self._connection.subscribe()
+        except gloclient.GloClientError:
+            pass
+
+    def _show_notifications(self) -> None:
+        """
+        Affiche les notifications déjà arrivées à l'aide du gabarit
+        `NOTIFICATION_DISPLAY`.
+        """
+        for notification in self._connection.notifications():
+            print(gloutils.NOTIFICATION_DISPLAY.format(
+                sender=notification.get("sender", ""),
+                subject=notification.get("subject", "")))
+
     def _register(self) -> None:
         """
-        Demande un nom d'utilisateur et un mot de passe et les transmet au
-        serveur avec l'entête `AUTH_REGISTER`.
+        Demande un nom d'utilisateur et un mot de passe et crée le compte.
 
-        Si la création du compte s'est effectuée avec succès, l'attribut
-        `_username` est mis à jour, sinon l'erreur est affichée.
+        Si la création du compte s'est effectuée avec succès, l'utilisateur
+        est connecté, sinon l'erreur est affichée.
         """
         username = input("Entrez un nom d'utilisateur : ")
         pw = getpass.getpass("Entrez un mot de passe : ")
-
-        payload = gloutils.AuthPayload(username=username, password=pw)
-        message = gloutils.GloMessage(header=gloutils.Headers.AUTH_REGISTER, payload=payload)
-
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        reply = json.loads(glosocket.recv_mesg(self._socket))
-
-        if reply["header"] == gloutils.Headers.OK:
-            self._username = username
-        elif reply["header"] == gloutils.Headers.ERROR:
-            print(reply["payload"]["error_message"])
-
+        try:
+            self._connection.register(username, pw)
+        except gloclient.GloClientError as ex:
+            print(ex)
+            return
+        self._subscribe()
 
     def _login(self) -> None:
         """
-        Demande un nom d'utilisateur et un mot de passe et les transmet au
-        serveur avec l'entête `AUTH_LOGIN`.
+        Demande un nom d'utilisateur et un mot de passe et se connecte au
+        compte.
 
-        Si la connexion est effectuée avec succès, l'attribut `_username`
-        est mis à jour, sinon l'erreur est affichée.
+        Si la connexion est effectuée avec succès, l'utilisateur est
+        connecté, sinon l'erreur est affichée.
         """
         username = input("Entrez un nom d'utilisateur : ")
         pw = getpass.getpass("Entrez un mot de passe : ")
-
-        payload = gloutils.AuthPayload(username=username, password=pw)
-        message = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGIN, payload=payload)
-        glosocket.send_mesg(self._socket, json.dumps(message))
-        reply = json.loads(glosocket.recv_mesg(self._socket))
-        if reply["header"] == gloutils.Headers.OK:
-            print("Connexion établie avec succès")
-            self._username = username
-        elif reply["header"] == gloutils.Headers.ERROR:
-            print(reply["payload"]["error_message"])
+        try:
+            self._connection.login(username, pw)
+        except gloclient.GloClientError as ex:
+            print(ex)
+            return
+        print("Connexion établie avec succès")
+        self._subscribe()
 
     def _quit(self) -> None:
-        """
-        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
-        socket du client.
-        """
-        message = gloutils.GloMessage(header=gloutils.Headers.BYE)
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        self._socket.close()
+        """Préviens le serveur de la déconnexion et ferme la connexion."""
+        self._connection.close()
 
     def _read_email(self) -> None:
         """
-        Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        Demande au serveur la liste de ses courriels, une page de
+        `INBOX_PAGE_SIZE` courriels à la fois.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
+        Affiche la page courante puis consulte le choix de l'utilisateur.
+        L'utilisateur peut aussi passer à la page suivante ou précédente.
+        Plusieurs courriels choisis sont demandés ensemble dans un lot.
 
-        Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
+        Affiche chaque courriel à l'aide du gabarit `EMAIL_DISPLAY`.
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
+        self._browse_emails(self._connection.inbox,
+                            "Il n'y a aucun courriel à consulter...")
 
-        message = gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST)
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        reply = json.loads(glosocket.recv_mesg(self._socket))
-        payload = reply["payload"]
-
-        if len(payload["email_list"]) == 0:
-            print("Il n'y a aucun courriel à consulter...")
-            return
-        
-        for subject in payload["email_list"]:
-            print(subject)
-        
-        choix_valide = False
-        while not choix_valide:
+    def _search_emails(self) -> None:
+        """
+        Demande les termes et les filtres de la recherche. Les résultats
+        sont parcourus et consultés comme la liste des courriels.
+        """
+        query = input("Mots recherchés : ").strip()
+        sender = input("Expéditeur (vide pour tous) : ").strip()
+        since = input("Depuis le (AAAA-MM-JJ, vide pour aucune limite) : ").strip()
+        until = input("Jusqu'au (AAAA-MM-JJ, vide pour aucune limite) : ").strip()
+        self._browse_emails(
+            lambda offset, limit: self._connection.search(query, sender, since, until,
+                                                          offset, limit),
+            "Aucun courriel ne correspond à la recherche...")
+
+    def _browse_emails(self, fetch_page, empty_message: str) -> None:
+        """
+        Affiche page par page la liste des courriels retournée par
+        `fetch_page(offset, limit)`, puis consulte les courriels choisis.
+        `empty_message` est affiché si la liste est vide.
+        """
+        offset = 0
+        choices = None
+        while choices is None:
             try:
-                choice = int(input(f"Entrez votre choix [1-{len(payload['email_list'])}] : "))
-            except ValueError:
-                print("Choix invalide")
+                payload = fetch_page(offset, gloutils.INBOX_PAGE_SIZE)
+            except gloclient.GloClientError as ex:
+                print(ex)
+                return
+            total = payload.get("total", len(payload["email_list"]))
+
+            if total == 0:
+                print(empty_message)
+                return
+            if len(payload["email_list"]) == 0:
+                # The inbox shrank under the current page, go back to the start
+                offset = 0
                 continue
-            if 1 <= choice <= len(payload['email_list']):
-                choix_valide = True
-            else:
+
+            for subject in payload["email_list"]:
+                print(subject)
+
+            first = offset + 1
+            last = offset + len(payload["email_list"])
+            has_next = last < total
+            has_previous = offset > 0
+            prompt = f"Entrez votre choix [{first}-{last}], plusieurs séparés par des virgules"
+            if has_next:
+                prompt += ", 's' pour la page suivante"
+            if has_previous:
+                prompt += ", 'p' pour la page précédente"
+
+            while True:
+                answer = input(prompt + " : ").strip().lower()
+                if answer == "s" and has_next:
+                    offset += gloutils.INBOX_PAGE_SIZE
+                    break
+                if answer == "p" and has_previous:
+                    offset = max(0, offset - gloutils.INBOX_PAGE_SIZE)
+                    break
+                numbers = self._parse_choices(answer)
+                if numbers and all(first <= number <= last for number in numbers):
+                    choices = [number - offset for number in numbers]
+                    break
                 print("Choix invalide")
 
-        message2 = gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_CHOICE,
-                                       payload=gloutils.EmailChoicePayload(choice=choice))
-        glosocket.send_mesg(self._socket, json.dumps(message2))
-
-        reply2 = json.loads(glosocket.recv_mesg(self._socket))
-        payload2 = reply2["payload"]
-        print(gloutils.EMAIL_DISPLAY.format(
-            sender=payload2["sender"],
-            to=payload2["destination"],
-            subject=payload2["subject"],
-            date=payload2["date"],
-            body=payload2["content"]
-        ))
+        if "email_ids" in payload:
+            emails = [payload["email_ids"][choice - 1] for choice in choices]
+        else:
+            emails = [offset + choice for choice in choices]
+
+        if len(emails) == 1:
+            try:
+                results = [self._connection.fetch(emails[0])]
+            except gloclient.GloClientError as ex:
+                results = [ex]
+        else:
+            # Several mails are fetched in a single round trip
+            results = self._connection.fetch_many(emails)
+
+        for email in results:
+            if isinstance(email, gloclient.GloClientError):
+                print(email)
+                continue
+            if email.get("streamed"):
+                self._display_streamed_email(email)
+                continue
+            print(gloutils.EMAIL_DISPLAY.format(
+                sender=email["sender"],
+                to=email["destination"],
+                subject=email["subject"],
+                date=email["date"],
+                body=email["content"]
+            ))
         return
 
+    def _display_streamed_email(self, payload: gloutils.StreamedEmailPayload) -> None:
+        """
+        Affiche un courriel dont le contenu suit la réponse en flux: le
+        corps est écrit sur la sortie standard et chaque pièce jointe dans
+        un fichier du dossier courant, morceau par morceau.
+        """
+        header = gloutils.EMAIL_DISPLAY.format(sender=payload["sender"],
+                                               to=payload["destination"],
+                                               subject=payload["subject"],
+                                               date=payload["date"],
+                                               body="")
+        print(header.rstrip("\n"))
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for chunk in self._connection.iter_chunks():
+            sys.stdout.write(decoder.decode(chunk))
+        print(decoder.decode(b"", final=True))
+
+        for attachment in payload.get("attachments", []):
+            path = self._attachment_path(attachment["name"])
+            with open(path, 'wb') as f:
+                for chunk in self._connection.iter_chunks():
+                    f.write(chunk)
+            print(f"Pièce jointe enregistrée : {path} ({attachment['size']} octets)")
+
+    @staticmethod
+    def _attachment_path(name: str) -> str:
+        """
+        Chemin où enregistrer une pièce jointe dans le dossier courant, sans
+        écraser de fichier existant.
+        """
+        name = os.path.basename(name) or "piece_jointe"
+        base, extension = os.path.splitext(name)
+        path = name
+        number = 1
+        while os.path.exists(path):
+            path = f"{base} ({number}){extension}"
+            number += 1
+        return path
+
+    @staticmethod
+    def _parse_choices(answer: str) -> list[int] | None:
+        """
+        Lit une liste de numéros séparés par des virgules, chacun pouvant
+        être un intervalle (`3-5`). Retourne None si la saisie est invalide
+        ou compte plus de BATCH_MAX_REQUESTS numéros.
+        """
+        numbers = []
+        for part in answer.split(","):
+            start, _, end = part.partition("-")
+            try:
+                start = int(start)
+                end = int(end) if end else start
+            except ValueError:
+                return None
+            numbers.extend(range(start, end + 1))
+        if not numbers or len(numbers) > gloutils.BATCH_MAX_REQUESTS:
+            return None
+        return numbers
+
     def _send_email(self) -> None:
         """
         Demande à l'utilisateur respectivement:
-        - l'adresse email du destinataire,
+        - les adresses email des destinataires, séparées par des virgules,
         - le sujet du message,
-        - le corps du message.
+        - le corps du message,
+        - les fichiers à joindre, si le serveur supporte les flux.
 
         La saisie du corps se termine par un point seul sur une ligne.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Envoie le courriel et affiche l'état de chaque destinataire s'il y
+        en a plusieurs.
         """
-
-        sender = self._username + "@" + gloutils.SERVER_DOMAIN
-        destination = input("Entrez l'adresse du destinataire : ")
+        destination = input("Entrez les adresses des destinataires, séparées par des virgules : ")
 
         subject = input("Entrez le sujet : ")
         print("Entrez le contenu du courriel, terminez la saisie avec un '.' sur sur une ligne : ")
@@ -166,52 +291,53 @@ class Client:
         while buffer != ".\n":
             content += buffer
             buffer = input() + '\n'
-        date = gloutils.get_current_utc_time()
-
-        payload = gloutils.EmailContentPayload(
-            sender=sender,
-            destination=destination,
-            subject=subject,
-            date=date,
-            content=content
-        )
-        message = gloutils.GloMessage(header=gloutils.Headers.EMAIL_SENDING, payload=payload)
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        reply = json.loads(glosocket.recv_mesg(self._socket))
-        if reply["header"] == gloutils.Headers.OK:
+
+        attachments = []
+        if gloutils.CAPABILITY_STREAMING in self._connection.capabilities:
+            while True:
+                answer = input("Entrez les chemins des pièces jointes, séparés par des"
+                               " virgules (vide pour aucune) : ")
+                attachments = [path.strip() for path in answer.split(",") if path.strip()]
+                missing = [path for path in attachments if not os.path.isfile(path)]
+                if not missing:
+                    break
+                print("Fichier introuvable : " + ", ".join(missing))
+
+        try:
+            report = self._connection.send(destination, subject, content, attachments)
+            error = None
+        except gloclient.GloClientError as ex:
+            report, error = ex.payload, ex
+        statuses = report.get("statuses", [])
+        if len(statuses) > 1:
+            for status in statuses:
+                print(f"{status['address']} : "
+                      + ("envoyé" if status["delivered"] else status["error_message"]))
+        if error is None:
             print("Envoi effectué avec succès :)")
-        elif reply["header"] == gloutils.Headers.ERROR:
-            print(reply["payload"]["error_message"])
+        elif len(statuses) <= 1:
+            print(error)
         return
 
     def _check_stats(self) -> None:
         """
-        Demande les statistiques au serveur avec l'entête `STATS_REQUEST`.
-
-        Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
+        Demande les statistiques au serveur et les affiche à l'aide du
+        gabarit `STATS_DISPLAY`.
         """
-
-        message = gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        reply = json.loads(glosocket.recv_mesg(self._socket))
+        try:
+            stats = self._connection.stats()
+        except gloclient.GloClientError as ex:
+            print(ex)
+            return
         print(gloutils.STATS_DISPLAY.format(
-            count=reply["payload"]["count"],
-            size=reply["payload"]["size"]
+            count=stats["count"],
+            size=stats["size"]
         ))
         return
 
     def _logout(self) -> None:
-        """
-        Préviens le serveur avec l'entête `AUTH_LOGOUT`.
-
-        Met à jour l'attribut `_username`.
-        """
-        message = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT)
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        self._username = None
+        """Préviens le serveur de la déconnexion du compte."""
+        self._connection.logout()
         print("Déconnexion effectuée avec succès")
         return
 
@@ -221,7 +347,7 @@ class Client:
 
         while not should_quit:
             try:
-                if not self._username:
+                if not self._connection.username:
                     # Authentication menu
                     print(gloutils.CLIENT_AUTH_CHOICE)
                     choix = input("Entrez votre choix [1-3] : ")
@@ -238,8 +364,9 @@ class Client:
 
                 else:
                     # Main menu
+                    self._show_notifications()
                     print(gloutils.CLIENT_USE_CHOICE)
-                    choix = input("Entrez votre choix [1-4] : ")
+                    choix = input("Entrez votre choix [1-5] : ")
 
                     if choix == "1":
                         self._read_email()
@@ -248,10 +375,13 @@ class Client:
                     elif choix == "3":
                         self._check_stats()
                     elif choix == "4":
+                        self._search_emails()
+                    elif choix == "5":
                         self._logout()
                     else:
                         print("Choix invalide")
-            except (ConnectionResetError, glosocket.GLOSocketError):
+            except (ConnectionResetError, glosocket.GLOSocketError,
+                    glocodec.GLOCodecError):
                 self._quit()
                 sys.exit(1)
 
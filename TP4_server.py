@@ -6,35 +6,124 @@ Noms et numéros étudiants:
 -
 """
 
-import hashlib
-import hmac
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import email.utils
+import functools
+import itertools
 import json
 import os
+import queue
 import select
 import socket
 import sys
 import re
-import pathlib
-import random
-
+import signal
+import threading
+import time
+from typing import Any, Callable, Iterator
+
+import glocache
+import glocodec
+import glometrics
+import glopassword
 import glosocket
+import glostorage
 import gloutils
 
+UPLOAD_TIMEOUT = 60.0
+"""
+Délai maximal, en secondes, de réception complète des contenus envoyés en
+flux à la suite d'une requête, au-delà duquel le client est déconnecté.
+"""
+
+
+class DeferredReply:
+    """
+    Réponse différée d'une requête dont le traitement coûteux s'exécute
+    dans le bassin de hachage du serveur.
+
+    `future` se termine avec le résultat du traitement; `finish` le reçoit,
+    dans le fil du moteur, et retourne la réponse.
+    """
+
+    def __init__(self, future: concurrent.futures.Future,
+                 finish: Callable[[Any], Any]) -> None:
+        self.future = future
+        self.finish = finish
+
+    def then(self, finish: Callable[[Any], Any]) -> "DeferredReply":
+        """Réponse différée transformée par `finish`."""
+        return DeferredReply(self.future, lambda result: finish(self.finish(result)))
+
+    def result(self) -> Any:
+        """Réponse, une fois `future` terminé."""
+        return self.finish(self.future.result())
+
 
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, storage: glostorage.MailboxStorage | None = None,
+                 hasher: glopassword.PasswordHasher | None = None,
+                 kdf_workers: int = 2, kdf_queue: int = 0,
+                 metrics: glometrics.Metrics | None = None,
+                 admins: list[str] | None = None, profile_rate: int = 10,
+                 max_buffer: int = 16 * 1024 * 1024, idle_timeout: float = 600,
+                 max_upload: int = 64 * 1024 * 1024) -> None:
         """
         Prépare le socket du serveur `_server_socket`
         et le met en mode écoute.
 
+        Les comptes et les courriels sont conservés dans le stockage
+        `_storage`, un DirectoryStorage par défaut.
+
+        Les mots de passe sont hachés avec `hasher` par un bassin de
+        `kdf_workers` fils, hors du fil du moteur. Si `kdf_queue` est
+        positif, au plus `kdf_queue` hachages sont en attente ou en cours à
+        la fois; les connexions suivantes sont refusées jusqu'à ce que la
+        file se vide.
+
+        Les requêtes sont mesurées dans `metrics`, que seuls les comptes
+        de `admins` peuvent consulter avec l'entête METRICS. Une fois
+        l'échantillonnage activé, une requête sur `profile_rate` est
+        exécutée sous cProfile.
+
+        Les réponses et notifications d'un client sont mises en file et
+        transmises au rythme où il les lit. Un client dont la file dépasse
+        `max_buffer` octets, ou qui ne lit ni n'envoie rien pendant
+        `idle_timeout` secondes (0: jamais), est déconnecté.
+
+        Le moteur select ne traite une requête suivie de contenus en flux
+        qu'une fois ceux-ci reçus en entier, sans attendre le client; il
+        déconnecte celui qui en envoie plus de `max_upload` octets ou ne les
+        termine pas en UPLOAD_TIMEOUT secondes.
+
         Prépare les attributs suivants:
         - `_client_socs` une liste des sockets clients.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
-
-        S'assure que les dossiers de données du serveur existent.
+        - `_client_encodings` un dictionnaire associant chaque socket
+            client à l'encodage négocié, JSON par défaut.
+        - `_client_compressions` un dictionnaire associant chaque socket
+            client à l'algorithme de compression des trames négocié.
+        - `_client_capabilities` un dictionnaire associant chaque socket
+            client aux capacités optionnelles négociées.
+        - `_executor` l'exécuteur des traitements du moteur asyncio.
+        - `_kdf_executor` le bassin de hachage, créé au premier usage dans
+            chaque processus.
+        - `_subscribers` un dictionnaire associant chaque nom d'utilisateur
+            aux sockets clients abonnés à ses notifications.
+        - `_outbound` un dictionnaire associant chaque socket client du
+            moteur select aux trames en attente de transmission.
+        - `_decoders` un dictionnaire associant chaque socket client du
+            moteur select au décodeur des trames qu'il a envoyées.
+        - `_uploads` un dictionnaire associant chaque socket client du
+            moteur select à la requête dont il envoie les contenus en flux.
         """
         try:
             self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -46,47 +135,183 @@ class Server:
 
         self._client_socs : list[socket.socket] = []
         self._logged_users = {}
-
-        if not os.path.exists(gloutils.SERVER_DATA_DIR):
-            os.makedirs(gloutils.SERVER_DATA_DIR)
-        if not os.path.exists(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR):
-            os.makedirs(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR)
-        
-
+        self._client_encodings: dict[socket.socket, str] = {}
+        self._client_compressions: dict[socket.socket, str] = {}
+        self._client_capabilities: dict[socket.socket, set[str]] = {}
+        self._executor: concurrent.futures.Executor | None = None
+        self._storage = storage or glostorage.DirectoryStorage()
+        self._hasher = hasher or glopassword.PasswordHasher()
+        self._kdf_workers = kdf_workers
+        self._kdf_queue = kdf_queue
+        self._kdf_executor: concurrent.futures.Executor | None = None
+        self._kdf_pending = 0
+        self._kdf_guard = threading.Lock()
+        # Select engine: clients waiting for a deferred reply, with their
+        # compression, and the replies ready to be sent
+        self._deferred_clients: dict[socket.socket, str | None] = {}
+        self._completed: queue.SimpleQueue = queue.SimpleQueue()
+        self._wakeup_socs: tuple[socket.socket, socket.socket] | None = None
+        # Select engine: frames waiting for each client, their size, the
+        # stream whose chunks follow them and the last progress of the client
+        self._outbound: dict[socket.socket, collections.deque] = {}
+        self._outbound_sizes: dict[socket.socket, int] = {}
+        self._streams: dict[socket.socket, tuple[Iterator[bytes], str | None]] = {}
+        self._last_activity: dict[socket.socket, float] = {}
+        self._decoders: dict[socket.socket, glosocket.FrameDecoder] = {}
+        # Select engine: request whose streamed contents are being received,
+        # with their number and the deadline of their reception
+        self._uploads: dict[socket.socket, tuple[bytes, int, float]] = {}
+        self._max_buffer = max_buffer
+        self._max_upload = max_upload
+        self._idle_timeout = idle_timeout
+        # Subscribed clients of each user and the user of each subscription,
+        # shared by the threads of the asyncio engine
+        self._subscribers: dict[str, set[socket.socket]] = {}
+        self._subscriptions: dict[socket.socket, str] = {}
+        self._subscription_guard = threading.Lock()
+        # Prefork workers: datagram socket receiving the deliveries made by
+        # the other workers, and the sockets reaching each of them
+        self._notify_inbox: socket.socket | None = None
+        self._notify_peers: list[socket.socket] = []
+        # Asyncio engine: its loop. Both engines: the notifications held back
+        # while a client receives the chunks of a stream
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._held_notifications: dict[socket.socket | asyncio.StreamWriter, list[bytes]] = {}
+        self._metrics = metrics or glometrics.Metrics()
+        self._admins = {admin.upper() for admin in admins or ()}
+        self._profiler = glometrics.Profiler(profile_rate)
 
     def cleanup(self) -> None:
         """Ferme toutes les connexions résiduelles."""
         for client_soc in self._client_socs:
             client_soc.close()
         self._server_socket.close()
+        if self._kdf_executor is not None:
+            self._kdf_executor.shutdown(wait=False, cancel_futures=True)
+        self._storage.close()
 
     def _accept_client(self) -> None:
         """Accepte un nouveau client."""
 
-        client_socket, _ = self._server_socket.accept()
+        try:
+            client_socket, _ = self._server_socket.accept()
+        except BlockingIOError:
+            # Another worker process accepted the client first
+            return
+        # Requests are read and replies queued as the socket allows, a client
+        # that sends or reads slowly blocks no one
+        client_socket.setblocking(False)
         self._client_socs.append(client_socket)
+        self._outbound[client_socket] = collections.deque()
+        self._outbound_sizes[client_socket] = 0
+        self._last_activity[client_socket] = time.monotonic()
+        self._decoders[client_socket] = glosocket.FrameDecoder()
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
+        self._unsubscribe(client_soc)
+        self._client_encodings.pop(client_soc, None)
+        self._client_compressions.pop(client_soc, None)
+        self._client_capabilities.pop(client_soc, None)
+        self._logged_users.pop(client_soc, None)
+        self._outbound.pop(client_soc, None)
+        self._outbound_sizes.pop(client_soc, None)
+        self._last_activity.pop(client_soc, None)
+        self._decoders.pop(client_soc, None)
+        self._uploads.pop(client_soc, None)
+        self._held_notifications.pop(client_soc, None)
+        stream, _ = self._streams.pop(client_soc, (None, None))
+        if stream is not None and hasattr(stream, "close"):
+            # Releases the storage the stream was reading
+            stream.close()
         try:
-            self._logged_users.pop(client_soc)
             self._client_socs.remove(client_soc)
-        except (KeyError, ValueError):
+        except ValueError:
             # No need to do anything, the client soc isn't in containers
             pass
 
         client_soc.close()
 
+    def _submit_kdf(self, function: Callable, *args) -> concurrent.futures.Future | None:
+        """
+        Soumet un traitement qui hache un mot de passe au bassin de hachage.
+
+        Retourne None si la file du bassin est pleine.
+        """
+        with self._kdf_guard:
+            if 0 < self._kdf_queue <= self._kdf_pending:
+                return None
+            self._kdf_pending += 1
+            if self._kdf_executor is None:
+                # Created on first use, inside each worker process
+                self._kdf_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._kdf_workers, thread_name_prefix="kdf")
+        future = self._kdf_executor.submit(function, *args)
+        future.add_done_callback(self._kdf_done)
+        return future
+
+    def _kdf_done(self, _: concurrent.futures.Future) -> None:
+        """Libère la place d'un traitement terminé dans la file du bassin."""
+        with self._kdf_guard:
+            self._kdf_pending -= 1
+
+    @staticmethod
+    def _busy() -> gloutils.GloMessage:
+        """Réponse aux connexions refusées quand la file du bassin est pleine."""
+        return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                   payload=gloutils.ErrorPayload(
+                                       error_message="Le serveur est occupé, "
+                                                     "réessayez plus tard"))
+
+    @staticmethod
+    def _error_reply(error_message: str) -> gloutils.GloMessage:
+        """Réponse d'erreur, notamment à une requête dont le payload est invalide."""
+        return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                   payload=gloutils.ErrorPayload(error_message=error_message))
+
+    @staticmethod
+    def _is_str_list(value) -> bool:
+        """Indique si `value` est une liste de chaînes."""
+        return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+    @staticmethod
+    def _is_auth_payload(payload) -> bool:
+        """Indique si le payload contient un nom d'utilisateur et un mot de passe."""
+        return (isinstance(payload, dict) and isinstance(payload.get("username"), str)
+                and isinstance(payload.get("password"), str))
+
+    def _register_user(self, username: str, password: str) -> bool:
+        """
+        Traitement du bassin de hachage: crée le compte avec l'empreinte
+        du mot de passe. Retourne False si le compte existe déjà.
+        """
+        return self._storage.create_user(username, self._hasher.hash(password))
+
+    def _check_password(self, username: str, password: str, credentials: dict) -> bool:
+        """
+        Traitement du bassin de hachage: vérifie le mot de passe et, s'il
+        est valide mais haché avec d'autres paramètres que ceux du serveur,
+        remplace son empreinte.
+        """
+        if not self._hasher.verify(password, credentials):
+            return False
+        if self._hasher.needs_upgrade(credentials):
+            self._storage.update_credentials(username, self._hasher.hash(password))
+        return True
+
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
-                        ) -> gloutils.GloMessage:
+                        ) -> gloutils.GloMessage | DeferredReply:
         """
         Crée un compte à partir des données du payload.
 
-        Si les identifiants sont valides, créee le dossier de l'utilisateur,
-        associe le socket au nouvel l'utilisateur et retourne un succès,
-        sinon retourne un message d'erreur.
+        Si les identifiants sont valides, le mot de passe est haché et le
+        dossier de l'utilisateur créé dans le bassin de hachage; la réponse
+        différée associe alors le socket au nouvel utilisateur et indique le
+        succès. Sinon, retourne un message d'erreur.
         """
+        if not self._is_auth_payload(payload):
+            return self._error_reply("Identifiants invalides")
         userName = payload["username"].upper()
         pw = payload["password"]
 
@@ -94,8 +319,8 @@ class Server:
         pattern = re.compile(r"[a-zA-Z0-9_\.-]+")
         validUsername = pattern.fullmatch(userName)
         
-        # Make sure there is not already an account with this name in the server data dir
-        newUsername = not os.path.exists(gloutils.SERVER_DATA_DIR + "/" + userName)
+        # Make sure there is not already an account with this name
+        newUsername = not self._storage.user_exists(userName)
 
         # Make sure the password is secure enough
         validPwLength = len(pw) >= 10
@@ -114,20 +339,23 @@ class Server:
         validCredentials = validUsername and newUsername and validPwLength and pwContainsNumber and pwContainsMin and pwContainsMaj
 
         if validCredentials:
-            os.makedirs(gloutils.SERVER_DATA_DIR + "/" + userName)
-
-            # hash password and add to folder
-            encodedPw = pw.encode('utf-8')
-            hasher = hashlib.sha3_224()
-            hasher.update(encodedPw)
-            data = {"password_hash": hasher.hexdigest()}
-            with open(gloutils.SERVER_DATA_DIR + "/" + userName + "/" + gloutils.PASSWORD_FILENAME, 'w') as f:
-                json.dump(data, f)
-            
-            # confirm success to client
-            message = gloutils.GloMessage(header=gloutils.Headers.OK)
-
-            self._logged_users[client_soc] = userName
+            # hash password and store it with the account, off the engine thread
+            future = self._submit_kdf(self._register_user, userName, pw)
+            if future is None:
+                return self._busy()
+
+            def finish(created: bool) -> gloutils.GloMessage:
+                if not created:
+                    # Another request created the same account in the meantime
+                    return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                               payload=gloutils.ErrorPayload(
+                                                   error_message="Ce nom d'utilisateur est déjà pris\n"))
+                # confirm success to client
+                self._unsubscribe(client_soc)
+                self._logged_users[client_soc] = userName
+                return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+            return DeferredReply(future, finish)
         else:
             error_string = ""
             if not validUsername:
@@ -149,109 +377,373 @@ class Server:
         return message
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
-               ) -> gloutils.GloMessage:
+               ) -> gloutils.GloMessage | DeferredReply:
         """
         Vérifie que les données fournies correspondent à un compte existant.
 
-        Si les identifiants sont valides, associe le socket à l'utilisateur et
-        retourne un succès, sinon retourne un message d'erreur.
+        Le mot de passe est vérifié dans le bassin de hachage. Si les
+        identifiants sont valides, la réponse différée associe le socket à
+        l'utilisateur et indique le succès, sinon elle contient un message
+        d'erreur.
         """
+        if not self._is_auth_payload(payload):
+            return self._error_reply("Identifiants invalides")
         userName = payload["username"].upper()
         pw = payload["password"]
-        validUsername = validPw = False
-
-        validUsername = os.path.exists(gloutils.SERVER_DATA_DIR + "/" + userName)
 
-        # Verify password (only if username exists)
-        if validUsername:
-            with open(gloutils.SERVER_DATA_DIR + "/" + userName + "/" + gloutils.PASSWORD_FILENAME, 'r') as f:
-                storedHash = json.load(f)
-            given_hash = hashlib.sha3_224()
-            given_hash.update(pw.encode('utf-8'))
-            validPw = hmac.compare_digest(given_hash.hexdigest(), storedHash["password_hash"])
-
-        if validUsername and validPw:
-            message = gloutils.GloMessage(header=gloutils.Headers.OK)
+        storedHash = self._storage.get_credentials(userName)
+        if storedHash is None:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(
+                                           error_message="Le nom d'utilisateur n'est pas valide"))
+
+        # Verify password, off the engine thread
+        future = self._submit_kdf(self._check_password, userName, pw, storedHash)
+        if future is None:
+            return self._busy()
+
+        def finish(validPw: bool) -> gloutils.GloMessage:
+            if not validPw:
+                return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                           payload=gloutils.ErrorPayload(
+                                               error_message="Le mot de passe n'est pas valide"))
+            self._unsubscribe(client_soc)
             self._logged_users[client_soc] = userName
-        else:
-            error_string = ""
-            if not validUsername:
-                error_string = "Le nom d'utilisateur n'est pas valide"
-            elif not validPw:
-                error_string = "Le mot de passe n'est pas valide"
+            return gloutils.GloMessage(header=gloutils.Headers.OK)
 
-            message = gloutils.GloMessage(header=gloutils.Headers.ERROR,
-                                          payload=gloutils.ErrorPayload(error_message=error_string))
+        return DeferredReply(future, finish)
 
-        return message
+    def _negotiate(self, client_soc: socket.socket,
+                   payload: gloutils.NegotiationPayload
+                   ) -> gloutils.GloMessage:
+        """
+        Retient le premier encodage proposé par le client que le serveur
+        supporte, JSON sinon, le premier algorithme de compression proposé
+        que le serveur supporte, aucun sinon, ainsi que les capacités
+        proposées que le serveur supporte, et les retourne au client.
+
+        La réponse est encodée en JSON et n'est pas compressée, les
+        messages suivants utilisent l'encodage et la compression retenus.
+        Sans compression retenue, une trame compressée du client met fin à
+        la connexion. Une proposition mal formée reçoit une erreur et ne
+        change rien.
+        """
+        payload = {} if payload is None else payload
+        if not (isinstance(payload, dict)
+                and all(self._is_str_list(payload.get(key, []))
+                        for key in ("encodings", "compressions", "capabilities"))):
+            return self._error_reply("Négociation invalide")
+        encoding = glocodec.ENCODING_JSON
+        for proposed in payload.get("encodings", []):
+            if proposed in glocodec.SUPPORTED_ENCODINGS:
+                encoding = proposed
+                break
+        compressions = [proposed for proposed in payload.get("compressions", [])
+                        if proposed in glosocket.SUPPORTED_COMPRESSIONS][:1]
+        capabilities = [capability for capability in gloutils.SUPPORTED_CAPABILITIES
+                        if capability in payload.get("capabilities", [])]
+
+        self._client_encodings[client_soc] = encoding
+        if compressions:
+            self._client_compressions[client_soc] = compressions[0]
+        else:
+            self._client_compressions.pop(client_soc, None)
+        self._client_capabilities[client_soc] = set(capabilities)
+        return gloutils.GloMessage(header=gloutils.Headers.OK,
+                                   payload=gloutils.NegotiationPayload(
+                                       encodings=[encoding], compressions=compressions,
+                                       capabilities=capabilities))
 
     def _logout(self, client_soc: socket.socket) -> None:
         """Déconnecte un utilisateur."""
 
-        self._logged_users.pop(client_soc)
+        self._unsubscribe(client_soc)
+        self._logged_users.pop(client_soc, None)
+
+    def _subscribe(self, client_soc: socket.socket) -> gloutils.GloMessage:
+        """
+        Abonne le client aux notifications des courriels livrés à
+        l'utilisateur associé au socket, jusqu'à sa déconnexion.
+        """
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(
+                                           error_message="Aucun utilisateur connecté"))
+        self._unsubscribe(client_soc)
+        with self._subscription_guard:
+            self._subscriptions[client_soc] = username
+            self._subscribers.setdefault(username, set()).add(client_soc)
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _unsubscribe(self, client_soc: socket.socket) -> None:
+        """Retire l'abonnement du client, s'il en a un."""
+        with self._subscription_guard:
+            username = self._subscriptions.pop(client_soc, None)
+            clients = self._subscribers.get(username)
+            if clients is not None:
+                clients.discard(client_soc)
+                if not clients:
+                    del self._subscribers[username]
+
+    def _notify(self, usernames: list[str], notification: gloutils.NotificationPayload,
+                relay: bool = True) -> None:
+        """
+        Transmet la notification aux clients abonnés de chaque utilisateur
+        et, si `relay` est vrai, aux autres processus travailleurs, qui la
+        transmettent à leurs propres abonnés.
+
+        Les notifications sont une simple commodité: celles qui ne peuvent
+        être transmises sont perdues, le client voit le courriel à sa
+        prochaine consultation.
+        """
+        if relay and self._notify_peers:
+            datagram = json.dumps({"usernames": usernames,
+                                   "notification": notification}).encode('utf-8')
+            for peer in self._notify_peers:
+                with contextlib.suppress(OSError):
+                    # A full or oversized datagram is dropped
+                    peer.send(datagram)
+
+        with self._subscription_guard:
+            clients = [client_soc for username in usernames
+                       for client_soc in self._subscribers.get(username, ())]
+        message = gloutils.GloMessage(header=gloutils.Headers.NOTIFICATION,
+                                      payload=notification)
+        encoded = {}
+        for client_soc in clients:
+            encoding = self._client_encodings.get(client_soc, glocodec.ENCODING_JSON)
+            if encoding not in encoded:
+                try:
+                    encoded[encoding] = glocodec.encode(message, encoding)
+                except glocodec.GLOCodecError:
+                    encoded[encoding] = None
+            if encoded[encoding] is None:
+                continue
+            frame = glosocket.encode_frame(encoded[encoding],
+                                           self._client_compressions.get(client_soc))
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._push_async, client_soc, frame)
+            else:
+                self._push(client_soc, frame)
+
+    def _push(self, client_soc: socket.socket, frame: bytes) -> None:
+        """
+        Met une notification en file pour un client du moteur select, ou la
+        retient s'il reçoit les morceaux d'un contenu en flux. Elle est
+        transmise quand son socket est prêt, le client pouvant être celui
+        dont la requête est en cours de traitement.
+        """
+        held = self._held_notifications.get(client_soc)
+        if held is None:
+            self._queue_frame(client_soc, frame)
+        elif self._outbound_sizes[client_soc] + sum(map(len, held)) + len(frame) > self._max_buffer:
+            self._remove_client(client_soc)
+        else:
+            held.append(frame)
+
+    def _push_async(self, writer: asyncio.StreamWriter, frame: bytes) -> None:
+        """
+        Écrit une notification pour un client du moteur asyncio, ou la
+        retient s'il reçoit les morceaux d'un contenu en flux. Un client qui
+        laisse s'accumuler plus de `_max_buffer` octets est déconnecté.
+        """
+        if writer.is_closing():
+            return
+        held = self._held_notifications.get(writer)
+        buffered = writer.transport.get_write_buffer_size() + sum(map(len, held or ()))
+        if buffered and buffered + len(frame) > self._max_buffer:
+            # Its coroutine ends on the broken connection
+            writer.transport.abort()
+        elif held is not None:
+            held.append(frame)
+        else:
+            writer.write(frame)
 
-    def _get_email_list(self, client_soc: socket.socket
+    def _receive_notifications(self) -> None:
+        """
+        Transmet aux abonnés de ce processus les livraisons annoncées par
+        les autres processus travailleurs.
+        """
+        while True:
+            try:
+                datagram = self._notify_inbox.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                announce = json.loads(datagram)
+                usernames = announce["usernames"]
+                notification = announce["notification"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            self._notify(usernames, notification, relay=False)
+
+    def _get_email_list(self, client_soc: socket.socket,
+                        payload: gloutils.EmailListRequestPayload | None = None
                         ) -> gloutils.GloMessage:
         """
         Récupère la liste des courriels de l'utilisateur associé au socket.
         Les éléments de la liste sont construits à l'aide du gabarit
         SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
 
+        La liste est servie à partir de l'index des entêtes du stockage. Si le
+        payload contient `offset` et `limit`, seule cette page est retournée.
+
         Une absence de courriel n'est pas une erreur, mais une liste vide.
+        Une page mal décrite est une erreur.
         """
 
-        folder = gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc]
-        json_files = [f for f in os.listdir(folder) if f != gloutils.PASSWORD_FILENAME]
-
-        file_list = []
-        for file in json_files:
-            with open(folder + "/" + file, 'r') as f:
-                file_list.append(json.load(f))
-        
-        # List items format : (envoyeur, sujet, date)
-        email_list = [(mail["sender"], mail["subject"], mail["date"]) for mail in file_list]
-
-        # Sort list
-        sorted_list = sorted(email_list, key=lambda x : x[2], reverse=True)
-
+        page = self._page(payload)
+        if page is None:
+            return self._error_reply("Page invalide")
+        offset, limit = page
+        entries, total = self._storage.list_headers(self._logged_users[client_soc],
+                                                    offset, limit)
+        return self._email_list(entries, offset, total)
+
+    @staticmethod
+    def _page(payload: gloutils.EmailListRequestPayload | None
+              ) -> tuple[int, int | None] | None:
+        """
+        Position et taille de la page demandée, la taille étant None pour
+        une liste complète. Retourne None si le payload n'est pas un
+        dictionnaire ou si la position ou la taille n'est pas un entier
+        positif.
+        """
+        payload = {} if payload is None else payload
+        if not isinstance(payload, dict):
+            return None
+        offset = payload.get("offset", 0)
+        limit = payload.get("limit")
+        if type(offset) is not int or offset < 0:
+            return None
+        if limit is not None and (type(limit) is not int or limit < 0):
+            return None
+        return offset, limit
+
+    @staticmethod
+    def _email_list(entries: list[dict], offset: int, total: int) -> gloutils.GloMessage:
+        """
+        Réponse listant les entêtes `entries` avec le gabarit
+        SUBJECT_DISPLAY, numérotés à partir de la position `offset`.
+        """
         subject_list = []
-        for i, email in enumerate(sorted_list):
+        id_list = []
+        for i, entry in enumerate(entries, start=offset):
             display = gloutils.SUBJECT_DISPLAY.format(
                 number = i+1,
-                sender = email[0],
-                subject = email[1],
-                date = email[2]
+                sender = entry["sender"],
+                subject = entry["subject"],
+                date = entry["date"]
             )
             subject_list.append(display)
+            id_list.append(entry["id"])
 
         return gloutils.GloMessage(header=gloutils.Headers.OK,
-                                   payload=gloutils.EmailListPayload(email_list=subject_list))
+                                   payload=gloutils.EmailListPayload(email_list=subject_list,
+                                                                     email_ids=id_list,
+                                                                     offset=offset,
+                                                                     total=total))
+
+    def _search(self, client_soc: socket.socket,
+                payload: gloutils.SearchPayload | None = None) -> gloutils.GloMessage:
+        """
+        Recherche les courriels de l'utilisateur associé au socket à l'aide
+        de l'index inversé du stockage, sans lire les courriels eux-mêmes.
+
+        La réponse a la forme de celle de _get_email_list, `total` étant le
+        nombre de résultats. Un filtre qui n'est pas une chaîne ou une date
+        mal formée est une erreur.
+        """
+        payload = {} if payload is None else payload
+        if not isinstance(payload, dict):
+            return self._error_reply("Recherche invalide")
+        page = self._page(payload)
+        if page is None:
+            return self._error_reply("Page invalide")
+        offset, limit = page
+        filters = {key: payload.get(key) or "" for key in ("query", "sender", "since", "until")}
+        if not all(isinstance(value, str) for value in filters.values()):
+            return self._error_reply("Recherche invalide")
+        dates = {}
+        for key in ("since", "until"):
+            value = filters[key] or None
+            if value is not None:
+                try:
+                    value = datetime.date.fromisoformat(value)
+                except ValueError:
+                    return self._error_reply(f"Date invalide : {value}")
+            dates[key] = value
+
+        entries = self._storage.search(self._logged_users[client_soc],
+                                       filters["query"], filters["sender"],
+                                       dates["since"], dates["until"])
+        end = None if limit is None else offset + limit
+        return self._email_list(entries[offset:end], offset, len(entries))
 
     def _get_email(self, client_soc: socket.socket,
-                   payload: gloutils.EmailChoicePayload
-                   ) -> gloutils.GloMessage:
+                   payload: gloutils.EmailChoicePayload, streaming: bool = False
+                   ) -> tuple[gloutils.GloMessage, Iterator[bytes] | None]:
         """
         Récupère le contenu de l'email dans le dossier de l'utilisateur associé
         au socket.
-        """
-        folder = gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc]
-        json_files = [f for f in os.listdir(folder) if f != gloutils.PASSWORD_FILENAME]
 
-        file_list = []
-        for file in json_files:
-            with open(folder + "/" + file, 'r') as f:
-                file_list.append(json.load(f))
+        Le courriel est désigné par son identifiant stable `email_id` et, pour
+        les anciens clients, par son numéro `choice` dans la liste.
 
-        # Sort list
-        sorted_list = sorted(file_list, key=lambda x : x["date"], reverse=True)
+        Si le courriel a été reçu en flux et que `streaming` est vrai, la
+        réponse ne contient que ses entêtes; les morceaux de son corps et de
+        ses pièces jointes, à transmettre après la réponse, sont aussi
+        retournés. Sinon, son corps est placé dans la réponse, sans les
+        pièces jointes.
+        """
+        if not isinstance(payload, dict):
+            return self._error_reply("Ce courriel n'existe pas"), None
+        userName = self._logged_users[client_soc]
+
+        if "email_id" in payload:
+            email_id = payload["email_id"]
+            if not isinstance(email_id, str):
+                email_id = None
+        else:
+            choice = payload.get("choice")
+            email_id = None
+            if isinstance(choice, int) and choice >= 1:
+                entries, _ = self._storage.list_headers(userName, choice - 1, 1)
+                if entries:
+                    email_id = entries[0]["id"]
+
+        chosen_email = None
+        if email_id is not None:
+            chosen_email = self._storage.get_mail(userName, email_id)
+        if chosen_email is None:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(
+                                           error_message="Ce courriel n'existe pas")), None
 
-        chosen_email = sorted_list[payload["choice"] -1]
         sender = chosen_email["sender"]
         subject = chosen_email["subject"]
         destination = chosen_email["destination"]
         date = chosen_email["date"]
         content = chosen_email["content"]
 
+        if chosen_email.get("streamed"):
+            chunks = self._storage.read_stream(userName, email_id)
+            if streaming:
+                return gloutils.GloMessage(header=gloutils.Headers.OK,
+                                           payload=gloutils.StreamedEmailPayload(
+                                               sender=sender,
+                                               subject=subject,
+                                               destination=destination,
+                                               date=date,
+                                               content="",
+                                               streamed=True,
+                                               content_size=chosen_email["content_size"],
+                                               attachments=chosen_email["attachments"]
+                                           )), chunks
+            # The body is read up to the end of its part
+            content = b"".join(itertools.takewhile(bool, chunks)).decode('utf-8', 'replace')
+
         return gloutils.GloMessage(header=gloutils.Headers.OK,
                                    payload=gloutils.EmailContentPayload(
                                        sender=sender,
@@ -259,125 +751,997 @@ class Server:
                                        destination=destination,
                                        date=date,
                                        content=content
-                                   ))
+                                   )), None
 
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
         de l'utilisateur associé au socket.
-        """
 
-        folder = pathlib.Path(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc])
-        json_files = [f for f in os.listdir(folder) if f != gloutils.PASSWORD_FILENAME]
-
-        nb_of_emails = len(json_files)
-        
-        total_size = 0
-        for file in folder.iterdir():
-            total_size += os.path.getsize(file)
+        Les valeurs proviennent des compteurs tenus à jour à chaque livraison.
+        """
 
         return gloutils.GloMessage(header=gloutils.Headers.OK,
-                                   payload=gloutils.StatsPayload(
-                                       count=nb_of_emails,
-                                       size=total_size
-                                   ))
+                                   payload=self._storage.get_stats(self._logged_users[client_soc]))
+
+    @staticmethod
+    def _parse_recipients(destination: str) -> list[tuple[str, str | None]]:
+        """
+        Sépare les adresses du champ `destination` et associe à chacune le
+        nom du compte destinataire, ou None si l'adresse est externe au
+        serveur.
+        """
+        recipients = []
+        for _, address in email.utils.getaddresses([destination]):
+            if not address:
+                continue
+            local_part, _, domain = address.rpartition("@")
+            if local_part and domain.lower() == gloutils.SERVER_DOMAIN.lower():
+                recipients.append((address, local_part.upper()))
+            else:
+                recipients.append((address, None))
+        return recipients
+
+    @staticmethod
+    def _stream_parts(payload: gloutils.StreamedEmailPayload) -> int:
+        """
+        Nombre de parties qui suivent un courriel envoyé en flux: le corps
+        et chaque pièce jointe.
 
-    def _send_email(self, payload: gloutils.EmailContentPayload
+        Lève une exception GLOCodecError si les pièces jointes sont mal
+        décrites, car la suite de la connexion ne peut être interprétée.
+        """
+        attachments = payload.get("attachments", [])
+        if not (isinstance(attachments, list)
+                and all(isinstance(attachment, dict) and isinstance(attachment.get("name"), str)
+                        for attachment in attachments)):
+            raise glocodec.GLOCodecError("Invalid attachments description")
+        return 1 + len(attachments)
+
+    def _send_email(self, payload: gloutils.EmailContentPayload,
+                    recv_chunk: Callable[[], bytes] | None = None
                     ) -> gloutils.GloMessage:
         """
-        Détermine si l'envoi est interne ou externe et:
+        Détermine, pour chaque destinataire, si l'envoi est interne ou
+        externe et:
         - Si l'envoi est interne, écris le message tel quel dans le dossier
-        du destinataire.
-        - Si le destinataire n'existe pas, place le message dans le dossier
-        SERVER_LOST_DIR et considère l'envoi comme un échec.
+        du destinataire. Le message est écrit une seule fois par dossier,
+        même si le destinataire est répété.
+        - Si le destinataire n'existe pas, considère l'envoi comme un échec.
         - Si le destinataire est externe, considère l'envoi comme un échec.
 
-        Retourne un messange indiquant le succès ou l'échec de l'opération.
+        En cas d'échec, une copie du message est placée dans le dossier
+        SERVER_LOST_DIR.
+
+        Si le courriel est envoyé en flux, son contenu est lu avec
+        `recv_chunk` et écrit au fur et à mesure dans le stockage.
+
+        Retourne un messange indiquant le succès ou l'échec de l'opération
+        avec l'état de chaque destinataire. Un courriel dont un champ n'est
+        pas une chaîne est refusé avant toute livraison.
         """
-        intern = exists = False
-        file_name = "mail" + str(random.randrange(1000000))
-        destination = payload["destination"][:-11]
+        if not isinstance(payload, dict):
+            return self._error_reply("Courriel invalide")
+        streamed = bool(payload.get("streamed"))
+        if streamed:
+            if recv_chunk is None:
+                raise glocodec.GLOCodecError("A streamed mail cannot be batched")
+            parts = self._stream_parts(payload)
+
+        valid = all(isinstance(payload.get(key), str)
+                    for key in ("sender", "destination", "subject", "date", "content"))
+        recipients = self._parse_recipients(payload["destination"]) if valid else []
+        if not recipients:
+            if streamed:
+                # Skip the content to stay in step with the client
+                for _ in range(parts):
+                    for _ in iter(recv_chunk, b""):
+                        pass
+            return self._error_reply("Aucun destinataire" if valid else "Courriel invalide")
+
+        statuses = []
+        mailboxes = []
+        for address, username in recipients:
+            if username is None:
+                error_string = "Le destinataire est externe au serveur"
+            elif not self._storage.user_exists(username):
+                error_string = "Cet utilisateur n'existe pas"
+            else:
+                mailboxes.append(username)
+                statuses.append(gloutils.RecipientStatus(address=address, delivered=True))
+                continue
+            statuses.append(gloutils.RecipientStatus(address=address, delivered=False,
+                                                     error_message=error_string))
+
+        failures = [status for status in statuses if not status["delivered"]]
+        mail_id = None
+        if streamed:
+            mail_id = self._storage.deliver_stream(mailboxes, payload, recv_chunk,
+                                                   lost=bool(failures))
+        else:
+            if mailboxes:
+                mail_id = self._storage.deliver_many(mailboxes, payload)
+            if failures:
+                self._storage.store_lost(payload)
+        if mailboxes:
+            self._notify(list(dict.fromkeys(mailboxes)), gloutils.NotificationPayload(
+                email_id=mail_id, sender=payload["sender"],
+                subject=payload["subject"][:gloutils.NOTIFICATION_SUBJECT_LENGTH],
+                date=payload["date"]))
+
+        if not failures:
+            return gloutils.GloMessage(header=gloutils.Headers.OK,
+                                       payload=gloutils.DeliveryReportPayload(statuses=statuses))
+
+        if len(statuses) == 1:
+            error_string = failures[0]["error_message"]
+        else:
+            error_string = "\n".join(f"{status['address']} : {status['error_message']}"
+                                     for status in failures)
+        return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                   payload=gloutils.DeliveryReportPayload(
+                                       error_message=error_string, statuses=statuses))
+
+    def _get_metrics(self, client_soc: socket.socket,
+                     payload: gloutils.MetricsPayload | None = None
+                     ) -> gloutils.GloMessage:
+        """
+        Retourne les mesures du processus serveur à un administrateur.
 
-        if payload["destination"][-10:] == gloutils.SERVER_DOMAIN.lower():
-            intern = True
+        Si le payload contient `profile`, active ou arrête d'abord
+        l'échantillonnage; à l'arrêt, le rapport du profil est joint à la
+        réponse.
+        """
+        if self._logged_users.get(client_soc) not in self._admins:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(
+                                           error_message="Accès réservé aux administrateurs"))
+        payload = {} if payload is None else payload
+        if not isinstance(payload, dict):
+            return self._error_reply("Requête de mesures invalide")
+        reply = gloutils.MetricsPayload()
+        profile = payload.get("profile")
+        if profile is True:
+            self._profiler.start()
+        elif profile is False:
+            reply["report"] = self._profiler.stop(self._profile_path())
+        reply["metrics"] = self._metrics.snapshot(self._gauges())
+        return gloutils.GloMessage(header=gloutils.Headers.OK, payload=reply)
+
+    def _gauges(self) -> dict[str, Any]:
+        """Jauges du serveur ajoutées aux mesures."""
+        gauges = {"clients": len(self._client_socs),
+                  "logged_users": len(self._logged_users),
+                  "outbound_bytes": sum(self._outbound_sizes.values()),
+                  "subscriptions": len(self._subscriptions),
+                  "kdf_pending": self._kdf_pending,
+                  "profiling": self._profiler.enabled}
+        if isinstance(self._storage, glocache.CachedStorage):
+            gauges["cache"] = self._storage.cache.stats()
+            gauges["registry"] = self._storage.registry.stats()
+        return gauges
+
+    @staticmethod
+    def _profile_path() -> str:
+        """Fichier où est écrit le profil du processus, dans le dossier courant."""
+        return os.path.abspath(f"glo_profile_{os.getpid()}.pstats")
+
+    def toggle_profile(self) -> None:
+        """
+        Active l'échantillonnage, ou l'arrête et écrit le profil, puis
+        l'indique sur la sortie d'erreur.
+        """
+        if self._profiler.enabled:
+            self._profiler.stop(self._profile_path())
+            print(f"Profil du processus {os.getpid()} : {self._profile_path()}",
+                  file=sys.stderr)
+        else:
+            self._profiler.start()
+            print(f"Échantillonnage du processus {os.getpid()} activé", file=sys.stderr)
 
-        if os.path.exists(gloutils.SERVER_DATA_DIR + "/" + destination):
-            exists = True
-        
-        if intern and exists:
-            with open(gloutils.SERVER_DATA_DIR + "/" + destination + "/" + file_name, 'w') as f:
-                json.dump(payload, f)
+    def _dispatch(self, client_soc: socket.socket, header: int, payload,
+                  recv_chunk: Callable[[], bytes] | None = None
+                  ) -> gloutils.GloMessage:
+        """
+        Achemine une requête vers le traitement correspondant à son entête
+        et retourne la réponse.
+
+        Seules les entêtes qui ne changent pas l'état de la connexion sont
+        traitées ici; elles peuvent donc aussi faire partie d'un lot. Les
+        contenus envoyés en flux sont lus avec `recv_chunk`, absent dans un
+        lot. Celles qui portent sur le dossier de l'utilisateur exigent
+        qu'il soit connecté.
+        """
+        if (header in (gloutils.Headers.INBOX_READING_REQUEST,
+                       gloutils.Headers.INBOX_READING_CHOICE,
+                       gloutils.Headers.STATS_REQUEST, gloutils.Headers.SEARCH)
+                and client_soc not in self._logged_users):
+            return self._error_reply("Aucun utilisateur connecté")
 
-            message = gloutils.GloMessage(header=gloutils.Headers.OK)
-        
+        if header == gloutils.Headers.INBOX_READING_REQUEST:
+            return self._get_email_list(client_soc, payload)
+
+        if header == gloutils.Headers.INBOX_READING_CHOICE:
+            return self._get_email(client_soc, payload)[0]
+
+        if header == gloutils.Headers.EMAIL_SENDING:
+            return self._send_email(payload, recv_chunk)
+
+        if header == gloutils.Headers.STATS_REQUEST:
+            return self._get_stats(client_soc)
+
+        if header == gloutils.Headers.SEARCH:
+            return self._search(client_soc, payload)
+
+        if header == gloutils.Headers.METRICS:
+            return self._get_metrics(client_soc, payload)
+
+        return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                   payload=gloutils.ErrorPayload(
+                                       error_message="Entête inconnue"))
+
+    def _run_batch(self, client_soc: socket.socket,
+                   payload: gloutils.BatchPayload
+                   ) -> gloutils.GloMessage:
+        """
+        Traite les requêtes d'un lot dans l'ordre et retourne leurs
+        réponses, chacune avec le `request_id` de sa requête.
+
+        Un lot n'est traité que pour un utilisateur connecté et si chacune
+        de ses requêtes est un message dont l'entête est un entier. Les
+        entêtes qui changent l'état de la connexion (BYE, AUTH_REGISTER,
+        AUTH_LOGIN, AUTH_LOGOUT, NEGOTIATION, BATCH, SUBSCRIBE) reçoivent une
+        réponse d'erreur.
+        """
+        if client_soc not in self._logged_users:
+            return self._error_reply("Aucun utilisateur connecté")
+        requests = payload.get("requests") if isinstance(payload, dict) else None
+        if not isinstance(requests, list) or len(requests) > gloutils.BATCH_MAX_REQUESTS:
+            return self._error_reply("Le lot doit contenir au plus "
+                                     f"{gloutils.BATCH_MAX_REQUESTS} requêtes")
+        if not all(isinstance(request, dict) and type(request.get("header")) is int
+                   for request in requests):
+            return self._error_reply("Lot invalide")
+
+        replies = []
+        for request in requests:
+            header = request["header"]
+            if header in (gloutils.Headers.BYE, gloutils.Headers.AUTH_REGISTER,
+                          gloutils.Headers.AUTH_LOGIN, gloutils.Headers.AUTH_LOGOUT,
+                          gloutils.Headers.NEGOTIATION, gloutils.Headers.BATCH,
+                          gloutils.Headers.SUBSCRIBE):
+                reply = gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                            payload=gloutils.ErrorPayload(
+                                                error_message="Entête non permise dans un lot"))
+            else:
+                reply = self._dispatch(client_soc, header, request.get("payload"))
+            if "request_id" in request:
+                reply["request_id"] = request["request_id"]
+            replies.append(reply)
+
+        return gloutils.GloMessage(header=gloutils.Headers.OK,
+                                   payload=gloutils.BatchPayload(replies=replies))
+
+    @staticmethod
+    def _encode_reply(request: dict, encoding: str, reply: gloutils.GloMessage) -> bytes:
+        """Encode la réponse à une requête, avec le `request_id` de celle-ci."""
+        if "request_id" in request:
+            reply["request_id"] = request["request_id"]
+        return glocodec.encode(reply, encoding)
+
+    def _handle_request(self, client_soc: socket.socket, data: bytes,
+                        recv_chunk: Callable[[], bytes] | None = None
+                        ) -> tuple[bytes | DeferredReply | None, bool, Iterator[bytes] | None]:
+        """
+        Décode une requête du client, l'achemine vers le traitement
+        correspondant à son entête et encode la réponse, qui reprend le
+        `request_id` de la requête. Le contenu d'un courriel envoyé en flux
+        est lu avec `recv_chunk`.
+
+        Retourne la réponse à transmettre (None s'il n'y en a pas, une
+        DeferredReply dont le résultat est la réponse encodée si elle est
+        différée), un booléen indiquant si la connexion doit rester ouverte
+        et les morceaux à transmettre en flux après la réponse (None s'il
+        n'y en a pas). Le moteur ne lit plus de requête du client tant
+        qu'une réponse différée n'est pas transmise.
+
+        La durée du traitement, jusqu'à la réponse encodée, et les octets
+        reçus et transmis sont mesurés pour l'entête de la requête.
+
+        Lève une exception GLOCodecError si la requête est invalide.
+        """
+        start = time.perf_counter()
+        self._metrics.add_bytes(received=len(data))
+        data = glocodec.decode(data)
+        header = data["header"]
+        encoding = self._client_encodings.get(client_soc, glocodec.ENCODING_JSON)
+        if recv_chunk is not None:
+            recv_chunk = self._counting(recv_chunk)
+
+        if header == gloutils.Headers.METRICS:
+            # Never sampled, it may stop the sampling itself
+            reply, keep_open, stream = self._route(client_soc, header, data.get("payload"),
+                                                   recv_chunk)
         else:
-            error_string = ""
-            with open(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR + "/" + file_name, 'w') as f:
-                json.dump(payload, f)
-            if intern == False:
-                error_string = "Le destinataire est externe au serveur"
-            elif exists == False:
-                error_string = "Cet utilisateur n'existe pas"
-            
-            message = gloutils.GloMessage(header=gloutils.Headers.ERROR,
-                                          payload=gloutils.ErrorPayload(error_message=error_string))
+            reply, keep_open, stream = self._profiler.run(
+                self._route, client_soc, header, data.get("payload"), recv_chunk)
+
+        finish = functools.partial(self._finish_reply, data, encoding, start)
+        if isinstance(reply, DeferredReply):
+            return reply.then(finish), keep_open, None
+        return finish(reply), keep_open, stream
+
+    def _counting(self, recv_chunk: Callable[[], bytes]) -> Callable[[], bytes]:
+        """Fonction de réception de morceaux qui compte les octets reçus."""
+        def receive() -> bytes:
+            chunk = recv_chunk()
+            self._metrics.add_bytes(received=len(chunk))
+            return chunk
+        return receive
+
+    def _finish_reply(self, request: dict, encoding: str, start: float,
+                      reply: gloutils.GloMessage | None) -> bytes | None:
+        """
+        Encode la réponse à une requête, s'il y en a une, et mesure le
+        traitement de la requête commencé à `start` (time.perf_counter).
+        """
+        encoded = None if reply is None else self._encode_reply(request, encoding, reply)
+        try:
+            name = gloutils.Headers(request["header"]).name
+        except (ValueError, TypeError):
+            name = "UNKNOWN"
+        self._metrics.record_request(
+            name, int((time.perf_counter() - start) * 1_000_000),
+            reply is not None and reply.get("header") == gloutils.Headers.ERROR)
+        if encoded is not None:
+            self._metrics.add_bytes(sent=len(encoded))
+        return encoded
+
+    def _route(self, client_soc: socket.socket, header: int, payload,
+               recv_chunk: Callable[[], bytes] | None = None
+               ) -> tuple[gloutils.GloMessage | DeferredReply | None, bool,
+                          Iterator[bytes] | None]:
+        """
+        Achemine une requête décodée vers le traitement correspondant à son
+        entête. Retourne la réponse, à encoder, et les deux autres valeurs
+        de _handle_request.
+        """
+        if header == gloutils.Headers.BYE:
+            return None, False, None
 
-        return message
+        if header == gloutils.Headers.AUTH_LOGOUT:
+            self._logout(client_soc)
+            return None, True, None
+
+        stream = None
+
+        if header == gloutils.Headers.AUTH_REGISTER:
+            reply = self._create_account(client_soc, payload)
+
+        elif header == gloutils.Headers.AUTH_LOGIN:
+            reply = self._login(client_soc, payload)
+
+        elif header == gloutils.Headers.NEGOTIATION:
+            # The reply is sent with the encoding in use before negotiation
+            reply = self._negotiate(client_soc, payload)
+
+        elif header == gloutils.Headers.BATCH:
+            reply = self._run_batch(client_soc, payload)
+
+        elif header == gloutils.Headers.SUBSCRIBE:
+            reply = self._subscribe(client_soc)
+
+        elif (header == gloutils.Headers.INBOX_READING_CHOICE
+              and gloutils.CAPABILITY_STREAMING in self._client_capabilities.get(client_soc, ())
+              and client_soc in self._logged_users):
+            reply, stream = self._get_email(client_soc, payload, streaming=True)
+
+        else:
+            reply = self._dispatch(client_soc, header, payload, recv_chunk)
+
+        return reply, True, stream
+
+    def _defer(self, client_soc: socket.socket, reply: DeferredReply,
+                compression: str | None) -> None:
+        """
+        Met un client du moteur select en attente de sa réponse différée,
+        qui sera transmise par _send_deferred_replies.
+        """
+        self._deferred_clients[client_soc] = compression
+
+        def done(_: concurrent.futures.Future) -> None:
+            self._completed.put((client_soc, reply))
+            with contextlib.suppress(BlockingIOError):
+                # A full socket already holds a pending wake-up
+                self._wakeup_socs[1].send(b"\0")
+
+        reply.future.add_done_callback(done)
+
+    def _send_deferred_replies(self) -> None:
+        """Met en file les réponses différées prêtes du moteur select."""
+        self._wakeup_socs[0].recv(4096)
+        while True:
+            try:
+                client_soc, reply = self._completed.get_nowait()
+            except queue.Empty:
+                return
+            compression = self._deferred_clients.pop(client_soc, None)
+            if client_soc not in self._outbound:
+                continue
+            self._last_activity[client_soc] = time.monotonic()
+            try:
+                frame = glosocket.encode_frame(reply.result(), compression)
+            except (glosocket.GLOSocketError, glocodec.GLOCodecError):
+                self._remove_client(client_soc)
+                continue
+            if self._queue_frame(client_soc, frame):
+                self._flush(client_soc)
+
+    def _queue_frame(self, client_soc: socket.socket, frame: bytes) -> bool:
+        """
+        Ajoute une trame à la file d'un client du moteur select.
+
+        Une trame est toujours acceptée dans une file vide, quelle que soit
+        sa taille. Sinon, si la file dépasserait `_max_buffer` octets, le
+        client, qui ne lit pas ce qui lui est transmis, est déconnecté et
+        False est retourné.
+        """
+        size = self._outbound_sizes[client_soc]
+        if size and size + len(frame) > self._max_buffer:
+            self._remove_client(client_soc)
+            return False
+        self._outbound[client_soc].append(frame)
+        self._outbound_sizes[client_soc] = size + len(frame)
+        return True
+
+    def _flush(self, client_soc: socket.socket) -> None:
+        """
+        Transmet les trames en attente d'un client du moteur select, autant
+        que son socket en accepte sans bloquer. Les morceaux du contenu en
+        flux qui suit la réponse sont lus du stockage au fur et à mesure
+        que la file se vide.
+        """
+        frames = self._outbound[client_soc]
+        while True:
+            while frames:
+                try:
+                    sent = client_soc.send(frames[0])
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    self._remove_client(client_soc)
+                    return
+                self._last_activity[client_soc] = time.monotonic()
+                self._outbound_sizes[client_soc] -= sent
+                if sent < len(frames[0]):
+                    frames[0] = memoryview(frames[0])[sent:]
+                else:
+                    frames.popleft()
+            if not self._next_chunk(client_soc):
+                return
+
+    def _next_chunk(self, client_soc: socket.socket) -> bool:
+        """
+        Met en file le morceau suivant du contenu en flux d'un client du
+        moteur select, ou, à la fin du contenu, les notifications retenues
+        pendant sa transmission. Retourne False s'il n'y a plus rien à
+        mettre en file.
+        """
+        if client_soc not in self._streams:
+            return False
+        stream, compression = self._streams[client_soc]
+        chunk = next(stream, None)
+        if chunk is None:
+            del self._streams[client_soc]
+            for frame in self._held_notifications.pop(client_soc, ()):
+                if not self._queue_frame(client_soc, frame):
+                    return False
+            return True
+        self._metrics.add_bytes(sent=len(chunk))
+        return self._queue_frame(client_soc,
+                                 glosocket.encode_frame(chunk, compression, chunk=True))
+
+    def _expire_idle_clients(self) -> float | None:
+        """
+        Déconnecte les clients du moteur select sans activité depuis
+        `_idle_timeout` secondes, sauf ceux qui attendent une réponse
+        différée, et ceux qui n'ont pas terminé à temps l'envoi de contenus
+        en flux. Retourne le délai avant la prochaine expiration possible,
+        None s'il n'y en a pas.
+        """
+        now = time.monotonic()
+        delays = []
+        for client_soc, (_, _, deadline) in list(self._uploads.items()):
+            if deadline <= now:
+                self._remove_client(client_soc)
+            else:
+                delays.append(deadline - now)
+        if self._idle_timeout <= 0:
+            return min(delays, default=None)
+        delay = min(delays, default=self._idle_timeout)
+        for client_soc, last_activity in list(self._last_activity.items()):
+            if client_soc in self._deferred_clients:
+                continue
+            remaining = last_activity + self._idle_timeout - now
+            if remaining <= 0:
+                self._remove_client(client_soc)
+            else:
+                delay = min(delay, remaining)
+        return delay
+
+    def _receive(self, client_soc: socket.socket) -> bool:
+        """
+        Fournit au décodeur du client du moteur select ce que son socket a
+        reçu, sans bloquer. Retourne False si le client a fermé la
+        connexion.
+
+        Lève une exception GLOSocketError en cas de problème de
+        communication.
+        """
+        try:
+            data = client_soc.recv(glosocket.RECV_CHUNK_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as ex:
+            raise glosocket.GLOSocketError("The source socket is closed.") from ex
+        if not data:
+            return False
+        self._last_activity[client_soc] = time.monotonic()
+        self._decoders[client_soc].feed(data)
+        return True
+
+    def _recv_chunk(self, client_soc: socket.socket) -> bytes:
+        """
+        Récupère un morceau d'un contenu envoyé en flux par un client du
+        moteur select, déjà reçu par son décodeur.
+
+        Lève une exception GLOSocketError si le morceau n'est pas reçu.
+        """
+        chunk = self._decoders[client_soc].next_chunk(client_soc in self._client_compressions)
+        if chunk is None:
+            raise glosocket.GLOSocketError("The stream was not received")
+        return chunk
+
+    def _streamed_parts(self, data: bytes) -> int:
+        """
+        Nombre de contenus envoyés en flux à la suite de la requête `data`,
+        0 si elle n'en annonce pas.
+
+        Lève une exception GLOCodecError si la requête est invalide.
+        """
+        if data[:1] == bytes((glocodec.BINARY_MAGIC,)):
+            if data[1:2] != bytes((gloutils.Headers.EMAIL_SENDING,)):
+                return 0
+        elif b'"streamed"' not in data:
+            return 0
+        message = glocodec.decode(data)
+        payload = message.get("payload")
+        if (message["header"] != gloutils.Headers.EMAIL_SENDING
+                or not isinstance(payload, dict) or not payload.get("streamed")):
+            return 0
+        return self._stream_parts(payload)
+
+    def _awaits_request(self, client_soc: socket.socket) -> bool:
+        """
+        Indique si un client du moteur select a reçu tout ce qui lui était
+        destiné et peut donc être servi.
+        """
+        return not (self._outbound[client_soc] or client_soc in self._streams
+                    or client_soc in self._deferred_clients)
+
+    def _serve_requests(self, client_soc: socket.socket) -> None:
+        """
+        Traite une à une les requêtes complètes reçues d'un client du moteur
+        select, tant qu'il n'attend rien du serveur; les suivantes restent
+        dans son décodeur. Le client est déconnecté en cas de problème.
+        """
+        decoder = self._decoders[client_soc]
+        try:
+            while client_soc in self._outbound and self._awaits_request(client_soc):
+                if client_soc in self._uploads:
+                    data, parts, _ = self._uploads[client_soc]
+                else:
+                    data = decoder.next_message(client_soc in self._client_compressions)
+                    if data is None:
+                        return
+                    parts = self._streamed_parts(data)
+                if parts and not decoder.has_streams(parts):
+                    # Served once its contents are received, without waiting
+                    if len(decoder) > self._max_upload:
+                        raise glosocket.GLOSocketError("The streamed content is too large")
+                    self._uploads.setdefault(
+                        client_soc, (data, parts, time.monotonic() + UPLOAD_TIMEOUT))
+                    return
+                self._uploads.pop(client_soc, None)
+                self._serve_request(client_soc, data)
+                if parts and client_soc in self._decoders:
+                    # Contents of a refused mail, left unread by its handling
+                    decoder.skip_chunks()
+        except (OSError, glosocket.GLOSocketError, glocodec.GLOCodecError):
+            self._remove_client(client_soc)
+
+    def _serve_request(self, client_soc: socket.socket, data: bytes) -> None:
+        """
+        Traite une requête d'un client du moteur select et met sa réponse
+        en file. Le contenu envoyé en flux qui suit la requête est lu
+        pendant son traitement.
+        """
+        # Read before handling, a negotiation reply is never compressed
+        compression = self._client_compressions.get(client_soc)
+        reply, keep_open, stream = self._handle_request(
+            client_soc, data, functools.partial(self._recv_chunk, client_soc))
+        if not keep_open:
+            self._remove_client(client_soc)
+        elif isinstance(reply, DeferredReply):
+            self._defer(client_soc, reply, compression)
+        else:
+            if stream is not None:
+                # Notifications must not slip between the reply and its chunks
+                self._streams[client_soc] = (stream, compression)
+                self._held_notifications[client_soc] = []
+            if reply is None or self._queue_frame(
+                    client_soc, glosocket.encode_frame(reply, compression)):
+                self._flush(client_soc)
+
+    def _read_requests(self, client_soc: socket.socket) -> None:
+        """
+        Reçoit ce que le socket d'un client du moteur select a de
+        disponible et traite les requêtes complètes. À la fermeture de la
+        connexion par le client, les requêtes déjà reçues sont traitées
+        avant qu'il soit retiré.
+        """
+        try:
+            still_open = self._receive(client_soc)
+        except glosocket.GLOSocketError:
+            self._remove_client(client_soc)
+            return
+        self._serve_requests(client_soc)
+        if not still_open and client_soc in self._outbound:
+            self._remove_client(client_soc)
 
     def run(self):
         """Point d'entrée du serveur."""
+        # Wakes select up when the hashing pool completes a deferred reply
+        self._wakeup_socs = socket.socketpair()
+        self._wakeup_socs[1].setblocking(False)
         while True:
-            # Select readable sockets
-            readable_sockets : list[socket.socket] = [sock for sock in self._client_socs if not sock._closed]
+            timeout = self._expire_idle_clients()
+            # Select the clients with nothing left to receive, which may send
+            # their next request, and those with frames waiting to be sent.
+            # Requests already received by a client served again are handled
+            # without waiting
+            readable_sockets: list[socket.socket] = []
+            writable_sockets: list[socket.socket] = []
+            backlog: list[socket.socket] = []
+            for sock in self._client_socs:
+                if self._outbound[sock] or sock in self._streams:
+                    writable_sockets.append(sock)
+                elif sock not in self._deferred_clients:
+                    readable_sockets.append(sock)
+                    if self._decoders[sock].has_frame() and sock not in self._uploads:
+                        backlog.append(sock)
+            if backlog:
+                timeout = 0
             readable_sockets.append(self._server_socket)
-            waiters = select.select(readable_sockets, [], [])[0]
-            for waiter in waiters:
+            readable_sockets.append(self._wakeup_socs[0])
+            if self._notify_inbox is not None:
+                readable_sockets.append(self._notify_inbox)
+            readers, writers, _ = select.select(readable_sockets, writable_sockets, [],
+                                                timeout)
+            for writer in writers:
+                # A client may have been dropped by a previous one
+                if writer in self._outbound:
+                    self._flush(writer)
+            for sock in backlog:
+                if sock in self._outbound:
+                    self._serve_requests(sock)
+            for waiter in readers:
                 # Handle sockets
                 if waiter == self._server_socket:
                     self._accept_client()
-                else:
-                    try:
-                        data = glosocket.recv_mesg(waiter)
-                        data = json.loads(data)
-                        header = data["header"]
-                        payload = data.get("payload")
-
-                        if header == gloutils.Headers.AUTH_REGISTER:
-                            reply = self._create_account(waiter, payload)
-
-                        elif header == gloutils.Headers.AUTH_LOGIN:
-                            reply = self._login(waiter, payload)
-                        
-                        elif header == gloutils.Headers.BYE:
-                            reply = self._remove_client(waiter)
-                            continue
-
-                        elif header == gloutils.Headers.INBOX_READING_REQUEST:
-                            reply = self._get_email_list(waiter)
-                        
-                        elif header == gloutils.Headers.INBOX_READING_CHOICE:
-                            reply = self._get_email(waiter, payload)
-                        
-                        elif header == gloutils.Headers.EMAIL_SENDING:
-                            reply = self._send_email(payload)
-                        
-                        elif header == gloutils.Headers.STATS_REQUEST:
-                            reply = self._get_stats(waiter)
-                        
-                        elif header == gloutils.Headers.AUTH_LOGOUT:
-                            reply = self._logout(waiter)
-                            continue
-                        
-                        glosocket.send_mesg(waiter, json.dumps(reply))
-
-                    except (ConnectionResetError, glosocket.GLOSocketError):
-                        self._remove_client(waiter)
+                elif waiter == self._wakeup_socs[0]:
+                    self._send_deferred_replies()
+                elif waiter == self._notify_inbox:
+                    self._receive_notifications()
+                elif waiter in self._outbound:
+                    self._read_requests(waiter)
+
+    async def _serve_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        """
+        Coroutine servant un client du moteur asyncio.
+
+        Les requêtes d'une connexion sont traitées dans l'ordre, dans
+        l'exécuteur `_executor` pour que les accès au disque ne bloquent
+        pas les autres clients. Le StreamWriter tient lieu de socket client
+        pour les traitements.
+
+        Les morceaux d'un contenu envoyé en flux sont lus par la boucle
+        d'événements à la demande du traitement; ceux d'un contenu à
+        transmettre sont lus du stockage dans l'exécuteur, un à la fois.
+
+        Une lecture ou une écriture qui n'aboutit pas en `_idle_timeout`
+        secondes met fin à la connexion, tout comme des contenus en flux qui
+        ne sont pas reçus en entier en UPLOAD_TIMEOUT secondes.
+        """
+        loop = asyncio.get_running_loop()
+        upload_deadline = 0.0
+
+        def recv_chunk() -> bytes:
+            # Bounds the time a trickled upload holds an executor thread
+            return asyncio.run_coroutine_threadsafe(asyncio.wait_for(
+                self._before_timeout(glosocket.async_recv_chunk(
+                    reader, writer in self._client_compressions)),
+                max(upload_deadline - loop.time(), 0)), loop).result()
+
+        self._client_socs.append(writer)
+        try:
+            while True:
+                data = await self._before_timeout(
+                    glosocket.async_recv_data(reader, writer in self._client_compressions))
+                upload_deadline = loop.time() + UPLOAD_TIMEOUT
+                compression = self._client_compressions.get(writer)
+                reply, keep_open, stream = await loop.run_in_executor(
+                    self._executor, self._handle_request, writer, data, recv_chunk)
+                if isinstance(reply, DeferredReply):
+                    # The hashing pool runs it, no executor thread waits for it
+                    await asyncio.wrap_future(reply.future)
+                    reply = reply.result()
+                if stream is not None:
+                    # Notifications must not slip between the reply and its chunks
+                    self._held_notifications[writer] = []
+                if reply is not None:
+                    await self._before_timeout(
+                        glosocket.async_send_data(writer, reply, compression))
+                while stream is not None:
+                    chunk = await loop.run_in_executor(self._executor, next, stream, None)
+                    if chunk is None:
+                        break
+                    await self._before_timeout(
+                        glosocket.async_send_chunk(writer, chunk, compression))
+                    self._metrics.add_bytes(sent=len(chunk))
+                for frame in self._held_notifications.pop(writer, ()):
+                    writer.write(frame)
+                if not keep_open:
+                    break
+        except (ConnectionError, TimeoutError, glosocket.GLOSocketError,
+                glocodec.GLOCodecError):
+            pass
+        except asyncio.CancelledError:
+            # The engine is shutting down, the connection simply ends
+            pass
+        finally:
+            self._held_notifications.pop(writer, None)
+            self._remove_client(writer)
+
+    async def _before_timeout(self, awaitable):
+        """
+        Attend `awaitable` au plus `_idle_timeout` secondes, sans limite si
+        le délai est nul. Lève une exception TimeoutError au-delà.
+        """
+        return await asyncio.wait_for(awaitable, self._idle_timeout or None)
+
+    async def _run_asyncio(self) -> None:
+        """Accepte les clients et lance une coroutine pour chacun."""
+        server = await asyncio.start_server(self._serve_client, sock=self._server_socket)
+        self._loop = asyncio.get_running_loop()
+        if self._notify_inbox is not None:
+            self._loop.add_reader(self._notify_inbox, self._receive_notifications)
+        # SIGTERM stops the engine cleanly instead of interrupting a callback
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                          asyncio.current_task().cancel)
+        async with server:
+            with contextlib.suppress(asyncio.CancelledError):
+                await server.serve_forever()
+
+    def run_asyncio(self, fs_workers: int = 4) -> None:
+        """
+        Point d'entrée du serveur avec le moteur asyncio.
+
+        Les traitements, qui accèdent au disque, s'exécutent dans un
+        exécuteur d'au plus `fs_workers` fils.
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=fs_workers)
+        try:
+            asyncio.run(self._run_asyncio())
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_worker(server: Server, engine: str, fs_workers: int) -> None:
+    """Exécute le moteur demandé dans un processus travailleur."""
+    # The master stops the workers with SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if engine == "asyncio":
+            server.run_asyncio(fs_workers)
+        else:
+            server.run()
+    except KeyboardInterrupt:
+        server.cleanup()
+
+
+def _run_prefork(server: Server, workers: int, engine: str, fs_workers: int) -> None:
+    """
+    Démarre `workers` processus travailleurs qui acceptent les clients sur
+    le socket d'écoute hérité du processus maître.
+
+    Le maître surveille les travailleurs et relance ceux qui s'arrêtent,
+    jusqu'à son interruption.
+
+    Chaque place de travailleur a une paire de sockets datagramme, créée
+    par le maître et conservée d'une relance à l'autre: un travailleur lit
+    les notifications de livraison des autres sur la sienne et leur
+    annonce ses propres livraisons sur les leurs.
+    """
+    # The workers race on accept, the losers must not block on it
+    server._server_socket.setblocking(False)
+    # Stopping the master with SIGTERM also stops the workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    children: dict[int, tuple[int, float]] = {}
+    buses = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+    for bus in buses:
+        # A worker never waits on a full or empty bus
+        bus[0].setblocking(False)
+        bus[1].setblocking(False)
+
+    def spawn(slot: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                server._notify_inbox = buses[slot][0]
+                server._notify_peers = [bus[1] for i, bus in enumerate(buses) if i != slot]
+                _run_worker(server, engine, fs_workers)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = (slot, time.monotonic())
+
+    try:
+        for slot in range(workers):
+            spawn(slot)
+        while True:
+            pid, status = os.wait()
+            child = children.pop(pid, None)
+            if child is None:
+                continue
+            slot, started = child
+            print(f"Travailleur {pid} arrêté (statut {status}), relance",
+                  file=sys.stderr)
+            # Avoid a restart loop when a worker dies at startup
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            spawn(slot)
+    except KeyboardInterrupt:
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            with contextlib.suppress(ChildProcessError):
+                os.waitpid(pid, 0)
+        raise
 
 
 def _main() -> int:
-    server = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verify-stats", action="store_true",
+                        dest="verify_stats",
+                        help="Recalcule les statistiques des dossiers et "
+                             "affiche les écarts, sans démarrer le serveur.")
+    parser.add_argument("--compact", action="store_true",
+                        help="Réécrit les courriels de chaque dossier dans "
+                             "des segments compressés (stockage segment), "
+                             "sans démarrer le serveur.")
+    parser.add_argument("--storage", choices=["directory", "segment", "sqlite"],
+                        default="directory",
+                        help="Moteur de stockage des comptes et des courriels.")
+    parser.add_argument("--cache-size", type=int, default=64, dest="cache_size",
+                        help="Taille du cache des courriels et des entêtes, "
+                             "en Mo (0: pas de cache).")
+    parser.add_argument("--registry-size", type=int, default=4, dest="registry_size",
+                        help="Taille du registre des comptes, en Mo.")
+    parser.add_argument("--engine", choices=["select", "asyncio"], default="select",
+                        help="Moteur de gestion des connexions.")
+    parser.add_argument("--fs-workers", type=int, default=4, dest="fs_workers",
+                        help="Nombre de fils pour les accès au disque "
+                             "du moteur asyncio.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Nombre de processus travailleurs partageant le "
+                             "socket d'écoute (0: un seul processus).")
+    parser.add_argument("--kdf", choices=glopassword.SUPPORTED_KDFS,
+                        default=glopassword.SUPPORTED_KDFS[0],
+                        help="Fonction de dérivation des nouvelles empreintes de "
+                             "mots de passe; les autres sont remplacées à la "
+                             "connexion.")
+    parser.add_argument("--kdf-cost", type=int, default=None, dest="kdf_cost",
+                        help="Coût de la dérivation: log2 de n pour scrypt, "
+                             "milliers d'itérations pour pbkdf2_sha256.")
+    parser.add_argument("--kdf-workers", type=int, default=2, dest="kdf_workers",
+                        help="Nombre de fils hachant les mots de passe, par processus.")
+    parser.add_argument("--kdf-queue", type=int, default=0, dest="kdf_queue",
+                        help="Nombre maximal de hachages en attente ou en cours par "
+                             "processus, au-delà duquel les connexions sont "
+                             "refusées (0: pas de limite).")
+    parser.add_argument("--client-buffer", type=int, default=16, dest="client_buffer",
+                        help="Taille maximale des réponses et notifications en "
+                             "attente d'un client, en Mo, au-delà de laquelle il "
+                             "est déconnecté.")
+    parser.add_argument("--idle-timeout", type=float, default=600, dest="idle_timeout",
+                        help="Délai en secondes après lequel un client qui ne lit "
+                             "ni n'envoie rien est déconnecté (0: jamais).")
+    parser.add_argument("--upload-buffer", type=int, default=64, dest="upload_buffer",
+                        help="Taille maximale, en Mo, des contenus envoyés en flux "
+                             "à la suite d'une requête que le moteur select "
+                             "conserve avant de la traiter.")
+    parser.add_argument("--admin", action="append", default=[], dest="admins",
+                        metavar="UTILISATEUR",
+                        help="Compte autorisé à consulter les mesures du serveur "
+                             "(entête METRICS); peut être répété.")
+    parser.add_argument("--profile-rate", type=int, default=10, dest="profile_rate",
+                        help="Une requête sur N est profilée avec cProfile quand "
+                             "l'échantillonnage est actif (METRICS ou SIGUSR2).")
+    args = parser.parse_args(sys.argv[1:])
+    if args.workers > 0 and not hasattr(os, "fork"):
+        parser.error("--workers n'est pas supporté sur cette plateforme")
+    if args.kdf_workers < 1:
+        parser.error("--kdf-workers doit être au moins 1")
+    if args.kdf_cost is None:
+        hasher = glopassword.PasswordHasher(args.kdf)
+    else:
+        try:
+            hasher = glopassword.PasswordHasher.with_cost(args.kdf, args.kdf_cost)
+            hasher.hash("")
+        except (ValueError, OverflowError, MemoryError):
+            parser.error(f"--kdf-cost {args.kdf_cost} n'est pas valide pour {args.kdf}")
+    storage = glostorage.open_storage(args.storage)
+    if args.verify_stats:
+        drifts = storage.verify_stats()
+        for user, stored, actual in drifts:
+            print(f"{user}: {stored} -> {actual}")
+        print(f"{len(drifts)} dossier(s) corrigé(s)")
+        storage.close()
+        return 0
+    if args.compact:
+        if not isinstance(storage, glostorage.SegmentStorage):
+            parser.error("--compact nécessite --storage segment")
+        for user in storage.users():
+            count, before, after = storage.compact(user)
+            print(f"{user}: {count} courriel(s), {before} -> {after} octets")
+        storage.close()
+        return 0
+
+    # Timed under the cache, so that only actual storage accesses are measured.
+    # Always cached for the account registry; a zero-sized cache keeps no mail
+    metrics = glometrics.Metrics()
+    storage = glocache.CachedStorage(glometrics.TimedStorage(storage, metrics),
+                                     max(args.cache_size, 0) * 1024 * 1024,
+                                     max(args.registry_size, 0) * 1024 * 1024)
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> prints the cache counters of that process
+        signal.signal(signal.SIGUSR1, lambda *_: print(
+            f"Cache du processus {os.getpid()}: {storage.cache.stats()},"
+            f" registre: {storage.registry.stats()}",
+            file=sys.stderr))
+
+    server = Server(storage, hasher, args.kdf_workers, args.kdf_queue,
+                    metrics, args.admins, args.profile_rate,
+                    max(args.client_buffer, 1) * 1024 * 1024, max(args.idle_timeout, 0),
+                    max(args.upload_buffer, 1) * 1024 * 1024)
+    if hasattr(signal, "SIGUSR2"):
+        # kill -USR2 <pid> toggles the sampling of that process; from a thread,
+        # since stopping waits for the request being profiled
+        signal.signal(signal.SIGUSR2, lambda *_: threading.Thread(
+            target=server.toggle_profile).start())
     try:
-        server.run()
+        if args.workers > 0:
+            _run_prefork(server, args.workers, args.engine, args.fs_workers)
+        elif args.engine == "asyncio":
+            server.run_asyncio(args.fs_workers)
+        else:
+            server.run()
     except KeyboardInterrupt:
         server.cleanup()
         sys.exit(1)
@@ -0,0 +1,83 @@
+"""\
+Banc d'essai des encodages de messages de glocodec.
+
+Mesure, pour des messages typiques (authentification, liste de courriels,
+courriel court et long), la taille encodée et le temps CPU d'un encodage
+suivi d'un décodage, en JSON et en binaire.
+
+Utilisation: python bench_codec.py [--repeat N]
+"""
+
+import argparse
+import sys
+import timeit
+
+import glocodec
+import gloutils
+
+
+def _messages() -> dict[str, gloutils.GloMessage]:
+    """Construit les messages mesurés."""
+    date = gloutils.get_current_utc_time()
+    listing = [gloutils.SUBJECT_DISPLAY.format(number=i + 1,
+                                               sender="ALICE@glo2000.ca",
+                                               subject=f"Rapport hebdomadaire {i}",
+                                               date=date)
+               for i in range(1000)]
+    body = "Bonjour,\nVoici les résultats de la semaine.\n" * 50
+    return {
+        "auth": gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username="alice", password="Password123")),
+        "stats": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.StatsPayload(count=1234, size=5678901)),
+        "liste (20)": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailListPayload(email_list=listing[:20],
+                                              email_ids=[f"mail{i}" for i in range(20)],
+                                              offset=0, total=1000)),
+        "liste (1000)": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailListPayload(email_list=listing,
+                                              email_ids=[f"mail{i}" for i in range(1000)],
+                                              offset=0, total=1000)),
+        "courriel 2 Ko": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailContentPayload(sender="ALICE@glo2000.ca",
+                                                 destination="BOB@glo2000.ca",
+                                                 subject="Résultats", date=date,
+                                                 content=body)),
+        "courriel 1 Mo": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailContentPayload(sender="ALICE@glo2000.ca",
+                                                 destination="BOB@glo2000.ca",
+                                                 subject="Résultats", date=date,
+                                                 content=body * 500)),
+    }
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000,
+                        help="Nombre d'encodages/décodages des petits messages.")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'message':>14} {'encodage':>9} {'octets':>9} {'µs/message':>11}")
+    for name, message in _messages().items():
+        size = len(glocodec.encode(message))
+        repeat = max(1, args.repeat * 2000 // max(size, 2000))
+        for encoding in (glocodec.ENCODING_JSON, glocodec.ENCODING_BINARY):
+            data = glocodec.encode(message, encoding)
+            assert glocodec.decode(data) == message
+            # Best of five runs, to smooth out the noise of a shared machine
+            duration = min(timeit.repeat(
+                lambda: glocodec.decode(glocodec.encode(message, encoding)),
+                number=repeat, repeat=5))
+            print(f"{name:>14} {encoding:>9} {len(data):>9}"
+                  f" {duration / repeat * 1e6:>11.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
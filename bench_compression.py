@@ -0,0 +1,97 @@
+"""\
+Banc d'essai de la compression des trames de glosocket.
+
+Mesure, pour des messages typiques (liste de courriels, courriel court et
+long), les octets transmis et le temps CPU d'un envoi suivi d'une
+réception avec `glosocket.send_mesg`/`recv_mesg`, sans compression puis
+avec chaque algorithme disponible.
+
+Utilisation: python bench_compression.py [--repeat N]
+"""
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+import glosocket
+import gloutils
+
+
+def _messages() -> dict[str, str]:
+    """Construit les messages mesurés, tels que les transmet le serveur."""
+    date = gloutils.get_current_utc_time()
+    listing = [gloutils.SUBJECT_DISPLAY.format(number=i + 1,
+                                               sender="ALICE@glo2000.ca",
+                                               subject=f"Rapport hebdomadaire {i}",
+                                               date=date)
+               for i in range(1000)]
+    ids = [f"mail-{1792000000000000000 + i * 7919:020d}-0012345-{i:06d}" for i in range(1000)]
+    body = "Bonjour,\nVoici les résultats de la semaine.\n" * 50
+
+    def listing_message(count: int) -> str:
+        return json.dumps(gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailListPayload(email_list=listing[:count],
+                                              email_ids=ids[:count],
+                                              offset=0, total=1000)))
+
+    def mail_message(content: str) -> str:
+        return json.dumps(gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailContentPayload(sender="ALICE@glo2000.ca",
+                                                 destination="BOB@glo2000.ca",
+                                                 subject="Résultats", date=date,
+                                                 content=content)))
+
+    return {
+        "liste (20)": listing_message(20),
+        "liste (1000)": listing_message(1000),
+        "courriel 2 Ko": mail_message(body),
+        "courriel 1 Mo": mail_message(body * 500),
+    }
+
+
+def _measure(message: str, compression: str | None, repeat: int) -> float:
+    """
+    Transmet `repeat` fois le message sur une paire de sockets et retourne
+    le temps CPU moyen d'un envoi et de sa réception, en microsecondes.
+    """
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(
+        target=lambda: [glosocket.send_mesg(sender, message, compression)
+                        for _ in range(repeat)])
+    try:
+        start = time.process_time()
+        thread.start()
+        for _ in range(repeat):
+            assert glosocket.recv_mesg(receiver) == message
+        thread.join()
+        return (time.process_time() - start) / repeat * 1e6
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=500,
+                        help="Nombre de transmissions des petits messages.")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'message':>14} {'compression':>11} {'octets':>9} {'ratio':>6} {'µs CPU':>9}")
+    for name, message in _messages().items():
+        data = message.encode('utf-8')
+        repeat = max(1, args.repeat * 2000 // max(len(data), 2000))
+        for compression in [None] + glosocket.SUPPORTED_COMPRESSIONS:
+            wire = len(glosocket.encode_frame(data, compression))
+            duration = _measure(message, compression, repeat)
+            print(f"{name:>14} {compression or 'aucune':>11} {wire:>9}"
+                  f" {wire / (len(data) + 4):>6.2f} {duration:>9.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
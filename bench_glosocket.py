@@ -0,0 +1,105 @@
+"""\
+Banc d'essai de la réception de messages de glosocket.
+
+Compare l'implémentation courante de `glosocket.recv_mesg` à l'ancienne
+réception par blocs de 4096 octets concaténés, en débit et en mémoire
+allouée, pour des messages de 1 Ko à 50 Mo.
+
+Utilisation: python bench_glosocket.py [--repeat N]
+"""
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+import glosocket
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024]
+
+
+def _legacy_recvall(source: socket.socket, size: int) -> bytes:
+    """Ancienne implémentation de glosocket._recvall."""
+    msg = b""
+    while size > 0:
+        chunk_size = min(size, 4096)
+        buffer = source.recv(chunk_size)
+        if not buffer:
+            raise glosocket.GLOSocketError("The other socket is closed.")
+        msg += buffer
+        size -= len(buffer)
+    return msg
+
+
+def _legacy_recv_mesg(source_soc: socket.socket) -> str:
+    """Ancienne implémentation de glosocket.recv_mesg."""
+    length, = struct.unpack("!I", _legacy_recvall(source_soc, 4))
+    return _legacy_recvall(source_soc, length).decode('utf-8')
+
+
+def _measure(recv: Callable[[socket.socket], str], message: str,
+             repeat: int, trace: bool) -> tuple[float, int]:
+    """
+    Transmet `repeat` fois le message sur une paire de sockets et retourne
+    la durée moyenne d'une réception et le pic de mémoire allouée.
+    """
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(
+        target=lambda: [glosocket.send_mesg(sender, message) for _ in range(repeat)])
+    try:
+        thread.start()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            recv(receiver)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        thread.join()
+        sender.close()
+        receiver.close()
+    return elapsed / repeat, peak
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Nombre de messages transmis par mesure.")
+    parser.add_argument("--max-legacy-size", type=int, default=1024 * 1024,
+                        dest="max_legacy_size",
+                        help="Taille au-delà de laquelle l'ancienne implémentation,"
+                             " quadratique, n'est pas mesurée.")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'taille':>10} {'impl.':>8} {'débit (Mo/s)':>14} {'pic alloué (Mo)':>17}")
+    for size in SIZES:
+        message = "x" * size
+        # More repetitions for small messages, fewer for large ones
+        if size <= 64 * 1024:
+            repeat = args.repeat * 200
+        elif size <= 1024 * 1024:
+            repeat = args.repeat
+        else:
+            repeat = max(1, args.repeat // 5)
+        for name, recv in (("ancien", _legacy_recv_mesg),
+                           ("courant", glosocket.recv_mesg)):
+            if recv is _legacy_recv_mesg and size > args.max_legacy_size:
+                print(f"{size:>10} {name:>8} {'ignoré':>14} {'':>17}")
+                continue
+            duration, _ = _measure(recv, message, repeat, trace=False)
+            _, peak = _measure(recv, message, 1, trace=True)
+            print(f"{size:>10} {name:>8} {size / duration / 1e6:>14.1f}"
+                  f" {peak / 1e6:>17.2f}", flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
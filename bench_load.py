@@ -0,0 +1,322 @@
+"""\
+Générateur de charge et banc d'essai des latences du serveur.
+
+Prépare un dossier de données où `--users` comptes ont chacun une boîte
+de `--mails` courriels, démarre le serveur (TP4_server.py) sur ces
+données, puis simule `--clients` clients concurrents pendant
+`--duration` secondes. Chaque client crée un compte, puis enchaîne des
+sessions: connexion, requêtes tirées au hasard (page de la liste,
+lecture, envoi, statistiques, recherche) et déconnexion. Les requêtes
+passent par glosocket et glocodec, comme celles de TP4_client.
+
+Affiche, pour chaque entête, le nombre de requêtes, d'erreurs, le débit
+et les latences p50, p95, p99 et maximale, en millisecondes.
+
+Avec --populate DOSSIER, prépare seulement les données dans ce dossier.
+Avec --external, les clients visent un serveur déjà démarré sur des
+données préparées ainsi, avec le même --kdf-cost.
+
+Utilisation: python bench_load.py [--clients N] [--duration S] [--users N]
+             [--mails N] [--storage MOTEUR] [--kdf-cost N]
+             [--server-args "OPTIONS"] [--populate DOSSIER | --external]
+"""
+
+import argparse
+import math
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import glocodec
+import glopassword
+import glosocket
+import glostorage
+import gloutils
+
+LOAD_PASSWORD = "Password123"  # nosec:B105
+"""Mot de passe des comptes préparés et créés par l'essai."""
+
+_WORDS = [f"mot{i}" for i in range(2000)]
+
+# Relative weight of each operation within a session
+_OPERATIONS = {
+    gloutils.Headers.INBOX_READING_REQUEST: 35,
+    gloutils.Headers.INBOX_READING_CHOICE: 30,
+    gloutils.Headers.STATS_REQUEST: 15,
+    gloutils.Headers.EMAIL_SENDING: 15,
+    gloutils.Headers.SEARCH: 5,
+}
+
+
+def _username(number: int) -> str:
+    """Nom du compte préparé numéro `number`."""
+    return f"LOAD{number}"
+
+
+def _payload(sender: str, destination: str) -> gloutils.EmailContentPayload:
+    """Courriel aléatoire, de quelques centaines d'octets à quelques Ko."""
+    return gloutils.EmailContentPayload(sender=f"{sender}@{gloutils.SERVER_DOMAIN}",
+                                        destination=f"{destination}@{gloutils.SERVER_DOMAIN}",
+                                        subject=" ".join(random.choices(_WORDS, k=4)),
+                                        date=gloutils.get_current_utc_time(),
+                                        content=" ".join(random.choices(
+                                            _WORDS, k=random.randint(50, 800))))
+
+
+def populate(root: str, engine: str, users: int, mails: int,
+             hasher: glopassword.PasswordHasher) -> None:
+    """
+    Prépare dans le dossier `root` les données du moteur de stockage
+    `engine`: `users` comptes de mot de passe LOAD_PASSWORD, dont la boîte
+    contient `mails` courriels.
+    """
+    if engine == "sqlite":
+        storage = glostorage.SQLiteStorage(os.path.join(root, gloutils.SERVER_DATABASE))
+    elif engine == "segment":
+        storage = glostorage.SegmentStorage(os.path.join(root, gloutils.SERVER_DATA_DIR))
+    else:
+        storage = glostorage.DirectoryStorage(os.path.join(root, gloutils.SERVER_DATA_DIR))
+    # The same record for every account keeps the preparation fast
+    credentials = hasher.hash(LOAD_PASSWORD)
+    try:
+        for number in range(users):
+            username = _username(number)
+            storage.create_user(username, credentials)
+            for _ in range(mails):
+                storage.deliver(username, _payload(_username(random.randrange(users)),
+                                                   username))
+    finally:
+        storage.close()
+
+
+class _Session:
+    """Connexion d'un client simulé, qui mesure la latence de ses requêtes."""
+
+    def __init__(self, latencies: dict[str, list[float]], errors: dict[str, int]) -> None:
+        self._latencies = latencies
+        self._errors = errors
+        self._socket = socket.create_connection(("127.0.0.1", gloutils.APP_PORT))
+        self._encoding = glocodec.ENCODING_JSON
+        self._compression: str | None = None
+        reply = self.request(gloutils.Headers.NEGOTIATION, gloutils.NegotiationPayload(
+            encodings=glocodec.SUPPORTED_ENCODINGS,
+            compressions=glosocket.SUPPORTED_COMPRESSIONS))
+        if reply["header"] == gloutils.Headers.OK:
+            self._encoding = reply["payload"]["encodings"][0]
+            self._compression = (reply["payload"]["compressions"] or [None])[0]
+
+    def request(self, header: gloutils.Headers, payload: dict | None = None,
+                reply_expected: bool = True) -> gloutils.GloMessage | None:
+        """
+        Transmet une requête et retourne sa réponse, en mesurant
+        l'aller-retour. Une requête sans réponse n'est pas mesurée.
+        """
+        message = gloutils.GloMessage(header=header)
+        if payload is not None:
+            message["payload"] = payload
+        start = time.perf_counter()
+        glocodec.send_message(self._socket, message, self._encoding, self._compression)
+        if not reply_expected:
+            return None
+        reply = glocodec.recv_message(self._socket)
+        self._latencies.setdefault(header.name, []).append(time.perf_counter() - start)
+        if reply["header"] == gloutils.Headers.ERROR:
+            self._errors[header.name] = self._errors.get(header.name, 0) + 1
+        return reply
+
+    def close(self) -> None:
+        """Termine la connexion avec l'entête `BYE`."""
+        try:
+            self.request(gloutils.Headers.BYE, reply_expected=False)
+        finally:
+            self._socket.close()
+
+
+def _run_client(number: int, users: int, session_length: int, deadline: float,
+                latencies: dict[str, list[float]], errors: dict[str, int]) -> None:
+    """
+    Client simulé: crée son compte, puis enchaîne les sessions sur les
+    comptes préparés jusqu'à l'échéance `deadline`. Une connexion perdue
+    arrête le client et compte comme une erreur `CONNECTION`.
+    """
+    try:
+        _run_sessions(number, users, session_length, deadline, latencies, errors)
+    except (OSError, glosocket.GLOSocketError, glocodec.GLOCodecError):
+        errors["CONNECTION"] = errors.get("CONNECTION", 0) + 1
+
+
+def _run_sessions(number: int, users: int, session_length: int, deadline: float,
+                  latencies: dict[str, list[float]], errors: dict[str, int]) -> None:
+    """Sessions d'un client simulé, voir _run_client."""
+    session = _Session(latencies, errors)
+    session.request(gloutils.Headers.AUTH_REGISTER, gloutils.AuthPayload(
+        username=f"LOADC{number}X{random.randrange(10 ** 9)}", password=LOAD_PASSWORD))
+    session.close()
+
+    headers = list(_OPERATIONS)
+    weights = list(_OPERATIONS.values())
+    while time.monotonic() < deadline:
+        username = _username(random.randrange(users))
+        session = _Session(latencies, errors)
+        try:
+            session.request(gloutils.Headers.AUTH_LOGIN, gloutils.AuthPayload(
+                username=username, password=LOAD_PASSWORD))
+            email_ids: list[str] = []
+            for header in random.choices(headers, weights, k=session_length):
+                if header == gloutils.Headers.INBOX_READING_CHOICE and email_ids:
+                    session.request(header, gloutils.EmailChoicePayload(
+                        email_id=random.choice(email_ids)))
+                elif header in (gloutils.Headers.INBOX_READING_REQUEST,
+                                gloutils.Headers.INBOX_READING_CHOICE):
+                    reply = session.request(gloutils.Headers.INBOX_READING_REQUEST,
+                                            gloutils.EmailListRequestPayload(
+                                                offset=0, limit=gloutils.INBOX_PAGE_SIZE))
+                    email_ids = reply.get("payload", {}).get("email_ids", [])
+                elif header == gloutils.Headers.EMAIL_SENDING:
+                    session.request(header, _payload(username,
+                                                     _username(random.randrange(users))))
+                elif header == gloutils.Headers.SEARCH:
+                    session.request(header, gloutils.SearchPayload(
+                        query=random.choice(_WORDS), limit=gloutils.INBOX_PAGE_SIZE))
+                else:
+                    session.request(header)
+            session.request(gloutils.Headers.AUTH_LOGOUT, reply_expected=False)
+        finally:
+            session.close()
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """Centile `percent` des valeurs triées, par la méthode du rang le plus proche."""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _report(latencies: dict[str, list[float]], errors: dict[str, int],
+            elapsed: float) -> None:
+    """Affiche le débit et les latences de chaque entête, puis le total."""
+    print(f"{'entête':>22} {'requêtes':>9} {'erreurs':>8} {'req/s':>8}"
+          f" {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    everything = []
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        everything.extend(values)
+        print(f"{name:>22} {len(values):>9} {errors.get(name, 0):>8}"
+              f" {len(values) / elapsed:>8.1f}"
+              + "".join(f" {_percentile(values, percent) * 1000:>8.2f}"
+                        for percent in (50, 95, 99))
+              + f" {values[-1] * 1000:>8.2f}")
+    everything.sort()
+    if errors.get("CONNECTION"):
+        print(f"{'CONNECTION':>22} {'':>9} {errors['CONNECTION']:>8}")
+    if everything:
+        print(f"{'total':>22} {len(everything):>9} {sum(errors.values()):>8}"
+              f" {len(everything) / elapsed:>8.1f}"
+              + "".join(f" {_percentile(everything, percent) * 1000:>8.2f}"
+                        for percent in (50, 95, 99))
+              + f" {everything[-1] * 1000:>8.2f}")
+
+
+def _start_server(root: str, engine: str, kdf_cost: int,
+                  server_args: list[str]) -> subprocess.Popen:
+    """
+    Démarre le serveur dans le dossier `root` et attend qu'il accepte les
+    connexions. Lève RuntimeError s'il s'arrête avant.
+    """
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            "TP4_server.py"),
+                               "--storage", engine, "--kdf-cost", str(kdf_cost),
+                               *server_args], cwd=root)
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError(f"Le serveur s'est arrêté (statut {server.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", gloutils.APP_PORT), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=20,
+                        help="Nombre de clients simulés concurrents.")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Durée de l'essai, en secondes.")
+    parser.add_argument("--session-length", type=int, default=20, dest="session_length",
+                        help="Nombre de requêtes entre la connexion et la "
+                             "déconnexion d'une session.")
+    parser.add_argument("--users", type=int, default=50,
+                        help="Nombre de comptes préparés.")
+    parser.add_argument("--mails", type=int, default=200,
+                        help="Nombre de courriels de chaque boîte préparée.")
+    parser.add_argument("--storage", choices=["directory", "segment", "sqlite"],
+                        default="directory",
+                        help="Moteur de stockage des données préparées et du serveur.")
+    parser.add_argument("--kdf-cost", type=int, default=10, dest="kdf_cost",
+                        help="Coût scrypt (log2 de n) des mots de passe, "
+                             "aussi transmis au serveur.")
+    parser.add_argument("--server-args", default="", dest="server_args",
+                        help="Options supplémentaires du serveur, par exemple "
+                             "\"--engine asyncio --workers 4\".")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--populate", metavar="DOSSIER",
+                      help="Prépare seulement les données dans ce dossier.")
+    mode.add_argument("--external", action="store_true",
+                      help="Vise un serveur déjà démarré sur des données préparées.")
+    args = parser.parse_args(sys.argv[1:])
+    if args.users < 1 or args.clients < 1:
+        parser.error("--users et --clients doivent être au moins 1")
+    hasher = glopassword.PasswordHasher.with_cost(glopassword.KDF_SCRYPT, args.kdf_cost)
+
+    with tempfile.TemporaryDirectory() as root:
+        if not args.external:
+            start = time.perf_counter()
+            populate(args.populate or root, args.storage, args.users, args.mails, hasher)
+            print(f"préparation: {args.users} comptes de {args.mails} courriels"
+                  f" en {time.perf_counter() - start:.1f} s")
+            if args.populate:
+                return 0
+
+        server = None
+        if not args.external:
+            server = _start_server(root, args.storage, args.kdf_cost,
+                                   shlex.split(args.server_args))
+        try:
+            # One set of counters per client, merged once the run is over
+            counters = [({}, {}) for _ in range(args.clients)]
+            deadline = time.monotonic() + args.duration
+            threads = [threading.Thread(target=_run_client,
+                                        args=(number, args.users, args.session_length,
+                                              deadline, *counters[number]))
+                       for number in range(args.clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    latencies: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    for client_latencies, client_errors in counters:
+        for name, values in client_latencies.items():
+            latencies.setdefault(name, []).extend(values)
+        for name, count in client_errors.items():
+            errors[name] = errors.get(name, 0) + count
+    print(f"{args.clients} clients pendant {elapsed:.1f} s, latences en ms")
+    _report(latencies, errors, elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,97 @@
+"""\
+Banc d'essai de la recherche dans les courriels.
+
+Remplit une boîte de plus en plus grande dans chaque moteur de stockage,
+dans un dossier temporaire, et mesure à chaque taille la durée moyenne
+d'une recherche avec l'index inversé: un mot rare, un mot présent dans
+tous les courriels et un mot rare filtré par expéditeur. La durée d'un
+balayage de tous les courriels, sans index, sert de référence. Le
+moteur `cache` est un dossier derrière le cache du serveur (glocache).
+
+Utilisation: python bench_search.py [--sizes N,N,...] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import glocache
+import glostorage
+import gloutils
+
+_WORDS = [f"mot{i}" for i in range(2000)]
+
+
+def _payload(i: int) -> gloutils.EmailContentPayload:
+    """Courriel de test numéro `i`, qui contient le mot rare `projet{i % 100}`."""
+    words = random.choices(_WORDS, k=60)
+    return gloutils.EmailContentPayload(sender=f"USER{i % 10}@glo2000.ca",
+                                        destination="ALICE@glo2000.ca",
+                                        subject=f"Rapport du projet{i % 100}",
+                                        date=gloutils.get_current_utc_time(),
+                                        content=" ".join(words))
+
+
+def _time(operation: Callable[[], object], repeat: int) -> float:
+    """Durée moyenne d'une opération, en millisecondes."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        operation()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _scan(storage: glostorage.MailboxStorage, term: str) -> list[str]:
+    """Recherche sans index, en lisant chaque courriel."""
+    return [mail_id for mail_id, mail in storage.iter_mails("ALICE")
+            if term in glostorage.mail_terms(mail)]
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,3000",
+                        help="Tailles de boîte mesurées, séparées par des virgules.")
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="Nombre de répétitions de chaque recherche.")
+    args = parser.parse_args(sys.argv[1:])
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    print("durées moyennes en ms")
+    print(f"{'courriels':>9} {'moteur':>10} {'rare':>8} {'fréquent':>8}"
+          f" {'expéditeur':>10} {'balayage':>9}")
+    with tempfile.TemporaryDirectory() as root:
+        engines = {
+            "directory": glostorage.DirectoryStorage(os.path.join(root, "data")),
+            "cache": glocache.CachedStorage(
+                glostorage.DirectoryStorage(os.path.join(root, "cached")), 64 * 1024 * 1024),
+            "sqlite": glostorage.SQLiteStorage(os.path.join(root, "data.sqlite3")),
+        }
+        for storage in engines.values():
+            storage.create_user("ALICE", {"password_hash": ""})
+        delivered = 0
+        for size in sizes:
+            for i in range(delivered, size):
+                for storage in engines.values():
+                    storage.deliver("ALICE", _payload(i))
+            delivered = size
+
+            for name, storage in engines.items():
+                # The first search reads the postings of the new deliveries
+                storage.search("ALICE", "projet7")
+                rare = _time(lambda: storage.search("ALICE", "projet7"), args.repeat)
+                common = _time(lambda: storage.search("ALICE", "rapport"), args.repeat)
+                sender = _time(lambda: storage.search("ALICE", "projet7", sender="user3"),
+                               args.repeat)
+                scan = _time(lambda: _scan(storage, "projet7"), max(1, args.repeat // 10))
+                print(f"{size:>9} {name:>10} {rare:>8.3f} {common:>8.3f}"
+                      f" {sender:>10.3f} {scan:>9.3f}")
+        for storage in engines.values():
+            storage.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
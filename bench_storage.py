@@ -0,0 +1,102 @@
+"""\
+Banc d'essai des moteurs de stockage de glostorage.
+
+Remplit une boîte de courriels dans chaque moteur, dans un dossier
+temporaire, puis mesure la durée moyenne des opérations du serveur:
+livraison, page de la liste, liste complète, lecture d'un courriel,
+statistiques et lecture des données d'authentification, ainsi que
+l'espace disque occupé.
+
+Utilisation: python bench_storage.py [--mails N] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import glostorage
+import gloutils
+
+
+def _payload(i: int) -> gloutils.EmailContentPayload:
+    """Courriel de test numéro `i`."""
+    return gloutils.EmailContentPayload(sender="BOB@glo2000.ca",
+                                        destination="ALICE@glo2000.ca",
+                                        subject=f"Rapport {i}",
+                                        date=gloutils.get_current_utc_time(),
+                                        content="Bonjour,\nVoici le rapport.\n" * 20)
+
+
+def _time(operation: Callable[[], object], repeat: int) -> float:
+    """Durée moyenne d'une opération, en millisecondes."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        operation()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _disk_usage(path: str) -> int:
+    """Octets occupés sur le disque par un fichier ou un dossier."""
+    if os.path.isfile(path):
+        return os.stat(path).st_blocks * 512
+    return sum(os.stat(os.path.join(folder, file)).st_blocks * 512
+               for folder, _, files in os.walk(path) for file in files)
+
+
+def _bench(storage: glostorage.MailboxStorage, mails: int, repeat: int) -> dict[str, float]:
+    """Remplit la boîte ALICE du stockage et mesure chaque opération."""
+    storage.create_user("ALICE", {"password_hash": ""})
+    start = time.perf_counter()
+    for i in range(mails):
+        storage.deliver("ALICE", _payload(i))
+    results = {"livraison": (time.perf_counter() - start) / mails * 1000}
+
+    ids = [entry["id"] for entry in storage.list_headers("ALICE")[0]]
+    results["page (20)"] = _time(
+        lambda: storage.list_headers("ALICE", random.randrange(len(ids)), 20), repeat)
+    results["liste complète"] = _time(lambda: storage.list_headers("ALICE"), repeat)
+    results["lecture"] = _time(lambda: storage.get_mail("ALICE", random.choice(ids)), repeat)
+    results["statistiques"] = _time(lambda: storage.get_stats("ALICE"), repeat)
+    results["authentification"] = _time(lambda: storage.get_credentials("ALICE"), repeat)
+    return results
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mails", type=int, default=2000,
+                        help="Nombre de courriels livrés dans la boîte.")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="Nombre de répétitions de chaque lecture.")
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as root:
+        paths = {
+            "directory": os.path.join(root, "directory"),
+            "segment": os.path.join(root, "segment"),
+            "sqlite": os.path.join(root, "data.sqlite3"),
+        }
+        engines = {
+            "directory": glostorage.DirectoryStorage(paths["directory"]),
+            "segment": glostorage.SegmentStorage(paths["segment"]),
+            "sqlite": glostorage.SQLiteStorage(paths["sqlite"]),
+        }
+        results = {name: _bench(storage, args.mails, args.repeat)
+                   for name, storage in engines.items()}
+        for name, storage in engines.items():
+            storage.close()
+            results[name]["disque (Ko)"] = _disk_usage(paths[name]) / 1024
+
+    print(f"{args.mails} courriels, durées moyennes en ms")
+    print(f"{'opération':>18}" + "".join(f" {name:>10}" for name in results))
+    for operation in results["directory"]:
+        print(f"{operation:>18}"
+              + "".join(f" {engine[operation]:>10.3f}" for engine in results.values()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
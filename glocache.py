@@ -0,0 +1,232 @@
+"""\
+Module fournissant un cache en mémoire des courriels et des listes
+d'entêtes lus dans le stockage du serveur.
+
+Le cache est borné en octets et évince les entrées les moins récemment
+utilisées. `CachedStorage` l'interpose devant n'importe quel
+`glostorage.MailboxStorage`, avec un registre des comptes qui évite de
+consulter le stockage à chaque authentification ou validation d'un
+destinataire.
+"""
+import collections
+import threading
+from typing import Any, Callable, Hashable, Iterator
+
+import glostorage
+import gloutils
+
+# Fixed cost estimate of a cached entry (dict, tuple and key objects)
+_ENTRY_OVERHEAD = 200
+
+REGISTRY_MAX_BYTES = 4 * 1024 * 1024
+"""Taille par défaut du registre des comptes, environ 10 000 comptes."""
+
+
+class LRUCache:
+    """
+    Cache associatif borné par la taille totale estimée de ses valeurs,
+    qui évince les entrées les moins récemment utilisées.
+
+    Tient les compteurs de succès, d'échecs et d'évictions.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._entries: collections.OrderedDict[Hashable, tuple[Any, int]] = \
+            collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        """Valeur associée à la clé, None si elle n'est pas en cache."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        """
+        Associe la valeur à la clé, puis évince les entrées les plus
+        anciennes jusqu'à respecter la taille maximale. Une valeur plus
+        grande que le cache entier n'est pas conservée.
+        """
+        size += _ENTRY_OVERHEAD
+        with self._lock:
+            self._discard(key)
+            if size > self._max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """Retire la clé du cache."""
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: Hashable) -> None:
+        """Retire la clé du cache, le verrou étant déjà acquis."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def stats(self) -> dict[str, int]:
+        """Compteurs du cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "entries": len(self._entries),
+                    "bytes": self._bytes, "max_bytes": self._max_bytes}
+
+
+def _headers_size(entries: list[dict]) -> int:
+    """Taille estimée d'une liste d'entêtes."""
+    return sum(len(entry["id"]) + len(entry["sender"]) + len(entry["subject"])
+               + len(entry["date"]) + _ENTRY_OVERHEAD for entry in entries)
+
+
+def _mail_size(mail: gloutils.EmailContentPayload) -> int:
+    """Taille estimée d'un courriel."""
+    return sum(len(value) for value in mail.values() if isinstance(value, str))
+
+
+def _credentials_size(credentials: dict) -> int:
+    """Taille estimée des données d'authentification d'un compte."""
+    return sum(len(str(key)) + len(str(value)) for key, value in credentials.items())
+
+
+class CachedStorage(glostorage.MailboxStorage):
+    """
+    Stockage interposant un LRUCache devant un autre stockage.
+
+    Les courriels sont mis en cache par (utilisateur, identifiant), ils ne
+    changent jamais une fois livrés. La liste complète des entêtes d'un
+    utilisateur est mise en cache avec la version de sa boîte, de sorte
+    qu'une livraison faite par un autre processus l'invalide aussi.
+
+    Le registre `registry` garde les données d'authentification des
+    comptes consultés ou créés, dans un LRUCache distinct pour que les
+    courriels ne les évincent pas. Seuls les comptes existants y sont
+    gardés: un compte créé par un autre processus est trouvé dans le
+    stockage à sa première consultation.
+    """
+
+    def __init__(self, storage: glostorage.MailboxStorage, max_bytes: int,
+                 registry_bytes: int = REGISTRY_MAX_BYTES) -> None:
+        self._storage = storage
+        self.cache = LRUCache(max_bytes)
+        self.registry = LRUCache(registry_bytes)
+
+    def user_exists(self, username: str) -> bool:
+        return self.get_credentials(username) is not None
+
+    def create_user(self, username: str, credentials: dict) -> bool:
+        created = self._storage.create_user(username, credentials)
+        if created:
+            self.registry.put(username, credentials, _credentials_size(credentials))
+        return created
+
+    def get_credentials(self, username: str) -> dict | None:
+        credentials = self.registry.get(username)
+        if credentials is None:
+            credentials = self._storage.get_credentials(username)
+            if credentials is not None:
+                self.registry.put(username, credentials, _credentials_size(credentials))
+        return credentials
+
+    def update_credentials(self, username: str, credentials: dict) -> None:
+        self._storage.update_credentials(username, credentials)
+        self.registry.put(username, credentials, _credentials_size(credentials))
+
+    def mailbox_version(self, username: str) -> Hashable:
+        return self._storage.mailbox_version(username)
+
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: int | None = None) -> tuple[list[dict], int]:
+        version = self._storage.mailbox_version(username)
+        cached = self.cache.get(("headers", username))
+        if cached is not None and cached[0] == version:
+            entries = cached[1]
+        else:
+            entries, _ = self._storage.list_headers(username)
+            if version is not None:
+                self.cache.put(("headers", username), (version, entries),
+                               _headers_size(entries))
+        end = None if limit is None else offset + limit
+        return entries[offset:end], len(entries)
+
+    def get_mail(self, username: str, mail_id: str
+                 ) -> gloutils.EmailContentPayload | None:
+        mail = self.cache.get(("mail", username, mail_id))
+        if mail is None:
+            mail = self._storage.get_mail(username, mail_id)
+            if mail is not None:
+                self.cache.put(("mail", username, mail_id), mail, _mail_size(mail))
+        return mail
+
+    def get_stats(self, username: str) -> gloutils.StatsPayload:
+        return self._storage.get_stats(username)
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                mail_id: str | None = None) -> str:
+        mail_id = self._storage.deliver(username, payload, mail_id)
+        self.cache.invalidate(("headers", username))
+        return mail_id
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     mail_id: str | None = None) -> str:
+        mail_id = self._storage.deliver_many(usernames, payload, mail_id)
+        for username in usernames:
+            self.cache.invalidate(("headers", username))
+        return mail_id
+
+    def deliver_stream(self, usernames: list[str], payload: gloutils.StreamedEmailPayload,
+                       recv_chunk: Callable[[], bytes], lost: bool = False,
+                       mail_id: str | None = None) -> str:
+        mail_id = self._storage.deliver_stream(usernames, payload, recv_chunk, lost, mail_id)
+        for username in usernames:
+            self.cache.invalidate(("headers", username))
+        return mail_id
+
+    def read_stream(self, username: str, mail_id: str) -> Iterator[bytes]:
+        return self._storage.read_stream(username, mail_id)
+
+    def search_ids(self, username: str, terms: list[str]) -> set[str]:
+        return self._storage.search_ids(username, terms)
+
+    def _matching_headers(self, username: str, terms: list[str]) -> list[dict]:
+        if not terms:
+            # All the headers, from the cache
+            return super()._matching_headers(username, terms)
+        # Keeps the storage's own selection, SQLite's in SQL
+        return self._storage._matching_headers(username, terms)
+
+    def store_lost(self, payload: gloutils.EmailContentPayload,
+                   mail_id: str | None = None) -> str:
+        return self._storage.store_lost(payload, mail_id)
+
+    def iter_lost(self) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        return self._storage.iter_lost()
+
+    def read_lost_stream(self, mail_id: str) -> Iterator[bytes]:
+        return self._storage.read_lost_stream(mail_id)
+
+    def verify_stats(self) -> list[tuple[str, dict | None, dict]]:
+        return self._storage.verify_stats()
+
+    def users(self) -> list[str]:
+        return self._storage.users()
+
+    def iter_mails(self, username: str
+                   ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        return self._storage.iter_mails(username)
+
+    def close(self) -> None:
+        self._storage.close()
@@ -0,0 +1,659 @@
+"""\
+Module fournissant une bibliothèque cliente non interactive pour le
+serveur mail @glo2000.ca.
+
+`Connection` et `AsyncConnection` (asyncio) offrent une méthode par
+opération du protocole, qui retourne le payload de la réponse ou lève
+une exception GloClientError si le serveur répond par une erreur.
+`ConnectionPool` et `AsyncConnectionPool` gardent des connexions
+authentifiées à réutiliser d'une opération à l'autre.
+
+Les erreurs de communication lèvent les exceptions de glosocket
+(GLOSocketError), de glocodec (GLOCodecError) ou OSError; une connexion
+qui en a levé une ne doit plus servir.
+"""
+
+import asyncio
+import contextlib
+import os
+import select
+import socket
+import threading
+from typing import AsyncIterator, Iterator
+
+import glocodec
+import glosocket
+import gloutils
+
+_TRANSPORT_ERRORS = (OSError, glosocket.GLOSocketError, glocodec.GLOCodecError)
+
+
+class GloClientError(Exception):
+    """
+    Erreur levée lorsque le serveur répond à une requête par l'entête
+    ERROR. `payload` contient la réponse complète, par exemple l'état de
+    chaque destinataire d'un envoi.
+    """
+
+    def __init__(self, message: str, payload: dict | None = None) -> None:
+        super().__init__(message)
+        self.payload = payload or {}
+
+
+class _BaseConnection:
+    """
+    État et construction des messages communs aux connexions synchrone et
+    asyncio: encodage, compression et capacités négociés, nom du compte
+    connecté et notifications reçues.
+    """
+
+    def __init__(self, streaming: bool) -> None:
+        self.username: str | None = None
+        self._streaming = streaming
+        self._encoding = glocodec.ENCODING_JSON
+        self._compression: str | None = None
+        self._capabilities: set[str] = set()
+        self._notifications: list[gloutils.NotificationPayload] = []
+
+    @property
+    def capabilities(self) -> set[str]:
+        """Capacités optionnelles négociées avec le serveur."""
+        return set(self._capabilities)
+
+    def _negotiation(self) -> gloutils.GloMessage:
+        """Requête de négociation, avec les flux si la connexion les demande."""
+        capabilities = gloutils.SUPPORTED_CAPABILITIES if self._streaming else []
+        return gloutils.GloMessage(header=gloutils.Headers.NEGOTIATION,
+                                   payload=gloutils.NegotiationPayload(
+                                       encodings=glocodec.SUPPORTED_ENCODINGS,
+                                       compressions=glosocket.SUPPORTED_COMPRESSIONS,
+                                       capabilities=capabilities))
+
+    def _negotiated(self, reply: gloutils.GloMessage) -> None:
+        """Retient les choix du serveur; un ancien serveur garde JSON."""
+        if reply["header"] != gloutils.Headers.OK:
+            return
+        payload = reply.get("payload", {})
+        encodings = payload.get("encodings", [])
+        if encodings and encodings[0] in glocodec.SUPPORTED_ENCODINGS:
+            self._encoding = encodings[0]
+        compressions = payload.get("compressions", [])
+        if compressions and compressions[0] in glosocket.SUPPORTED_COMPRESSIONS:
+            self._compression = compressions[0]
+        self._capabilities = (set(payload.get("capabilities", []))
+                              & set(gloutils.SUPPORTED_CAPABILITIES))
+
+    def _received(self, message: gloutils.GloMessage) -> bool:
+        """
+        Met une notification de côté et retourne True, ou retourne False
+        pour tout autre message.
+        """
+        if message.get("header") != gloutils.Headers.NOTIFICATION:
+            return False
+        self._notifications.append(message.get("payload", {}))
+        return True
+
+    def _take_notifications(self) -> list[gloutils.NotificationPayload]:
+        """Retourne et oublie les notifications mises de côté."""
+        notifications, self._notifications = self._notifications, []
+        return notifications
+
+    @staticmethod
+    def _result(reply: gloutils.GloMessage) -> dict:
+        """Payload d'une réponse, GloClientError si c'est une erreur."""
+        payload = reply.get("payload") or {}
+        if reply.get("header") == gloutils.Headers.ERROR:
+            raise GloClientError(payload.get("error_message", "Erreur du serveur"), payload)
+        return payload
+
+    @staticmethod
+    def _auth(header: gloutils.Headers, username: str, password: str) -> gloutils.GloMessage:
+        """Requête d'authentification."""
+        return gloutils.GloMessage(header=header,
+                                   payload=gloutils.AuthPayload(username=username,
+                                                                password=password))
+
+    @staticmethod
+    def _page(header: gloutils.Headers, payload: dict, offset: int,
+              limit: int | None) -> gloutils.GloMessage:
+        """Requête de liste ou de recherche, paginée si `limit` est donné."""
+        payload = dict(payload, offset=offset)
+        if limit is not None:
+            payload["limit"] = limit
+        return gloutils.GloMessage(header=header, payload=payload)
+
+    @staticmethod
+    def _choice(email: str | int) -> gloutils.GloMessage:
+        """
+        Requête de lecture d'un courriel désigné par son identifiant, ou par
+        son numéro dans la liste pour les anciens serveurs.
+        """
+        if isinstance(email, int):
+            payload = gloutils.EmailChoicePayload(choice=email)
+        else:
+            payload = gloutils.EmailChoicePayload(email_id=email)
+        return gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_CHOICE,
+                                   payload=payload)
+
+    def _batch(self, messages: list[gloutils.GloMessage]) -> gloutils.GloMessage:
+        """Lot des requêtes, numérotées dans l'ordre."""
+        requests = [dict(message, request_id=i) for i, message in enumerate(messages)]
+        return gloutils.GloMessage(header=gloutils.Headers.BATCH,
+                                   payload=gloutils.BatchPayload(requests=requests))
+
+    @staticmethod
+    def _batch_replies(reply: gloutils.GloMessage, count: int) -> list[gloutils.GloMessage]:
+        """
+        Réponses d'un lot de `count` requêtes, dans l'ordre. Une requête
+        sans réponse reçoit une réponse d'erreur.
+        """
+        if reply["header"] != gloutils.Headers.OK:
+            return [reply] * count
+        replies = {batch_reply.get("request_id"): batch_reply
+                   for batch_reply in reply["payload"].get("replies", [])}
+        missing = gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                      payload=gloutils.ErrorPayload(
+                                          error_message="Aucune réponse du serveur"))
+        return [replies.get(i, missing) for i in range(count)]
+
+    def _mail(self, destination: str, subject: str, content: str,
+              attachments: list[str]) -> gloutils.GloMessage:
+        """
+        Requête d'envoi d'un courriel du compte connecté. Le courriel est
+        envoyé en flux s'il a des pièces jointes ou un long corps et que le
+        serveur supporte les flux.
+        """
+        if self.username is None:
+            raise GloClientError("Aucun utilisateur connecté")
+        streaming = gloutils.CAPABILITY_STREAMING in self._capabilities
+        if attachments and not streaming:
+            raise GloClientError("Le serveur ne supporte pas les pièces jointes")
+        missing = [path for path in attachments if not os.path.isfile(path)]
+        if missing:
+            raise GloClientError("Fichier introuvable : " + ", ".join(missing))
+
+        payload = gloutils.EmailContentPayload(
+            sender=self.username + "@" + gloutils.SERVER_DOMAIN,
+            destination=destination,
+            subject=subject,
+            date=gloutils.get_current_utc_time(),
+            content=content)
+        if attachments or (streaming and len(content) > glosocket.STREAM_CHUNK_SIZE):
+            payload = gloutils.StreamedEmailPayload(
+                payload, content="", streamed=True,
+                attachments=[gloutils.AttachmentInfo(name=os.path.basename(path))
+                             for path in attachments])
+        return gloutils.GloMessage(header=gloutils.Headers.EMAIL_SENDING, payload=payload)
+
+    @staticmethod
+    def _search(query: str, sender: str, since: str, until: str) -> dict:
+        """Payload d'une recherche, sans pagination."""
+        return gloutils.SearchPayload(query=query, sender=sender, since=since, until=until)
+
+    @staticmethod
+    def _metrics(profile: bool | None) -> gloutils.GloMessage:
+        """Requête des mesures du serveur."""
+        message = gloutils.GloMessage(header=gloutils.Headers.METRICS)
+        if profile is not None:
+            message["payload"] = gloutils.MetricsPayload(profile=profile)
+        return message
+
+
+class Connection(_BaseConnection):
+    """
+    Connexion synchrone au serveur.
+
+    Si `streaming` est vrai, les flux sont négociés: les courriels avec
+    pièces jointes peuvent être envoyés et la lecture d'un courriel reçu en
+    flux retourne seulement ses entêtes (`streamed` vrai). Son corps puis
+    chacune de ses pièces jointes doivent alors être lus avec iter_chunks
+    avant la requête suivante.
+    """
+
+    def __init__(self, destination: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                 streaming: bool = False, timeout: float | None = None) -> None:
+        super().__init__(streaming)
+        self._socket = socket.create_connection((destination, port), timeout)
+        try:
+            self._negotiated(self.request(self._negotiation()))
+        except BaseException:
+            self._socket.close()
+            raise
+
+    def __enter__(self) -> "Connection":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def request(self, message: gloutils.GloMessage) -> gloutils.GloMessage:
+        """
+        Transmet une requête et retourne la réponse du serveur. Les
+        notifications reçues avant la réponse sont mises de côté.
+        """
+        self._send(message)
+        return self._recv()
+
+    def _send(self, message: gloutils.GloMessage) -> None:
+        """Transmet un message avec l'encodage et la compression négociés."""
+        glocodec.send_message(self._socket, message, self._encoding, self._compression)
+
+    def _recv(self) -> gloutils.GloMessage:
+        """Récupère le prochain message qui n'est pas une notification."""
+        while True:
+            message = glocodec.recv_message(self._socket)
+            if not self._received(message):
+                return message
+
+    def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte."""
+        self._result(self.request(self._auth(gloutils.Headers.AUTH_REGISTER,
+                                             username, password)))
+        self.username = username
+
+    def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte."""
+        self._result(self.request(self._auth(gloutils.Headers.AUTH_LOGIN,
+                                             username, password)))
+        self.username = username
+
+    def logout(self) -> None:
+        """Se déconnecte du compte, sans fermer la connexion."""
+        self._send(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
+        self.username = None
+        self._notifications.clear()
+
+    def subscribe(self) -> None:
+        """Demande les notifications des courriels livrés au compte (voir notifications)."""
+        self._result(self.request(gloutils.GloMessage(header=gloutils.Headers.SUBSCRIBE)))
+
+    def notifications(self) -> list[gloutils.NotificationPayload]:
+        """Notifications reçues depuis le dernier appel, sans attendre."""
+        while select.select([self._socket], [], [], 0)[0]:
+            message = glocodec.recv_message(self._socket)
+            self._received(message)
+        return self._take_notifications()
+
+    def inbox(self, offset: int = 0, limit: int | None = None) -> gloutils.EmailListPayload:
+        """Liste des courriels, du plus récent au plus ancien."""
+        return self._result(self.request(self._page(
+            gloutils.Headers.INBOX_READING_REQUEST, {}, offset, limit)))
+
+    def search(self, query: str = "", sender: str = "", since: str = "", until: str = "",
+               offset: int = 0, limit: int | None = None) -> gloutils.EmailListPayload:
+        """Courriels correspondant à la recherche (voir gloutils.SearchPayload)."""
+        return self._result(self.request(self._page(
+            gloutils.Headers.SEARCH, self._search(query, sender, since, until),
+            offset, limit)))
+
+    def fetch(self, email: str | int) -> gloutils.StreamedEmailPayload:
+        """Courriel désigné par son identifiant, ou par son numéro dans la liste."""
+        return self._result(self.request(self._choice(email)))
+
+    def fetch_many(self, emails: list[str | int]
+                   ) -> list[gloutils.EmailContentPayload | GloClientError]:
+        """
+        Plusieurs courriels en un seul aller-retour, dans un lot. Chaque
+        élément du résultat est le courriel ou l'erreur correspondante; les
+        courriels reçus en flux contiennent leur corps, sans les pièces
+        jointes.
+        """
+        replies = self._batch_replies(
+            self.request(self._batch([self._choice(email) for email in emails])),
+            len(emails))
+        results = []
+        for reply in replies:
+            try:
+                results.append(self._result(reply))
+            except GloClientError as ex:
+                results.append(ex)
+        return results
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Morceaux de la partie suivante d'un courriel lu en flux."""
+        return glosocket.iter_chunks(self._socket)
+
+    def send(self, destination: str, subject: str, content: str,
+             attachments: list[str] | None = None) -> gloutils.DeliveryReportPayload:
+        """
+        Envoie un courriel à une ou plusieurs adresses séparées par des
+        virgules, avec les fichiers `attachments` en pièces jointes.
+
+        Si un destinataire n'a pas reçu le courriel, l'exception
+        GloClientError contient l'état de chaque destinataire.
+        """
+        attachments = attachments or []
+        message = self._mail(destination, subject, content, attachments)
+        self._send(message)
+        if message["payload"].get("streamed"):
+            glosocket.send_stream(self._socket, content.encode('utf-8'), self._compression)
+            for path in attachments:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(glosocket.STREAM_CHUNK_SIZE), b""):
+                        glosocket.send_chunk(self._socket, chunk, self._compression)
+                glosocket.send_chunk(self._socket, b"")
+        return self._result(self._recv())
+
+    def stats(self) -> gloutils.StatsPayload:
+        """Nombre de courriels et taille du dossier."""
+        return self._result(self.request(
+            gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)))
+
+    def metrics(self, profile: bool | None = None) -> gloutils.MetricsPayload:
+        """Mesures du serveur, pour un administrateur (voir glometrics)."""
+        return self._result(self.request(self._metrics(profile)))
+
+    def close(self) -> None:
+        """Prévient le serveur avec l'entête `BYE` et ferme la connexion."""
+        try:
+            self._send(gloutils.GloMessage(header=gloutils.Headers.BYE))
+        except _TRANSPORT_ERRORS:
+            pass
+        finally:
+            self._socket.close()
+
+
+class AsyncConnection(_BaseConnection):
+    """
+    Équivalent asyncio de Connection, ouvert avec AsyncConnection.open.
+    Une connexion ne sert qu'une requête à la fois.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 streaming: bool = False) -> None:
+        super().__init__(streaming)
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def open(cls, destination: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                   streaming: bool = False) -> "AsyncConnection":
+        """Ouvre une connexion et négocie ses options."""
+        reader, writer = await asyncio.open_connection(destination, port)
+        connection = cls(reader, writer, streaming)
+        try:
+            connection._negotiated(await connection.request(connection._negotiation()))
+        except BaseException:
+            writer.close()
+            raise
+        return connection
+
+    async def __aenter__(self) -> "AsyncConnection":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def request(self, message: gloutils.GloMessage) -> gloutils.GloMessage:
+        """Équivalent de Connection.request."""
+        await self._send(message)
+        return await self._recv()
+
+    async def _send(self, message: gloutils.GloMessage) -> None:
+        """Transmet un message avec l'encodage et la compression négociés."""
+        await glosocket.async_send_data(self._writer, glocodec.encode(message, self._encoding),
+                                        self._compression)
+
+    async def _recv(self) -> gloutils.GloMessage:
+        """Récupère le prochain message qui n'est pas une notification."""
+        while True:
+            message = glocodec.decode(await glosocket.async_recv_data(self._reader))
+            if not self._received(message):
+                return message
+
+    async def register(self, username: str, password: str) -> None:
+        """Équivalent de Connection.register."""
+        self._result(await self.request(self._auth(gloutils.Headers.AUTH_REGISTER,
+                                                   username, password)))
+        self.username = username
+
+    async def login(self, username: str, password: str) -> None:
+        """Équivalent de Connection.login."""
+        self._result(await self.request(self._auth(gloutils.Headers.AUTH_LOGIN,
+                                                   username, password)))
+        self.username = username
+
+    async def logout(self) -> None:
+        """Équivalent de Connection.logout."""
+        await self._send(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
+        self.username = None
+        self._notifications.clear()
+
+    async def subscribe(self) -> None:
+        """Équivalent de Connection.subscribe."""
+        self._result(await self.request(gloutils.GloMessage(header=gloutils.Headers.SUBSCRIBE)))
+
+    def notifications(self) -> list[gloutils.NotificationPayload]:
+        """
+        Notifications reçues avec les réponses depuis le dernier appel; voir
+        wait_notification pour attendre la suivante.
+        """
+        return self._take_notifications()
+
+    async def wait_notification(self) -> gloutils.NotificationPayload:
+        """
+        Attend la prochaine notification, sans requête en cours sur la
+        connexion.
+        """
+        while not self._notifications:
+            message = glocodec.decode(await glosocket.async_recv_data(self._reader))
+            self._received(message)
+        return self._notifications.pop(0)
+
+    async def inbox(self, offset: int = 0, limit: int | None = None
+                   ) -> gloutils.EmailListPayload:
+        """Équivalent de Connection.inbox."""
+        return self._result(await self.request(self._page(
+            gloutils.Headers.INBOX_READING_REQUEST, {}, offset, limit)))
+
+    async def search(self, query: str = "", sender: str = "", since: str = "",
+                     until: str = "", offset: int = 0, limit: int | None = None
+                     ) -> gloutils.EmailListPayload:
+        """Équivalent de Connection.search."""
+        return self._result(await self.request(self._page(
+            gloutils.Headers.SEARCH, self._search(query, sender, since, until),
+            offset, limit)))
+
+    async def fetch(self, email: str | int) -> gloutils.StreamedEmailPayload:
+        """Équivalent de Connection.fetch."""
+        return self._result(await self.request(self._choice(email)))
+
+    async def fetch_many(self, emails: list[str | int]
+                         ) -> list[gloutils.EmailContentPayload | GloClientError]:
+        """Équivalent de Connection.fetch_many."""
+        replies = self._batch_replies(
+            await self.request(self._batch([self._choice(email) for email in emails])),
+            len(emails))
+        results = []
+        for reply in replies:
+            try:
+                results.append(self._result(reply))
+            except GloClientError as ex:
+                results.append(ex)
+        return results
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """Équivalent de Connection.iter_chunks."""
+        while True:
+            chunk = await glosocket.async_recv_chunk(self._reader)
+            if not chunk:
+                return
+            yield chunk
+
+    async def send(self, destination: str, subject: str, content: str,
+                   attachments: list[str] | None = None) -> gloutils.DeliveryReportPayload:
+        """
+        Équivalent de Connection.send. Les pièces jointes sont lues dans le
+        fil de la boucle, un morceau à la fois.
+        """
+        attachments = attachments or []
+        message = self._mail(destination, subject, content, attachments)
+        await self._send(message)
+        if message["payload"].get("streamed"):
+            body = memoryview(content.encode('utf-8'))
+            for start in range(0, len(body), glosocket.STREAM_CHUNK_SIZE):
+                await glosocket.async_send_chunk(
+                    self._writer, body[start:start + glosocket.STREAM_CHUNK_SIZE].tobytes(),
+                    self._compression)
+            await glosocket.async_send_chunk(self._writer, b"")
+            for path in attachments:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(glosocket.STREAM_CHUNK_SIZE), b""):
+                        await glosocket.async_send_chunk(self._writer, chunk,
+                                                         self._compression)
+                await glosocket.async_send_chunk(self._writer, b"")
+        return self._result(await self._recv())
+
+    async def stats(self) -> gloutils.StatsPayload:
+        """Équivalent de Connection.stats."""
+        return self._result(await self.request(
+            gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)))
+
+    async def metrics(self, profile: bool | None = None) -> gloutils.MetricsPayload:
+        """Équivalent de Connection.metrics."""
+        return self._result(await self.request(self._metrics(profile)))
+
+    async def close(self) -> None:
+        """Équivalent de Connection.close."""
+        try:
+            await self._send(gloutils.GloMessage(header=gloutils.Headers.BYE))
+        except _TRANSPORT_ERRORS:
+            pass
+        finally:
+            self._writer.close()
+            with contextlib.suppress(*_TRANSPORT_ERRORS):
+                await self._writer.wait_closed()
+
+
+class ConnectionPool:
+    """
+    Réserve de connexions authentifiées au compte `username`, au plus
+    `size` à la fois, ouvertes au besoin et gardées entre les opérations.
+
+    Une connexion est empruntée avec `with pool.connection() as conn:`.
+    Elle est rendue à la réserve à la sortie du bloc, sauf si le bloc a
+    levé une exception autre que GloClientError: son état n'est alors plus
+    connu et elle est fermée.
+    """
+
+    def __init__(self, username: str, password: str, destination: str = "127.0.0.1",
+                 port: int = gloutils.APP_PORT, size: int = 4,
+                 streaming: bool = False) -> None:
+        self._username = username
+        self._password = password
+        self._destination = destination
+        self._port = port
+        self._streaming = streaming
+        self._slots = threading.BoundedSemaphore(size)
+        self._guard = threading.Lock()
+        self._idle: list[Connection] = []
+        self._closed = False
+
+    def _open(self) -> Connection:
+        """Ouvre et authentifie une nouvelle connexion."""
+        connection = Connection(self._destination, self._port, self._streaming)
+        try:
+            connection.login(self._username, self._password)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """Emprunte une connexion, en attendant qu'une place se libère."""
+        self._slots.acquire()
+        try:
+            with self._guard:
+                if self._closed:
+                    raise GloClientError("La réserve de connexions est fermée")
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._open()
+            try:
+                yield connection
+            except GloClientError:
+                self._give_back(connection)
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            else:
+                self._give_back(connection)
+        finally:
+            self._slots.release()
+
+    def _give_back(self, connection: Connection) -> None:
+        """Rend une connexion à la réserve, ou la ferme si la réserve l'est."""
+        with self._guard:
+            if not self._closed:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        """Ferme les connexions inutilisées; les autres le sont à leur retour."""
+        with self._guard:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class AsyncConnectionPool:
+    """Équivalent asyncio de ConnectionPool, emprunté avec `async with`."""
+
+    def __init__(self, username: str, password: str, destination: str = "127.0.0.1",
+                 port: int = gloutils.APP_PORT, size: int = 4,
+                 streaming: bool = False) -> None:
+        self._username = username
+        self._password = password
+        self._destination = destination
+        self._port = port
+        self._streaming = streaming
+        self._slots = asyncio.BoundedSemaphore(size)
+        self._idle: list[AsyncConnection] = []
+        self._closed = False
+
+    async def _open(self) -> AsyncConnection:
+        """Ouvre et authentifie une nouvelle connexion."""
+        connection = await AsyncConnection.open(self._destination, self._port,
+                                                self._streaming)
+        try:
+            await connection.login(self._username, self._password)
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[AsyncConnection]:
+        """Équivalent de ConnectionPool.connection."""
+        async with self._slots:
+            if self._closed:
+                raise GloClientError("La réserve de connexions est fermée")
+            connection = self._idle.pop() if self._idle else await self._open()
+            try:
+                yield connection
+            except GloClientError:
+                await self._give_back(connection)
+                raise
+            except BaseException:
+                await connection.close()
+                raise
+            else:
+                await self._give_back(connection)
+
+    async def _give_back(self, connection: AsyncConnection) -> None:
+        """Rend une connexion à la réserve, ou la ferme si la réserve l'est."""
+        if self._closed:
+            await connection.close()
+        else:
+            self._idle.append(connection)
+
+    async def close(self) -> None:
+        """Équivalent de ConnectionPool.close."""
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await connection.close()
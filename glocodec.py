@@ -0,0 +1,286 @@
+"""\
+Module fournissant l'encodage des messages GLO en octets.
+
+Deux encodages sont disponibles:
+- JSON, l'encodage historique, toujours accepté;
+- binaire, un encodage compact négocié à la connexion avec l'entête
+  `NEGOTIATION`.
+
+Un message binaire débute par l'octet `BINARY_MAGIC` suivi de l'entête
+sur un octet, puis des autres champs du message (`payload`, ...) encodés
+comme un dictionnaire. Chaque valeur est précédée d'une étiquette d'un
+octet indiquant son type; les chaînes et les collections sont préfixées
+par leur longueur. Les noms de champs connus sont remplacés par un octet.
+
+Le décodage détecte l'encodage à partir du premier octet, un message JSON
+débutant toujours par une accolade.
+"""
+import json
+import socket
+import struct
+from typing import Any
+
+import glosocket
+import gloutils
+
+ENCODING_JSON = "json"
+ENCODING_BINARY = "binary"
+SUPPORTED_ENCODINGS = [ENCODING_BINARY, ENCODING_JSON]
+
+BINARY_MAGIC = 0xB1
+
+# Known field names, encoded on a single byte. Append only: the position
+# of a name is its identifier on the wire.
+_KEYS = (
+    "header", "payload", "error_message", "username", "password",
+    "sender", "destination", "subject", "date", "content",
+    "email_list", "email_ids", "offset", "limit", "total",
+    "choice", "email_id", "count", "size", "encodings",
+    "request_id", "requests", "replies", "statuses", "address", "delivered",
+    "capabilities", "streamed", "content_size", "attachments", "name",
+    "compressions", "query", "since", "until", "profile", "metrics", "report",
+)
+_KEY_IDS = {key: i for i, key in enumerate(_KEYS)}
+_UNKNOWN_KEY = 0xFF
+
+_NONE = ord("N")
+_TRUE = ord("T")
+_FALSE = ord("F")
+_INT8 = ord("b")
+_INT32 = ord("i")
+_INT64 = ord("q")
+_SHORT_STR = ord("s")
+_STR = ord("S")
+_STR_LIST = ord("L")
+_LIST = ord("l")
+_DICT = ord("d")
+
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_I8 = struct.Struct("!b")
+_I32 = struct.Struct("!i")
+_I64 = struct.Struct("!q")
+_TAG_U8 = struct.Struct("!BB")
+_TAG_U32 = struct.Struct("!BI")
+_TAG_I8 = struct.Struct("!Bb")
+_TAG_I32 = struct.Struct("!Bi")
+_TAG_I64 = struct.Struct("!Bq")
+_MESSAGE_HEAD = struct.Struct("!BB")
+_NONE_BYTE = bytes((_NONE,))
+_TRUE_BYTE = bytes((_TRUE,))
+_FALSE_BYTE = bytes((_FALSE,))
+# Lone surrogates, which UTF-8 cannot encode, can only come from a \u escape
+# of a JSON string or, since json.loads decodes bytes with surrogatepass,
+# from a three-byte sequence starting with 0xED
+_SURROGATE_MARKERS = (b"\\ud", b"\\uD", b"\xed")
+
+
+class GLOCodecError(Exception):
+    """Erreur levée lorsqu'un message ne peut être encodé ou décodé."""
+
+
+def _encode_value(value: Any, parts: list) -> None:
+    """Ajoute la représentation binaire de `value` à `parts`."""
+    kind = type(value)
+    if kind is str:
+        data = value.encode('utf-8')
+        if len(data) < 256:
+            parts.append(_TAG_U8.pack(_SHORT_STR, len(data)))
+        else:
+            parts.append(_TAG_U32.pack(_STR, len(data)))
+        parts.append(data)
+    elif kind is bool:
+        parts.append(_TRUE_BYTE if value else _FALSE_BYTE)
+    elif isinstance(value, int):
+        if -128 <= value < 128:
+            parts.append(_TAG_I8.pack(_INT8, value))
+        elif -2**31 <= value < 2**31:
+            parts.append(_TAG_I32.pack(_INT32, value))
+        else:
+            try:
+                parts.append(_TAG_I64.pack(_INT64, value))
+            except struct.error as ex:
+                raise GLOCodecError("Integer out of range") from ex
+    elif value is None:
+        parts.append(_NONE_BYTE)
+    elif kind is dict:
+        parts.append(_TAG_U32.pack(_DICT, len(value)))
+        for key, item in value.items():
+            _encode_key(key, parts)
+            _encode_value(item, parts)
+    elif kind in (list, tuple):
+        if value and set(map(type, value)) == {str}:
+            # Lists of strings (email_list, email_ids) are the bulk of the
+            # listings: they are stored as a single UTF-8 JSON array, which
+            # the C json module encodes and decodes faster than one field
+            # per string.
+            data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+            parts.append(_TAG_U32.pack(_STR_LIST, len(data)))
+            parts.append(data)
+        else:
+            parts.append(_TAG_U32.pack(_LIST, len(value)))
+            for item in value:
+                _encode_value(item, parts)
+    else:
+        raise GLOCodecError(f"Cannot encode value of type {kind.__name__}")
+
+
+def _encode_key(key: str, parts: list) -> None:
+    """Ajoute la représentation binaire d'un nom de champ à `parts`."""
+    key_id = _KEY_IDS.get(key)
+    if key_id is not None:
+        parts.append(_U8.pack(key_id))
+    else:
+        data = key.encode('utf-8')
+        parts.append(_U8.pack(_UNKNOWN_KEY) + _U16.pack(len(data)))
+        parts.append(data)
+
+
+def _decode_key(data: memoryview, offset: int) -> tuple[str, int]:
+    """Décode un nom de champ et retourne la position suivante."""
+    key_id = data[offset]
+    if key_id != _UNKNOWN_KEY:
+        return _KEYS[key_id], offset + 1
+    length, = _U16.unpack_from(data, offset + 1)
+    start = offset + 3
+    return str(data[start:start + length], 'utf-8'), start + length
+
+
+def _decode_value(data: memoryview, offset: int) -> tuple[Any, int]:
+    """Décode une valeur et retourne la position suivante."""
+    tag = data[offset]
+    offset += 1
+    if tag == _SHORT_STR:
+        length = data[offset]
+        offset += 1
+        return str(data[offset:offset + length], 'utf-8'), offset + length
+    if tag == _STR:
+        length, = _U32.unpack_from(data, offset)
+        offset += 4
+        return str(data[offset:offset + length], 'utf-8'), offset + length
+    if tag == _INT8:
+        return _I8.unpack_from(data, offset)[0], offset + 1
+    if tag == _INT32:
+        return _I32.unpack_from(data, offset)[0], offset + 4
+    if tag == _INT64:
+        return _I64.unpack_from(data, offset)[0], offset + 8
+    if tag == _DICT:
+        count, = _U32.unpack_from(data, offset)
+        offset += 4
+        result = {}
+        for _ in range(count):
+            key, offset = _decode_key(data, offset)
+            result[key], offset = _decode_value(data, offset)
+        return result, offset
+    if tag == _STR_LIST:
+        length, = _U32.unpack_from(data, offset)
+        offset += 4
+        return json.loads(str(data[offset:offset + length], 'utf-8')), offset + length
+    if tag == _LIST:
+        count, = _U32.unpack_from(data, offset)
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    raise GLOCodecError(f"Unknown value tag {tag}")
+
+
+def encode(message: gloutils.GloMessage, encoding: str = ENCODING_JSON) -> bytes:
+    """
+    Encode un message selon l'encodage demandé.
+
+    Lève une exception GLOCodecError si le message ne peut être encodé,
+    notamment s'il contient une chaîne qui n'est pas de l'Unicode valide.
+    """
+    if encoding == ENCODING_JSON:
+        return json.dumps(message).encode('utf-8')
+    if encoding != ENCODING_BINARY:
+        raise GLOCodecError(f"Unknown encoding {encoding}")
+
+    try:
+        parts = [_MESSAGE_HEAD.pack(BINARY_MAGIC, message["header"])]
+    except (KeyError, struct.error) as ex:
+        raise GLOCodecError("The message has no valid header") from ex
+    fields = {key: value for key, value in message.items() if key != "header"}
+    try:
+        _encode_value(fields, parts)
+    except UnicodeEncodeError as ex:
+        raise GLOCodecError("The message contains an invalid string") from ex
+    return b"".join(parts)
+
+
+def _check_strings(message: dict, data: bytes | bytearray) -> None:
+    """
+    Vérifie que les chaînes d'un message décodé de `data` sont de
+    l'Unicode valide, sans surrogate isolé, pour qu'elles puissent être
+    réencodées en UTF-8. Seuls les messages qui en contiennent peut-être
+    sont parcourus.
+    """
+    if not any(marker in data for marker in _SURROGATE_MARKERS):
+        return
+    try:
+        json.dumps(message, ensure_ascii=False).encode('utf-8')
+    except UnicodeEncodeError as ex:
+        raise GLOCodecError("The message contains an invalid string") from ex
+
+
+def decode(data: bytes | bytearray) -> gloutils.GloMessage:
+    """
+    Décode un message JSON ou binaire, détecté par son premier octet.
+
+    Lève une exception GLOCodecError si le message est invalide ou contient
+    une chaîne qui n'est pas de l'Unicode valide.
+    """
+    if not data or data[0] != BINARY_MAGIC:
+        try:
+            message = json.loads(data)
+        except (ValueError, RecursionError) as ex:
+            raise GLOCodecError("The message is not valid JSON") from ex
+        if not isinstance(message, dict) or "header" not in message:
+            raise GLOCodecError("The message has no header")
+        _check_strings(message, data)
+        return message
+
+    view = memoryview(data)
+    try:
+        message, end = _decode_value(view, 2)
+    except (IndexError, struct.error, ValueError, RecursionError) as ex:
+        # ValueError covers invalid UTF-8 and the JSON of string lists
+        raise GLOCodecError("The binary message is truncated or corrupted") from ex
+    if end != len(data) or not isinstance(message, dict):
+        raise GLOCodecError("The binary message is truncated or corrupted")
+    # The string lists are JSON, which may escape surrogates
+    _check_strings(message, data)
+    return {"header": data[1], **message}
+
+
+def send_message(dest_soc: socket.socket, message: gloutils.GloMessage,
+                 encoding: str = ENCODING_JSON, compression: str | None = None) -> None:
+    """
+    Encode le message puis le transmet à la destination, compressé avec
+    l'algorithme `compression` s'il est donné (voir glosocket).
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    glosocket.send_data(dest_soc, encode(message, encoding), compression)
+
+
+def recv_message(source_soc: socket.socket) -> gloutils.GloMessage:
+    """
+    Récupère un message de la source et le décode, quel que soit son
+    encodage.
+
+    Lève une exception GLOSocketError en cas de problème de communication
+    et GLOCodecError si le message est invalide.
+    """
+    return decode(glosocket.recv_data(source_soc))
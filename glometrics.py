@@ -0,0 +1,369 @@
+"""\
+Module fournissant les mesures du serveur: nombre de requêtes, d'erreurs
+et histogramme des latences de chaque entête, octets reçus et transmis,
+durées des accès au stockage, ainsi qu'un échantillonnage des requêtes
+avec cProfile, activé à la demande.
+
+Les durées sont en microsecondes entières, que glocodec sait encoder.
+
+Exécuté comme un script, le module affiche les mesures d'un serveur avec
+l'entête METRICS, ou active et arrête l'échantillonnage.
+
+Utilisation: python glometrics.py -u ADMIN [--profile on|off]
+"""
+
+import argparse
+import cProfile
+import getpass
+import io
+import json
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+from typing import Any, Callable, Hashable, Iterator
+
+import glocodec
+import glosocket
+import glostorage
+import gloutils
+
+LATENCY_BUCKETS = (100, 250, 500, 1_000, 2_500, 5_000, 10_000, 25_000, 50_000,
+                   100_000, 250_000, 500_000, 1_000_000, 2_500_000)
+"""Bornes supérieures, en microsecondes, des classes des histogrammes."""
+
+PROFILE_REPORT_LINES = 30
+"""Nombre de fonctions du rapport retourné à l'arrêt de l'échantillonnage."""
+
+
+def _microseconds(start: float) -> int:
+    """Durée écoulée depuis `start` (time.perf_counter), en microsecondes."""
+    return int((time.perf_counter() - start) * 1_000_000)
+
+
+class Histogram:
+    """
+    Histogramme de durées à classes fixes (LATENCY_BUCKETS, plus une
+    classe pour les durées plus longues), avec leur nombre, leur somme et
+    leur maximum. Non synchronisé: Metrics le protège.
+    """
+
+    __slots__ = ("count", "total", "maximum", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration: int) -> None:
+        """Ajoute une durée, en microsecondes."""
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, percent: int) -> int:
+        """
+        Borne supérieure de la classe qui contient le centile `percent`,
+        le maximum pour la dernière classe.
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.maximum
+        return self.maximum
+
+    def snapshot(self) -> dict[str, Any]:
+        """État de l'histogramme, avec les centiles estimés p50, p95 et p99."""
+        return {"count": self.count, "total_us": self.total, "max_us": self.maximum,
+                "p50_us": self.percentile(50), "p95_us": self.percentile(95),
+                "p99_us": self.percentile(99), "buckets": list(self.buckets)}
+
+
+class Metrics:
+    """
+    Mesures d'un processus serveur, partagées par les fils du moteur
+    asyncio et du bassin de hachage.
+
+    Les requêtes sont comptées par nom d'entête, les accès au stockage par
+    nom de méthode (voir TimedStorage).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._requests: dict[str, Histogram] = {}
+        self._errors: dict[str, int] = {}
+        self._storage: dict[str, Histogram] = {}
+        self._bytes_in = 0
+        self._bytes_out = 0
+
+    def record_request(self, name: str, duration: int, error: bool = False) -> None:
+        """Compte une requête de l'entête `name` traitée en `duration` µs."""
+        with self._lock:
+            histogram = self._requests.get(name)
+            if histogram is None:
+                histogram = self._requests[name] = Histogram()
+            histogram.record(duration)
+            if error:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    def record_storage(self, name: str, duration: int) -> None:
+        """Compte un appel à la méthode `name` du stockage qui a duré `duration` µs."""
+        with self._lock:
+            histogram = self._storage.get(name)
+            if histogram is None:
+                histogram = self._storage[name] = Histogram()
+            histogram.record(duration)
+
+    def add_bytes(self, received: int = 0, sent: int = 0) -> None:
+        """Compte les octets reçus et transmis, avant compression des trames."""
+        with self._lock:
+            self._bytes_in += received
+            self._bytes_out += sent
+
+    def snapshot(self, gauges: dict[str, Any] | None = None) -> dict[str, Any]:
+        """
+        État des mesures, avec les jauges `gauges` du serveur (clients
+        connectés, etc.) au moment de l'appel.
+        """
+        with self._lock:
+            return {"pid": os.getpid(),
+                    "uptime_s": int(time.time() - self._started),
+                    "bytes_in": self._bytes_in,
+                    "bytes_out": self._bytes_out,
+                    "gauges": dict(gauges or {}),
+                    "requests": {name: dict(histogram.snapshot(),
+                                            errors=self._errors.get(name, 0))
+                                 for name, histogram in self._requests.items()},
+                    "storage": {name: histogram.snapshot()
+                                for name, histogram in self._storage.items()}}
+
+
+class Profiler:
+    """
+    Échantillonnage des requêtes avec cProfile: une fois activé, une
+    requête sur `rate` est exécutée sous le profileur, une seule à la fois;
+    les autres s'exécutent normalement.
+    """
+
+    def __init__(self, rate: int = 10) -> None:
+        self._rate = max(1, rate)
+        self._guard = threading.Lock()
+        # Held while a sampled request runs under the profiler; reentrant so
+        # that a sampled request, or a signal handler, can stop sampling
+        self._busy = threading.RLock()
+        self._profile: cProfile.Profile | None = None
+        self._calls = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Indique si l'échantillonnage est actif."""
+        return self._profile is not None
+
+    def start(self) -> None:
+        """Active l'échantillonnage, avec un nouveau profil."""
+        with self._guard:
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+                self._calls = 0
+
+    def stop(self, path: str) -> list[str]:
+        """
+        Arrête l'échantillonnage, écrit le profil dans le fichier `path`
+        (format pstats) et retourne les lignes du rapport des
+        PROFILE_REPORT_LINES fonctions les plus coûteuses, en temps cumulé.
+        Retourne une liste vide si l'échantillonnage n'était pas actif.
+        """
+        with self._guard:
+            profile, self._profile = self._profile, None
+        if profile is None:
+            return []
+        with self._busy:
+            # Waits for the sampled request still running, if any
+            pass
+        report = io.StringIO()
+        try:
+            stats = pstats.Stats(profile, stream=report)
+        except TypeError:
+            # No request was sampled
+            return []
+        stats.dump_stats(path)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_REPORT_LINES)
+        return [line for line in report.getvalue().splitlines() if line.strip()]
+
+    def run(self, function: Callable, *args) -> Any:
+        """Exécute la fonction, sous le profileur si la requête est échantillonnée."""
+        profile = self._profile
+        if profile is None:
+            return function(*args)
+        with self._guard:
+            self._calls += 1
+            sampled = self._calls % self._rate == 0
+        if sampled and self._busy.acquire(blocking=False):
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                self._busy.release()
+        return function(*args)
+
+
+class TimedStorage(glostorage.MailboxStorage):
+    """
+    Stockage qui mesure la durée de chaque appel à un autre stockage dans
+    un objet Metrics. Placé sous le cache (glocache), il mesure les accès
+    réels au disque.
+
+    Les contenus en flux sont mesurés morceau par morceau. La durée d'une
+    livraison en flux comprend la réception de ses morceaux.
+    """
+
+    def __init__(self, storage: glostorage.MailboxStorage, metrics: Metrics) -> None:
+        self._storage = storage
+        self._metrics = metrics
+
+    def _timed(self, name: str, function: Callable, *args) -> Any:
+        """Appelle la fonction du stockage et mesure sa durée sous le nom `name`."""
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self._metrics.record_storage(name, _microseconds(start))
+
+    def _timed_iter(self, name: str, iterator: Iterator) -> Iterator:
+        """Parcourt l'itérateur en mesurant la production de chaque élément."""
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._metrics.record_storage(name, _microseconds(start))
+            yield item
+
+    def user_exists(self, username: str) -> bool:
+        return self._timed("user_exists", self._storage.user_exists, username)
+
+    def create_user(self, username: str, credentials: dict) -> bool:
+        return self._timed("create_user", self._storage.create_user, username, credentials)
+
+    def get_credentials(self, username: str) -> dict | None:
+        return self._timed("get_credentials", self._storage.get_credentials, username)
+
+    def update_credentials(self, username: str, credentials: dict) -> None:
+        self._timed("update_credentials", self._storage.update_credentials,
+                    username, credentials)
+
+    def mailbox_version(self, username: str) -> Hashable:
+        return self._timed("mailbox_version", self._storage.mailbox_version, username)
+
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: int | None = None) -> tuple[list[dict], int]:
+        return self._timed("list_headers", self._storage.list_headers,
+                           username, offset, limit)
+
+    def get_mail(self, username: str, mail_id: str
+                 ) -> gloutils.EmailContentPayload | None:
+        return self._timed("get_mail", self._storage.get_mail, username, mail_id)
+
+    def get_stats(self, username: str) -> gloutils.StatsPayload:
+        return self._timed("get_stats", self._storage.get_stats, username)
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                mail_id: str | None = None) -> str:
+        return self._timed("deliver", self._storage.deliver, username, payload, mail_id)
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     mail_id: str | None = None) -> str:
+        return self._timed("deliver_many", self._storage.deliver_many,
+                           usernames, payload, mail_id)
+
+    def deliver_stream(self, usernames: list[str], payload: gloutils.StreamedEmailPayload,
+                       recv_chunk: Callable[[], bytes], lost: bool = False,
+                       mail_id: str | None = None) -> str:
+        return self._timed("deliver_stream", self._storage.deliver_stream,
+                           usernames, payload, recv_chunk, lost, mail_id)
+
+    def read_stream(self, username: str, mail_id: str) -> Iterator[bytes]:
+        return self._timed_iter("read_stream", self._storage.read_stream(username, mail_id))
+
+    def search_ids(self, username: str, terms: list[str]) -> set[str]:
+        return self._timed("search_ids", self._storage.search_ids, username, terms)
+
+    def _matching_headers(self, username: str, terms: list[str]) -> list[dict]:
+        # Keeps the storage's own implementation, SQLite's selects in SQL
+        return self._timed("matching_headers", self._storage._matching_headers,
+                           username, terms)
+
+    def store_lost(self, payload: gloutils.EmailContentPayload,
+                   mail_id: str | None = None) -> str:
+        return self._timed("store_lost", self._storage.store_lost, payload, mail_id)
+
+    def iter_lost(self) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        return self._timed_iter("iter_lost", iter(self._storage.iter_lost()))
+
+    def read_lost_stream(self, mail_id: str) -> Iterator[bytes]:
+        return self._timed_iter("read_lost_stream", self._storage.read_lost_stream(mail_id))
+
+    def verify_stats(self) -> list[tuple[str, dict | None, dict]]:
+        return self._timed("verify_stats", self._storage.verify_stats)
+
+    def users(self) -> list[str]:
+        return self._timed("users", self._storage.users)
+
+    def iter_mails(self, username: str
+                   ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        return self._timed_iter("iter_mails", iter(self._storage.iter_mails(username)))
+
+    def close(self) -> None:
+        self._storage.close()
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--destination", default="127.0.0.1",
+                        help="Adresse IP/URL du serveur.")
+    parser.add_argument("-u", "--username", required=True,
+                        help="Compte administrateur du serveur.")
+    parser.add_argument("--profile", choices=["on", "off"],
+                        help="Active ou arrête l'échantillonnage avec cProfile.")
+    args = parser.parse_args(sys.argv[1:])
+    password = getpass.getpass("Mot de passe : ")
+
+    try:
+        with socket.create_connection((args.destination, gloutils.APP_PORT)) as soc:
+            glocodec.send_message(soc, gloutils.GloMessage(
+                header=gloutils.Headers.AUTH_LOGIN,
+                payload=gloutils.AuthPayload(username=args.username, password=password)))
+            reply = glocodec.recv_message(soc)
+            if reply["header"] == gloutils.Headers.OK:
+                request = gloutils.GloMessage(header=gloutils.Headers.METRICS)
+                if args.profile is not None:
+                    request["payload"] = gloutils.MetricsPayload(profile=args.profile == "on")
+                glocodec.send_message(soc, request)
+                reply = glocodec.recv_message(soc)
+            glocodec.send_message(soc, gloutils.GloMessage(header=gloutils.Headers.BYE))
+    except (OSError, glosocket.GLOSocketError, glocodec.GLOCodecError) as ex:
+        print(f"Erreur de communication : {ex}", file=sys.stderr)
+        return 1
+    if reply["header"] != gloutils.Headers.OK:
+        print(reply["payload"]["error_message"], file=sys.stderr)
+        return 1
+    print(json.dumps(reply["payload"].get("metrics", {}), indent=2))
+    for line in reply["payload"].get("report", []):
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
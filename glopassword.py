@@ -0,0 +1,104 @@
+"""\
+Module fournissant le hachage et la vérification des mots de passe.
+
+Les données d'authentification d'un compte contiennent l'empreinte du mot
+de passe `password_hash`, en hexadécimal, la fonction de dérivation `kdf`,
+le sel `salt` et les paramètres `params` de la fonction. Les comptes créés
+avant l'ajout de `kdf` n'ont qu'une empreinte SHA3-224 sans sel; leur
+empreinte est remplacée à la prochaine connexion réussie, comme celle des
+comptes dont les paramètres ne sont plus ceux du serveur.
+"""
+import hashlib
+import hmac
+import os
+
+KDF_SCRYPT = "scrypt"
+KDF_PBKDF2 = "pbkdf2_sha256"
+KDF_LEGACY = "sha3_224"
+
+SALT_SIZE = 16
+
+DEFAULT_PARAMS = {
+    KDF_SCRYPT: {"n": 2 ** 14, "r": 8, "p": 1},
+    KDF_PBKDF2: {"iterations": 600_000},
+}
+"""Paramètres par défaut de chaque fonction de dérivation."""
+
+# scrypt depends on the OpenSSL build hashlib was linked against
+SUPPORTED_KDFS = [kdf for kdf in (KDF_SCRYPT, KDF_PBKDF2)
+                  if kdf != KDF_SCRYPT or hasattr(hashlib, "scrypt")]
+"""Fonctions de dérivation disponibles pour les nouvelles empreintes."""
+
+
+def _derive(password: str, kdf: str, salt: bytes, params: dict) -> bytes:
+    """
+    Dérive l'empreinte d'un mot de passe.
+
+    Lève ValueError si la fonction ou ses paramètres ne sont pas valides.
+    """
+    data = password.encode('utf-8')
+    if kdf == KDF_SCRYPT:
+        n, r, p = params["n"], params["r"], params["p"]
+        return hashlib.scrypt(data, salt=salt, n=n, r=r, p=p,
+                              maxmem=2 * 128 * n * r * p + 1024 * 1024, dklen=32)
+    if kdf == KDF_PBKDF2:
+        return hashlib.pbkdf2_hmac("sha256", data, salt, params["iterations"])
+    if kdf == KDF_LEGACY:
+        return hashlib.sha3_224(data).digest()
+    raise ValueError(f"Unknown key derivation function {kdf}")
+
+
+class PasswordHasher:
+    """
+    Hache les nouveaux mots de passe avec une fonction de dérivation et
+    des paramètres donnés, et vérifie ceux de toutes les fonctions.
+    """
+
+    def __init__(self, kdf: str = SUPPORTED_KDFS[0], params: dict | None = None) -> None:
+        if kdf not in SUPPORTED_KDFS:
+            raise ValueError(f"Unsupported key derivation function {kdf}")
+        self.kdf = kdf
+        self.params = dict(params or DEFAULT_PARAMS[kdf])
+
+    @classmethod
+    def with_cost(cls, kdf: str, cost: int) -> "PasswordHasher":
+        """
+        Hacheur dont le coût est réglé par un seul entier: le logarithme
+        en base 2 de `n` pour scrypt, le nombre de milliers d'itérations
+        pour PBKDF2.
+
+        Lève ValueError si le coût est inférieur à 1.
+        """
+        if cost < 1:
+            raise ValueError(f"Invalid cost {cost}")
+        if kdf == KDF_SCRYPT:
+            return cls(kdf, {**DEFAULT_PARAMS[KDF_SCRYPT], "n": 2 ** cost})
+        return cls(kdf, {"iterations": cost * 1000})
+
+    def hash(self, password: str) -> dict:
+        """Données d'authentification d'un nouveau mot de passe."""
+        salt = os.urandom(SALT_SIZE)
+        return {"password_hash": _derive(password, self.kdf, salt, self.params).hex(),
+                "kdf": self.kdf,
+                "salt": salt.hex(),
+                "params": dict(self.params)}
+
+    @staticmethod
+    def verify(password: str, credentials: dict) -> bool:
+        """Indique si le mot de passe correspond aux données d'authentification."""
+        try:
+            kdf = credentials.get("kdf", KDF_LEGACY)
+            expected = bytes.fromhex(credentials["password_hash"])
+            salt = bytes.fromhex(credentials.get("salt", ""))
+            actual = _derive(password, kdf, salt, credentials.get("params", {}))
+        except (KeyError, TypeError, ValueError, MemoryError):
+            return False
+        return hmac.compare_digest(actual, expected)
+
+    def needs_upgrade(self, credentials: dict) -> bool:
+        """
+        Indique si l'empreinte a été calculée avec une autre fonction ou
+        d'autres paramètres que ceux du hacheur.
+        """
+        return (credentials.get("kdf", KDF_LEGACY) != self.kdf
+                or credentials.get("params") != self.params)
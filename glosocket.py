@@ -1,9 +1,29 @@
 """\
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
+
+Chaque trame débute par un mot de longueur de 4 octets. Ses deux bits de
+poids fort sont des drapeaux: CHUNK_FLAG marque un morceau d'un contenu en
+flux et COMPRESSED_FLAG une trame compressée, dont le premier octet
+identifie l'algorithme de compression.
 """
+import asyncio
 import socket
 import struct
+import zlib
+from typing import Callable, Iterator
+
+try:
+    import bz2
+except ImportError:
+    # Python builds without libbz2 simply do not offer this compression
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    # Same for builds without liblzma
+    lzma = None
 
 
 class GLOSocketError(Exception):
@@ -13,42 +33,396 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+RECV_CHUNK_SIZE = 1024 * 1024
+"""Taille maximale demandée à chaque appel à socket.recv_into."""
+
+CHUNK_FLAG = 0x80000000
+"""
+Bit du mot de longueur indiquant un morceau d'un contenu transmis en flux
+plutôt qu'un message. Un morceau vide termine le contenu.
+"""
+
+COMPRESSED_FLAG = 0x40000000
+"""Bit du mot de longueur indiquant une trame compressée."""
+
+LENGTH_MASK = 0x3FFFFFFF
+"""Bits du mot de longueur portant la longueur de la trame."""
+
+STREAM_CHUNK_SIZE = 64 * 1024
+"""Taille des morceaux envoyés par send_stream."""
+
+MAX_CHUNK_SIZE = RECV_CHUNK_SIZE
+"""Taille maximale acceptée pour un morceau reçu, une fois décompressé."""
+
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+"""
+Taille maximale acceptée pour un message reçu, telle qu'annoncée et une
+fois décompressé.
+"""
+
+COMPRESSION_THRESHOLD = 1024
+"""Taille en deçà de laquelle les trames ne sont pas compressées."""
+
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_BZ2 = "bz2"
+COMPRESSION_LZMA = "lzma"
+
+# Identifier written before the compressed data, compression function and
+# decompressor factory of each algorithm. Identifiers are part of the wire
+# format and must never be reused.
+_COMPRESSIONS: dict[str, tuple[int, Callable[[bytes], bytes], Callable]] = {
+    COMPRESSION_ZLIB: (1, lambda data: zlib.compress(data, 6), zlib.decompressobj),
+}
+if bz2 is not None:
+    _COMPRESSIONS[COMPRESSION_BZ2] = (2, lambda data: bz2.compress(data, 9),
+                                      bz2.BZ2Decompressor)
+if lzma is not None:
+    _COMPRESSIONS[COMPRESSION_LZMA] = (3, lambda data: lzma.compress(data, preset=1),
+                                       lzma.LZMADecompressor)
+_DECOMPRESSORS = {compression_id: decompressor
+                  for compression_id, _, decompressor in _COMPRESSIONS.values()}
+_DECOMPRESSION_ERRORS = (zlib.error, OSError, ValueError, EOFError) + (
+    (lzma.LZMAError,) if lzma is not None else ())
+
+SUPPORTED_COMPRESSIONS = [name for name in (COMPRESSION_ZLIB, COMPRESSION_LZMA,
+                                            COMPRESSION_BZ2)
+                          if name in _COMPRESSIONS]
+"""Algorithmes de compression disponibles, du plus rapide au plus lent."""
+
+
+def encode_frame(data: bytes, compression: str | None = None, chunk: bool = False) -> bytes:
+    """
+    Construit la trame d'un message, ou d'un morceau si `chunk` est vrai.
+
+    Avec un algorithme de `compression`, les données d'au moins
+    COMPRESSION_THRESHOLD octets sont compressées, à moins que cela ne les
+    réduise pas.
+    """
+    flags = CHUNK_FLAG if chunk else 0
+    if compression is not None and len(data) >= COMPRESSION_THRESHOLD:
+        try:
+            compression_id, compress, _ = _COMPRESSIONS[compression]
+        except KeyError as ex:
+            raise GLOSocketError(f"Unknown compression {compression}") from ex
+        compressed = compress(data)
+        if len(compressed) + 1 < len(data):
+            data = bytes((compression_id,)) + compressed
+            flags |= COMPRESSED_FLAG
+    if len(data) > LENGTH_MASK:
+        raise GLOSocketError("The data is too large for a single frame")
+    return struct.pack("!I", len(data) | flags) + data
+
+
+def _decompress(data: bytes | bytearray, max_size: int) -> bytes:
+    """Décompresse les données d'une trame compressée d'au plus `max_size` octets."""
+    decompressor = _DECOMPRESSORS.get(data[0]) if data else None
+    if decompressor is None:
+        raise GLOSocketError("Unknown compression of the received frame")
+    decompressor = decompressor()
+    try:
+        result = decompressor.decompress(memoryview(data)[1:], max_size + 1)
+    except _DECOMPRESSION_ERRORS as ex:
+        raise GLOSocketError("The received frame is corrupted") from ex
+    if len(result) > max_size or not decompressor.eof:
+        raise GLOSocketError("The received frame is corrupted or too large")
+    return result
+
+
+def _unpack_length(data_length: bytes) -> tuple[int, int]:
+    """Décode un mot de longueur: la longueur et les drapeaux de la trame."""
+    try:
+        length, = struct.unpack("!I", data_length)
+    except struct.error as ex:
+        raise GLOSocketError("The received data was"
+                             " not the message's length") from ex
+    return length & LENGTH_MASK, length & ~LENGTH_MASK
+
+
+def _check_compression(flags: int, compressed: bool) -> None:
+    """Vérifie qu'une trame n'est compressée que si la compression est permise."""
+    if flags & COMPRESSED_FLAG and not compressed:
+        raise GLOSocketError("Received a compressed frame without negotiated compression")
+
+
+def _check_message(length: int, flags: int, compressed: bool = True) -> None:
+    """
+    Vérifie que la trame annonce un message de taille acceptable, qui
+    n'est compressé que si `compressed` est vrai.
+    """
+    if flags & CHUNK_FLAG:
+        raise GLOSocketError("Received a chunk where a message was expected")
+    if length > MAX_MESSAGE_SIZE:
+        raise GLOSocketError("The received message is too large")
+    _check_compression(flags, compressed)
+
+
+def _check_chunk(length: int, flags: int, compressed: bool = True) -> None:
+    """
+    Vérifie que la trame annonce un morceau de taille acceptable, qui
+    n'est compressé que si `compressed` est vrai.
+    """
+    if not flags & CHUNK_FLAG:
+        raise GLOSocketError("Received a message where a chunk was expected")
+    if length > MAX_CHUNK_SIZE:
+        raise GLOSocketError("The received chunk is too large")
+    _check_compression(flags, compressed)
+
+
+def _recvall(source: socket.socket, size: int) -> bytes | bytearray:
     """
     Fonction utilitaire pour recv_mesg.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Tente de recevoir le message en un seul appel à socket.recv. Sinon,
+    alloue un tampon de la taille voulue et le remplit en appliquant
+    socket.recv_into en boucle jusqu'à la réception complète du message.
+
+    Lève une exception GLOSocketError si `size` dépasse MAX_MESSAGE_SIZE,
+    avant toute allocation.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    if size == 0:
+        return b""
+    if size > MAX_MESSAGE_SIZE:
+        raise GLOSocketError("The announced frame is too large")
+    try:
+        first = source.recv(min(size, RECV_CHUNK_SIZE))
+    except OSError as ex:
+        raise GLOSocketError("The source socket is closed.") from ex
+    if not first:
+        raise GLOSocketError("The other socket is closed.")
+    if len(first) == size:
+        return first
+
+    msg = bytearray(size)
+    view = memoryview(msg)
+    received = len(first)
+    view[:received] = first
+    while received < size:
+        chunk_size = min(size - received, RECV_CHUNK_SIZE)
         try:
-            buffer = source.recv(chunk_size)
+            nbytes = source.recv_into(view[received:], chunk_size)
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if not nbytes:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
+        received += nbytes
     return msg
 
 
-def send_mesg(dest_soc: socket.socket, message: str) -> None:
+def send_data(dest_soc: socket.socket, data: bytes,
+              compression: str | None = None) -> None:
     """
-    Encode le message puis le transmet à la destination.
+    Transmet un message déjà encodé à la destination, compressé avec
+    l'algorithme `compression` s'il est donné.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    frame = encode_frame(data, compression)
+    try:
+        dest_soc.sendall(frame)
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with socket") from ex
+
+
+def recv_data(source_soc: socket.socket, compressed: bool = True) -> bytes | bytearray:
+    """
+    Récupère un message de la source sans le décoder. Un message
+    compressé est décompressé; il est refusé si `compressed` est faux.
+
+    Lève une exception GLOSocketError en cas de problème de communication
+    ou si le message dépasse MAX_MESSAGE_SIZE octets.
+    """
+    length, flags = _unpack_length(_recvall(source_soc, 4))
+    _check_message(length, flags, compressed)
+    data = _recvall(source_soc, length)
+    if flags & COMPRESSED_FLAG:
+        return _decompress(data, MAX_MESSAGE_SIZE)
+    return data
+
+
+def send_chunk(dest_soc: socket.socket, data: bytes,
+               compression: str | None = None) -> None:
+    """
+    Transmet un morceau d'un contenu en flux à la destination. Un morceau
+    vide termine le contenu.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    frame = encode_frame(data, compression, chunk=True)
     try:
-        dest_soc.sendall(data_length + data)
+        dest_soc.sendall(frame)
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
+def send_stream(dest_soc: socket.socket, data: bytes,
+                compression: str | None = None) -> None:
+    """
+    Transmet un contenu déjà en mémoire en morceaux de STREAM_CHUNK_SIZE
+    octets, suivis du morceau vide final.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    view = memoryview(data)
+    for start in range(0, len(view), STREAM_CHUNK_SIZE):
+        send_chunk(dest_soc, view[start:start + STREAM_CHUNK_SIZE].tobytes(), compression)
+    send_chunk(dest_soc, b"")
+
+
+def recv_chunk(source_soc: socket.socket, compressed: bool = True) -> bytes | bytearray:
+    """
+    Récupère un morceau d'un contenu en flux, vide à la fin du contenu. Un
+    morceau compressé est refusé si `compressed` est faux.
+
+    Lève une exception GLOSocketError en cas de problème de communication
+    ou si la source n'envoie pas un morceau.
+    """
+    length, flags = _unpack_length(_recvall(source_soc, 4))
+    _check_chunk(length, flags, compressed)
+    data = _recvall(source_soc, length)
+    if flags & COMPRESSED_FLAG:
+        return _decompress(data, MAX_CHUNK_SIZE)
+    return data
+
+
+def iter_chunks(source_soc: socket.socket) -> Iterator[bytes | bytearray]:
+    """Parcourt les morceaux d'un contenu en flux jusqu'au morceau vide final."""
+    return iter(lambda: recv_chunk(source_soc), b"")
+
+
+class FrameDecoder:
+    """
+    Décodeur incrémental des trames reçues d'une connexion.
+
+    Les octets reçus sont fournis à `feed` dans l'ordre, en morceaux de
+    taille quelconque. `next_message` et `next_chunk` retournent ensuite
+    les trames complètes une à une, décompressées, et conservent les
+    octets d'une trame incomplète jusqu'à la réception de la suite.
+
+    Le décodeur ne lit rien lui-même: il convient à toute boucle
+    d'événements, qui lui fournit ce que le socket a reçu sans bloquer.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        # Start of the first frame not yet returned in the buffer
+        self._start = 0
+        # Progress of has_streams, relative to the start: end of the frames
+        # already scanned and number of contents they complete
+        self._scanned = 0
+        self._scanned_streams = 0
+
+    def __len__(self) -> int:
+        """Nombre d'octets reçus qui ne font pas partie d'une trame retournée."""
+        return len(self._buffer) - self._start
+
+    def feed(self, data: bytes) -> None:
+        """Ajoute les octets reçus à la suite des précédents."""
+        if self._start and self._start >= len(self._buffer) // 2:
+            # Drop the returned frames once they are half of the buffer
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+    def _header(self) -> tuple[int, int] | None:
+        """Longueur et drapeaux de la trame suivante, None s'ils ne sont pas reçus."""
+        if len(self) < 4:
+            return None
+        return _unpack_length(self._buffer[self._start:self._start + 4])
+
+    def has_frame(self) -> bool:
+        """Indique si une trame complète est prête."""
+        header = self._header()
+        return header is not None and len(self) >= 4 + header[0]
+
+    def has_streams(self, count: int) -> bool:
+        """
+        Indique si les `count` contenus en flux qui suivent sont entièrement
+        reçus, jusqu'à leur morceau vide final.
+
+        Lève une exception GLOSocketError si l'une des trames qui suivent
+        n'est pas un morceau valide.
+        """
+        while self._scanned_streams < count:
+            position = self._start + self._scanned
+            if len(self._buffer) - position < 4:
+                return False
+            length, flags = _unpack_length(self._buffer[position:position + 4])
+            _check_chunk(length, flags)
+            if len(self._buffer) - position < 4 + length:
+                return False
+            self._scanned += 4 + length
+            if not length:
+                self._scanned_streams += 1
+        return True
+
+    def skip_chunks(self) -> None:
+        """Écarte les morceaux complets qui suivent, restés sans lecteur."""
+        while self.has_frame() and self._header()[1] & CHUNK_FLAG:
+            self._start += 4 + self._header()[0]
+            self._scanned = self._scanned_streams = 0
+
+    def _next(self, chunk: bool, compressed: bool) -> bytes | None:
+        """
+        Trame suivante, qui doit être un morceau si `chunk` est vrai et ne
+        peut être compressée que si `compressed` est vrai.
+        """
+        header = self._header()
+        if header is None:
+            return None
+        length, flags = header
+        if chunk:
+            _check_chunk(length, flags, compressed)
+        else:
+            _check_message(length, flags, compressed)
+        if len(self) < 4 + length:
+            return None
+        start = self._start + 4
+        data = bytes(self._buffer[start:start + length])
+        self._start = start + length
+        self._scanned = self._scanned_streams = 0
+        if flags & COMPRESSED_FLAG:
+            return _decompress(data, MAX_CHUNK_SIZE if chunk else MAX_MESSAGE_SIZE)
+        return data
+
+    def next_message(self, compressed: bool = True) -> bytes | None:
+        """
+        Récupère le message suivant, sans le décoder, ou None s'il n'est
+        pas encore complet. Un message compressé est refusé si
+        `compressed` est faux.
+
+        Lève une exception GLOSocketError si la trame suivante n'est pas un
+        message valide; la taille d'un message est vérifiée dès la
+        réception de son mot de longueur.
+        """
+        return self._next(False, compressed)
+
+    def next_chunk(self, compressed: bool = True) -> bytes | None:
+        """
+        Récupère le morceau suivant d'un contenu en flux, vide à la fin du
+        contenu, ou None s'il n'est pas encore complet. Un morceau
+        compressé est refusé si `compressed` est faux.
+
+        Lève une exception GLOSocketError si la trame suivante n'est pas un
+        morceau valide; la taille d'un morceau est vérifiée dès la
+        réception de son mot de longueur.
+        """
+        return self._next(True, compressed)
+
+
+def send_mesg(dest_soc: socket.socket, message: str,
+              compression: str | None = None) -> None:
+    """
+    Encode le message puis le transmet à la destination.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    send_data(dest_soc, message.encode(encoding='utf-8'), compression)
+
+
 def recv_mesg(source_soc: socket.socket) -> str:
     """
     Récupère un message de la source et le décode.
@@ -56,12 +430,76 @@ def recv_mesg(source_soc: socket.socket) -> str:
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data_length = _recvall(source_soc, 4)
+    return recv_data(source_soc).decode('utf-8')
+
+
+async def async_send_data(writer: asyncio.StreamWriter, data: bytes,
+                          compression: str | None = None) -> None:
+    """
+    Équivalent de send_data pour les flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    frame = encode_frame(data, compression)
     try:
-        length, = struct.unpack("!I", data_length)
-    except struct.error as ex:
-        raise GLOSocketError("The received data was"
-                             " not the message's length") from ex
+        writer.write(frame)
+        await writer.drain()
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with stream") from ex
 
-    data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+
+async def async_recv_data(reader: asyncio.StreamReader, compressed: bool = True) -> bytes:
+    """
+    Équivalent de recv_data pour les flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème de communication
+    ou si le message dépasse MAX_MESSAGE_SIZE octets.
+    """
+    try:
+        length, flags = _unpack_length(await reader.readexactly(4))
+        _check_message(length, flags, compressed)
+        data = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    except OSError as ex:
+        raise GLOSocketError("The source stream is closed.") from ex
+    if flags & COMPRESSED_FLAG:
+        return _decompress(data, MAX_MESSAGE_SIZE)
+    return data
+
+
+async def async_send_chunk(writer: asyncio.StreamWriter, data: bytes,
+                           compression: str | None = None) -> None:
+    """
+    Équivalent de send_chunk pour les flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    frame = encode_frame(data, compression, chunk=True)
+    try:
+        writer.write(frame)
+        await writer.drain()
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with stream") from ex
+
+
+async def async_recv_chunk(reader: asyncio.StreamReader, compressed: bool = True) -> bytes:
+    """
+    Équivalent de recv_chunk pour les flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    try:
+        length, flags = _unpack_length(await reader.readexactly(4))
+        _check_chunk(length, flags, compressed)
+        data = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    except OSError as ex:
+        raise GLOSocketError("The source stream is closed.") from ex
+    if flags & COMPRESSED_FLAG:
+        return _decompress(data, MAX_CHUNK_SIZE)
+    return data
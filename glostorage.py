@@ -0,0 +1,1626 @@
+"""\
+Module fournissant le stockage des comptes et des courriels du serveur.
+
+L'interface `MailboxStorage` regroupe tous les accès au stockage faits par
+le serveur. Deux moteurs l'implémentent:
+- `DirectoryStorage`, un dossier par utilisateur sous SERVER_DATA_DIR
+  contenant le fichier `pass`, un fichier JSON par courriel, l'index des
+  entêtes et les compteurs de statistiques;
+- `SegmentStorage`, la même arborescence, mais dont les courriels sont
+  ajoutés compressés à des fichiers segments de chaque dossier;
+- `SQLiteStorage`, un seul fichier de base de données SQLite.
+
+Chaque moteur tient aussi un index inversé des mots des courriels de
+chaque compte, mis à jour à chaque livraison, sur lequel s'appuie
+`MailboxStorage.search`.
+
+Les courriels reçus en flux (voir gloutils.StreamedEmailPayload) gardent
+leurs entêtes dans le fichier ou la table des courriels, alors que leur
+corps et leurs pièces jointes sont écrits au fur et à mesure de leur
+réception, dans un fichier BLOB_SUFFIX ou la table `chunks`.
+
+Exécuté comme script, le module migre un dossier de données existant vers
+une base SQLite.
+"""
+import abc
+import argparse
+import collections
+import contextlib
+import datetime
+import functools
+import itertools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from typing import Callable, Hashable, Iterator
+
+try:
+    import fcntl
+except ImportError:
+    # No inter-process locking on platforms without fcntl (Windows),
+    # where the multi-process mode is not available anyway
+    fcntl = None
+
+import gloutils
+
+NAME_PATTERN = re.compile(r"[a-zA-Z0-9_\.-]+")
+# Time-ordered mail ids: arrival time in nanoseconds, process id and a
+# per-process sequence number, all fixed width so the names sort by arrival
+TIMED_MAIL_ID_PATTERN = re.compile(r"mail-(\d{20})-\d{7}-\d{6}")
+# Suffix of the file holding the body and attachments of a streamed mail
+BLOB_SUFFIX = ".blob"
+STREAM_READ_SIZE = 64 * 1024
+# Append-only segment files of SegmentStorage, numbered in creation order
+SEGMENT_SUFFIX = ".seg"
+SEGMENT_PATTERN = re.compile(r"segment-(\d{6})" + re.escape(SEGMENT_SUFFIX))
+SEGMENT_MAX_SIZE = 16 * 1024 * 1024
+# Folders whose inverted index a process keeps in memory, the least
+# recently searched being evicted first
+SEARCH_CACHE_FOLDERS = 64
+# Width the counters of a folder are padded to, so that they are rewritten
+# in place over the previous ones
+STATS_WIDTH = 64
+# Words of at least two characters, once lowercased and stripped of accents
+_TERM_PATTERN = re.compile(r"\w{2,}")
+_COMBINING_PATTERN = re.compile(r"[\u0300-\u036f]")
+
+_mail_id_guard = threading.Lock()
+_mail_id_sequence = itertools.count()
+_last_mail_timestamp = 0
+
+
+def new_mail_id() -> str:
+    """
+    Génère un identifiant de courriel unique, croissant avec l'heure
+    d'arrivée au sein d'un processus.
+    """
+    global _last_mail_timestamp
+    with _mail_id_guard:
+        timestamp = max(time.time_ns(), _last_mail_timestamp + 1)
+        _last_mail_timestamp = timestamp
+        sequence = next(_mail_id_sequence) % 1_000_000
+    return f"mail-{timestamp:020d}-{os.getpid() % 10_000_000:07d}-{sequence:06d}"
+
+
+def arrival_time(mail_id: str, date: str) -> int:
+    """
+    Heure d'arrivée d'un courriel en nanosecondes.
+
+    Elle est lue dans l'identifiant du courriel; seuls les anciens
+    courriels, aux noms aléatoires, nécessitent de lire la date.
+    """
+    match = TIMED_MAIL_ID_PATTERN.fullmatch(mail_id)
+    if match:
+        return int(match.group(1))
+    try:
+        parsed = datetime.datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %z")
+    except (TypeError, ValueError):
+        return 0
+    return int(parsed.timestamp()) * 1_000_000_000
+
+
+def mail_size(payload: gloutils.EmailContentPayload) -> int:
+    """Taille d'un courriel, celle de sa représentation JSON."""
+    return len(json.dumps(payload).encode('utf-8'))
+
+
+def search_terms(text: str) -> list[str]:
+    """
+    Termes de recherche d'un texte: ses mots d'au moins deux caractères,
+    en minuscules et sans accents, sans doublons.
+    """
+    text = _COMBINING_PATTERN.sub("", unicodedata.normalize("NFKD", text.casefold()))
+    return list(dict.fromkeys(_TERM_PATTERN.findall(text)))
+
+
+def mail_terms(payload: gloutils.EmailContentPayload) -> list[str]:
+    """Termes indexés d'un courriel: ceux de son expéditeur, de son sujet et de son corps."""
+    return search_terms(" ".join((payload["sender"], payload["subject"], payload["content"])))
+
+
+def _day_start(day: datetime.date) -> int:
+    """Début d'un jour UTC en nanosecondes, à comparer à arrival_time."""
+    start = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+    return int(start.timestamp()) * 1_000_000_000
+
+
+def stream_metadata(payload: gloutils.StreamedEmailPayload,
+                    sizes: list[int]) -> gloutils.StreamedEmailPayload:
+    """
+    Entêtes conservés d'un courriel reçu en flux, avec la taille du corps
+    et de chaque pièce jointe, `sizes` dans l'ordre du flux.
+    """
+    attachments = [gloutils.AttachmentInfo(name=attachment["name"], size=size)
+                   for attachment, size in zip(payload.get("attachments", []), sizes[1:])]
+    return gloutils.StreamedEmailPayload(sender=payload["sender"],
+                                         destination=payload["destination"],
+                                         subject=payload["subject"],
+                                         date=payload["date"],
+                                         content="",
+                                         streamed=True,
+                                         content_size=sizes[0],
+                                         attachments=attachments)
+
+
+class MailboxStorage(abc.ABC):
+    """
+    Interface du stockage des comptes et des courriels.
+
+    Les noms d'utilisateurs sont ceux des comptes, en majuscules. Les
+    entêtes de courriels sont des dictionnaires avec les clés `id`,
+    `sender`, `subject`, `date` et `size`.
+    """
+
+    @abc.abstractmethod
+    def user_exists(self, username: str) -> bool:
+        """Indique si le compte existe."""
+
+    @abc.abstractmethod
+    def create_user(self, username: str, credentials: dict) -> bool:
+        """
+        Crée le compte avec ses données d'authentification.
+
+        Retourne False si le compte existe déjà.
+        """
+
+    @abc.abstractmethod
+    def get_credentials(self, username: str) -> dict | None:
+        """Données d'authentification du compte, None s'il n'existe pas."""
+
+    @abc.abstractmethod
+    def update_credentials(self, username: str, credentials: dict) -> None:
+        """Remplace les données d'authentification d'un compte existant."""
+
+    @abc.abstractmethod
+    def mailbox_version(self, username: str) -> Hashable:
+        """
+        Jeton peu coûteux qui change à chaque livraison dans la boîte du
+        compte, None s'il ne peut être déterminé.
+        """
+
+    @abc.abstractmethod
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: int | None = None) -> tuple[list[dict], int]:
+        """
+        Entêtes des courriels du compte, du plus récent au plus ancien,
+        à partir de la position `offset` et au plus `limit`.
+
+        Retourne aussi le nombre total de courriels du compte.
+        """
+
+    @abc.abstractmethod
+    def get_mail(self, username: str, mail_id: str
+                 ) -> gloutils.EmailContentPayload | None:
+        """Contenu d'un courriel du compte, None s'il n'existe pas."""
+
+    @abc.abstractmethod
+    def get_stats(self, username: str) -> gloutils.StatsPayload:
+        """
+        Nombre de courriels du compte et taille totale de ses courriels et
+        de ses données d'authentification.
+        """
+
+    @abc.abstractmethod
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                mail_id: str | None = None) -> str:
+        """
+        Livre un courriel dans la boîte du compte et retourne son
+        identifiant. Un identifiant est généré si `mail_id` est omis.
+        """
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     mail_id: str | None = None) -> str:
+        """
+        Livre un même courriel dans la boîte de chaque compte, une seule
+        fois par compte, sous un même identifiant qui est retourné.
+        """
+        mail_id = mail_id or new_mail_id()
+        for username in dict.fromkeys(usernames):
+            self.deliver(username, payload, mail_id)
+        return mail_id
+
+    @abc.abstractmethod
+    def deliver_stream(self, usernames: list[str], payload: gloutils.StreamedEmailPayload,
+                       recv_chunk: Callable[[], bytes], lost: bool = False,
+                       mail_id: str | None = None) -> str:
+        """
+        Livre un courriel reçu en flux dans la boîte de chaque compte et,
+        si `lost` est vrai, parmi les courriels perdus. Retourne son
+        identifiant.
+
+        `recv_chunk` retourne les morceaux du corps puis de chaque pièce
+        jointe de `payload`, un morceau vide terminant chaque partie. Les
+        morceaux sont écrits à mesure qu'ils sont reçus, le contenu n'est
+        jamais entièrement en mémoire.
+        """
+
+    @abc.abstractmethod
+    def read_stream(self, username: str, mail_id: str) -> Iterator[bytes]:
+        """
+        Parcourt par morceaux le corps puis chaque pièce jointe d'un
+        courriel reçu en flux, un morceau vide terminant chaque partie.
+        """
+
+    @abc.abstractmethod
+    def search_ids(self, username: str, terms: list[str]) -> set[str]:
+        """
+        Identifiants des courriels du compte contenant tous les termes
+        `terms`, tels que retournés par search_terms, lus dans l'index
+        inversé du compte.
+        """
+
+    def search(self, username: str, query: str = "", sender: str = "",
+               since: datetime.date | None = None,
+               until: datetime.date | None = None) -> list[dict]:
+        """
+        Entêtes des courriels du compte, du plus récent au plus ancien, qui
+        contiennent tous les mots de `query`, dont l'expéditeur contient
+        `sender` et qui sont arrivés entre les jours `since` et `until`
+        inclusivement (UTC).
+
+        Seuls les entêtes des courriels reçus en flux sont indexés.
+        """
+        entries = self._matching_headers(username, search_terms(query))
+        if sender:
+            sender = sender.casefold()
+            entries = [entry for entry in entries if sender in entry["sender"].casefold()]
+        if since is not None or until is not None:
+            start = 0 if since is None else _day_start(since)
+            end = (float("inf") if until is None
+                   else _day_start(until + datetime.timedelta(days=1)))
+            entries = [entry for entry in entries
+                       if start <= arrival_time(entry["id"], entry["date"]) < end]
+        return entries
+
+    def _matching_headers(self, username: str, terms: list[str]) -> list[dict]:
+        """
+        Entêtes des courriels du compte contenant tous les termes, du plus
+        récent au plus ancien; tous les entêtes si `terms` est vide.
+        """
+        entries, _ = self.list_headers(username)
+        if terms:
+            ids = self.search_ids(username, terms)
+            entries = [entry for entry in entries if entry["id"] in ids]
+        return entries
+
+    @abc.abstractmethod
+    def store_lost(self, payload: gloutils.EmailContentPayload,
+                   mail_id: str | None = None) -> str:
+        """
+        Conserve un courriel sans destinataire valide et retourne son
+        identifiant. Un identifiant est généré si `mail_id` est omis.
+        """
+
+    @abc.abstractmethod
+    def iter_lost(self) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        """Parcourt les identifiants et contenus des courriels perdus."""
+
+    @abc.abstractmethod
+    def read_lost_stream(self, mail_id: str) -> Iterator[bytes]:
+        """
+        Parcourt par morceaux, comme read_stream, le contenu d'un courriel
+        perdu reçu en flux.
+        """
+
+    @abc.abstractmethod
+    def verify_stats(self) -> list[tuple[str, dict | None, dict]]:
+        """
+        Recalcule les compteurs de chaque compte et corrige ceux qui
+        divergent.
+
+        Retourne, pour chaque compte corrigé, son nom, les compteurs
+        trouvés et les compteurs recalculés.
+        """
+
+    @abc.abstractmethod
+    def users(self) -> list[str]:
+        """Noms de tous les comptes."""
+
+    @abc.abstractmethod
+    def iter_mails(self, username: str
+                   ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        """Parcourt les identifiants et contenus des courriels d'un compte."""
+
+    def close(self) -> None:
+        """Libère les ressources du stockage."""
+
+
+class DirectoryStorage(MailboxStorage):
+    """
+    Stockage dans un dossier par utilisateur.
+
+    Chaque dossier contient le fichier PASSWORD_FILENAME, un fichier JSON
+    par courriel nommé par son identifiant, l'index des entêtes
+    INDEX_FILENAME et les compteurs STATS_FILENAME. Les courriels perdus
+    sont placés dans le dossier SERVER_LOST_DIR.
+
+    L'index des entêtes reçoit, à chaque livraison, une ligne JSON avec
+    l'entrée du courriel; il n'est réécrit en entier que pour être
+    reconstruit ou compacté. Les compteurs sont réécrits sur place.
+
+    L'index inversé SEARCH_FILENAME reçoit, à chaque livraison, une ligne
+    avec l'identifiant du courriel et ses termes; chaque processus le
+    relit à partir de la dernière position lue et garde en mémoire ceux
+    des SEARCH_CACHE_FOLDERS derniers dossiers consultés.
+    """
+
+    def __init__(self, root: str = gloutils.SERVER_DATA_DIR) -> None:
+        """S'assure que les dossiers de données existent."""
+        self._root = root
+        # One lock per mailbox folder, shared by every thread of the process,
+        # and the nesting depth of each held lock
+        self._locks: dict[str, threading.RLock] = {}
+        self._lock_depths: dict[str, int] = {}
+        self._locks_guard = threading.Lock()
+        # Postings read from the inverted index of the last searched folders,
+        # with the inode of the index and the position read up to, and one
+        # lock per folder serializing the reads of its index
+        self._search_cache: collections.OrderedDict[
+            str, tuple[int, int, dict[str, set[str]]]] = collections.OrderedDict()
+        self._search_locks: dict[str, threading.Lock] = {}
+        self._search_guard = threading.Lock()
+
+        os.makedirs(self._root + "/" + gloutils.SERVER_LOST_DIR, exist_ok=True)
+
+    def _folder(self, username: str) -> str | None:
+        """Dossier d'un utilisateur, None si le nom n'est pas valide."""
+        if (not NAME_PATTERN.fullmatch(username) or username.startswith(".")
+                or username == gloutils.SERVER_LOST_DIR):
+            return None
+        return self._root + "/" + username
+
+    @staticmethod
+    def _is_mail_file(file_name: str) -> bool:
+        """Indique si le fichier du dossier utilisateur est un courriel."""
+        return (file_name not in (gloutils.PASSWORD_FILENAME, gloutils.INDEX_FILENAME,
+                                  gloutils.STATS_FILENAME, gloutils.SEARCH_FILENAME)
+                and not file_name.startswith(".")
+                and not file_name.endswith((BLOB_SUFFIX, SEGMENT_SUFFIX)))
+
+    @staticmethod
+    def _blob_size(folder: str, mail_id: str) -> int:
+        """Taille du contenu d'un courriel reçu en flux, 0 pour les autres."""
+        try:
+            return os.path.getsize(folder + "/" + mail_id + BLOB_SUFFIX)
+        except FileNotFoundError:
+            return 0
+
+    def _stored_size(self, folder: str, mail_id: str) -> int:
+        """Taille d'un courriel sur le disque, contenu reçu en flux compris."""
+        return os.path.getsize(folder + "/" + mail_id) + self._blob_size(folder, mail_id)
+
+    @staticmethod
+    def _arrival_key(entry: dict) -> int:
+        """
+        Clé de tri d'une entrée d'index: l'opposé de l'heure d'arrivée,
+        pour obtenir un ordre du plus récent au plus ancien.
+        """
+        return -arrival_time(entry["id"], entry.get("date"))
+
+    @contextlib.contextmanager
+    def _mailbox_lock(self, folder: str):
+        """
+        Verrouille un dossier utilisateur le temps d'une livraison ou d'une
+        reconstruction de ses métadonnées.
+
+        Le verrou exclut les autres fils du processus et, avec un verrou
+        fcntl sur le fichier `.lock` du dossier, les autres processus.
+        """
+        with self._locks_guard:
+            lock = self._locks.setdefault(folder, threading.RLock())
+        with lock:
+            depth = self._lock_depths.get(folder, 0)
+            lock_fd = None
+            if depth == 0 and fcntl is not None:
+                lock_fd = os.open(folder + "/.lock", os.O_RDWR | os.O_CREAT)
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self._lock_depths[folder] = depth + 1
+            try:
+                yield
+            finally:
+                self._lock_depths[folder] = depth
+                if lock_fd is not None:
+                    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                    os.close(lock_fd)
+
+    @staticmethod
+    def _write_synced(path: str, data: bytes) -> None:
+        """Écrit un fichier et attend qu'il soit sur le disque."""
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_mail(self, folder: str, mail_id: str, data: bytes) -> None:
+        """
+        Écrit un courriel sérialisé dans un nouveau fichier du dossier.
+
+        Le courriel est d'abord écrit dans un fichier temporaire puis renommé,
+        de sorte qu'un arrêt brutal ne laisse jamais de courriel tronqué.
+        """
+        tmp_path = folder + "/." + mail_id + ".tmp"
+        self._write_synced(tmp_path, data)
+        os.replace(tmp_path, folder + "/" + mail_id)
+
+    def _encode_mail(self, mail_id: str, payload: gloutils.EmailContentPayload) -> bytes:
+        """Sérialise un courriel tel qu'il est écrit par _place_mail."""
+        return json.dumps(payload).encode('utf-8')
+
+    def _place_mail(self, folder: str, mail_id: str, data: bytes) -> dict:
+        """
+        Range un courriel sérialisé par _encode_mail dans le dossier.
+
+        Retourne les champs d'emplacement à ajouter à son entrée d'index,
+        aucun pour un fichier par courriel.
+        """
+        self._write_mail(folder, mail_id, data)
+        return {}
+
+    def _link_blob(self, blob_path: str, folder: str, mail_id: str) -> None:
+        """
+        Place le contenu d'un courriel reçu en flux dans le dossier, avec un
+        lien physique ou, à défaut, une copie.
+        """
+        path = folder + "/" + mail_id + BLOB_SUFFIX
+        try:
+            os.link(blob_path, path)
+        except OSError:
+            tmp_path = folder + "/." + mail_id + BLOB_SUFFIX + ".tmp"
+            shutil.copyfile(blob_path, tmp_path)
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def _write_json(folder: str, file_name: str, data: dict) -> None:
+        """Écrit un fichier de métadonnées du dossier de façon atomique."""
+        tmp_path = f"{folder}/.{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, folder + "/" + file_name)
+
+    def _scan_mails(self, folder: str) -> list[dict]:
+        """Entrées d'index des courriels lisibles du dossier, dans le désordre."""
+        entries = []
+        for file in os.listdir(folder):
+            if not self._is_mail_file(file):
+                continue
+            path = folder + "/" + file
+            try:
+                with open(path, 'r') as f:
+                    mail = json.load(f)
+                entries.append({"id": file,
+                                "sender": mail["sender"],
+                                "subject": mail["subject"],
+                                "date": mail["date"],
+                                "size": self._stored_size(folder, file)})
+            except (OSError, ValueError, KeyError, TypeError):
+                # Unreadable mail, leave it out of the index
+                continue
+        return entries
+
+    @staticmethod
+    def _write_index(folder: str, entries: list[dict]) -> None:
+        """
+        Réécrit l'index des entêtes d'un dossier de façon atomique, une
+        ligne par entrée, de la plus ancienne à la plus récente.
+        """
+        tmp_path = (f"{folder}/.{gloutils.INDEX_FILENAME}.{os.getpid()}"
+                    f".{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w') as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in reversed(entries))
+        os.replace(tmp_path, folder + "/" + gloutils.INDEX_FILENAME)
+
+    def _rebuild_index(self, folder: str) -> list[dict]:
+        """
+        Reconstruit l'index des entêtes d'un dossier à partir des fichiers
+        de courriels, l'écrit sur le disque et le retourne.
+        """
+        entries = self._scan_mails(folder)
+        entries.sort(key=self._arrival_key)
+        self._write_index(folder, entries)
+        return entries
+
+    def _load_index(self, folder: str) -> tuple[list[dict], bool]:
+        """
+        Lit l'index des entêtes d'un dossier, trié du plus récent au plus
+        ancien, et indique s'il doit être compacté: s'il répète un courriel
+        ou a été écrit d'un bloc par une version précédente.
+
+        Lève OSError, ValueError, KeyError ou TypeError si l'index est
+        absent ou corrompu.
+        """
+        with open(folder + "/" + gloutils.INDEX_FILENAME, 'rb') as f:
+            data = f.read()
+        legacy = data.startswith(b'{"entries"')
+        text = data.decode('utf-8')
+        end = 0
+        if legacy:
+            # Deliveries may have appended lines after the document
+            document, end = json.JSONDecoder().raw_decode(text)
+        # Appended from the oldest to the newest, give or take the order in
+        # which concurrent deliveries took the mailbox lock
+        entries = [json.loads(line) for line in reversed(text[end:].splitlines())]
+        if legacy:
+            entries += document["entries"]
+        if not all(isinstance(entry, dict)
+                   and {"id", "sender", "subject", "date", "size"} <= entry.keys()
+                   for entry in entries):
+            raise ValueError("Corrupted index")
+        unique = list({entry["id"]: entry for entry in entries}.values())
+        # Nearly sorted already, the sort is close to linear
+        unique.sort(key=self._arrival_key)
+        return unique, legacy or len(unique) < len(entries)
+
+    def _read_index(self, folder: str) -> list[dict]:
+        """
+        Lit l'index des entêtes d'un dossier, trié du plus récent au plus
+        ancien. L'index est reconstruit s'il est absent ou corrompu, et
+        compacté s'il le faut.
+        """
+        try:
+            entries, compact = self._load_index(folder)
+            if compact:
+                with self._mailbox_lock(folder):
+                    # Read again, a delivery may have appended to it meanwhile
+                    entries, _ = self._load_index(folder)
+                    self._write_index(folder, entries)
+        except (OSError, ValueError, KeyError, TypeError):
+            with self._mailbox_lock(folder):
+                entries = self._rebuild_index(folder)
+        return entries
+
+    def _add_to_index(self, folder: str, mail_id: str,
+                      payload: gloutils.EmailContentPayload, size: int,
+                      location: dict | None = None) -> None:
+        """
+        Ajoute une ligne avec les entêtes d'un courriel livré à la fin de
+        l'index du dossier, avec les champs d'emplacement retournés par
+        _place_mail, sans relire l'index.
+        """
+        path = folder + "/" + gloutils.INDEX_FILENAME
+        if not os.path.exists(path):
+            # Rebuilt from the mails, the new one included
+            self._rebuild_index(folder)
+            return
+        entry = {"id": mail_id,
+                 "sender": payload["sender"],
+                 "subject": payload["subject"],
+                 "date": payload["date"],
+                 "size": size,
+                 **(location or {})}
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _stored_sizes(self, folder: str) -> dict[str, int]:
+        """Taille sur le disque de chaque courriel du dossier."""
+        return {file: self._stored_size(folder, file)
+                for file in os.listdir(folder) if self._is_mail_file(file)}
+
+    def _compute_stats(self, folder: str) -> dict:
+        """Recalcule les compteurs d'un dossier à partir des fichiers."""
+        sizes = self._stored_sizes(folder)
+        return {"count": len(sizes), "size": sum(sizes.values())}
+
+    @staticmethod
+    def _load_stats(folder: str) -> dict | None:
+        """Charge les compteurs d'un dossier, ou None s'ils sont absents ou corrompus."""
+        try:
+            with open(folder + "/" + gloutils.STATS_FILENAME, 'r') as f:
+                stats = json.load(f)
+            if not (isinstance(stats["count"], int) and isinstance(stats["size"], int)):
+                raise ValueError("Corrupted stats")
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return stats
+
+    def _add_to_stats(self, folder: str, size: int) -> None:
+        """
+        Compte un courriel livré de `size` octets dans les compteurs, qui
+        sont réécrits sur place plutôt que dans un nouveau fichier.
+        """
+        stats = self._load_stats(folder)
+        if stats is None:
+            # Recomputed from the disk, the new mail is already counted
+            stats = self._compute_stats(folder)
+        else:
+            stats["count"] += 1
+            stats["size"] += size
+        # Padded with whitespace, which JSON ignores, to cover the previous
+        # counters whatever their length
+        data = json.dumps(stats).ljust(STATS_WIDTH).encode('utf-8')
+        fd = os.open(folder + "/" + gloutils.STATS_FILENAME, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _add_to_search(folder: str, mail_id: str,
+                       payload: gloutils.EmailContentPayload) -> None:
+        """
+        Ajoute les termes d'un courriel livré à l'index inversé du dossier.
+        Un index absent n'est pas créé: il sera reconstruit au complet par
+        la première recherche.
+        """
+        line = f"{mail_id}\t{' '.join(mail_terms(payload))}\n".encode('utf-8')
+        try:
+            fd = os.open(folder + "/" + gloutils.SEARCH_FILENAME, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _record_delivery(self, folder: str, mail_id: str,
+                         payload: gloutils.EmailContentPayload, size: int,
+                         location: dict | None = None) -> None:
+        """
+        Met l'index des entêtes, les compteurs et l'index inversé du dossier
+        à jour après la livraison d'un courriel.
+        """
+        self._add_to_index(folder, mail_id, payload, size, location)
+        self._add_to_stats(folder, size)
+        self._add_to_search(folder, mail_id, payload)
+
+    def _rebuild_search(self, username: str) -> None:
+        """Reconstruit l'index inversé d'un dossier à partir de ses courriels."""
+        folder = self._folder(username)
+        data = "".join(f"{mail_id}\t{' '.join(mail_terms(mail))}\n"
+                       for mail_id, mail in self.iter_mails(username))
+        tmp_path = f"{folder}/.{gloutils.SEARCH_FILENAME}.{os.getpid()}.tmp"
+        self._write_synced(tmp_path, data.encode('utf-8'))
+        os.replace(tmp_path, folder + "/" + gloutils.SEARCH_FILENAME)
+
+    def user_exists(self, username: str) -> bool:
+        folder = self._folder(username)
+        return folder is not None and os.path.isdir(folder)
+
+    def create_user(self, username: str, credentials: dict) -> bool:
+        folder = self._folder(username)
+        if folder is None:
+            return False
+        try:
+            os.makedirs(folder)
+        except FileExistsError:
+            return False
+        # The inverted index of a new mailbox is kept up to date from the start
+        open(folder + "/" + gloutils.SEARCH_FILENAME, 'wb').close()
+        self._write_json(folder, gloutils.PASSWORD_FILENAME, credentials)
+        return True
+
+    def get_credentials(self, username: str) -> dict | None:
+        folder = self._folder(username)
+        if folder is None:
+            return None
+        try:
+            with open(folder + "/" + gloutils.PASSWORD_FILENAME, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Unknown account, or still being created by another worker
+            return None
+
+    def update_credentials(self, username: str, credentials: dict) -> None:
+        folder = self._folder(username)
+        if folder is not None and os.path.isdir(folder):
+            self._write_json(folder, gloutils.PASSWORD_FILENAME, credentials)
+
+    def mailbox_version(self, username: str) -> Hashable:
+        # Every delivery appends to the index, a compaction replaces it
+        try:
+            index = os.stat(self._folder(username) + "/" + gloutils.INDEX_FILENAME)
+        except (OSError, TypeError):
+            return None
+        return index.st_ino, index.st_mtime_ns, index.st_size
+
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: int | None = None) -> tuple[list[dict], int]:
+        entries = self._read_index(self._folder(username))
+        end = None if limit is None else offset + limit
+        return entries[offset:end], len(entries)
+
+    def _read_mail_file(self, folder: str, mail_id: str
+                        ) -> gloutils.EmailContentPayload | None:
+        """Contenu du fichier d'un courriel du dossier, None s'il est absent ou illisible."""
+        # Make sure the id can only designate a mail of this folder
+        if not (NAME_PATTERN.fullmatch(mail_id) and self._is_mail_file(mail_id)):
+            return None
+        try:
+            with open(folder + "/" + mail_id, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get_mail(self, username: str, mail_id: str
+                 ) -> gloutils.EmailContentPayload | None:
+        return self._read_mail_file(self._folder(username), mail_id)
+
+    def get_stats(self, username: str) -> gloutils.StatsPayload:
+        folder = self._folder(username)
+        stats = self._load_stats(folder)
+        if stats is None:
+            with self._mailbox_lock(folder):
+                stats = self._compute_stats(folder)
+                self._write_json(folder, gloutils.STATS_FILENAME, stats)
+        # The password file is counted in the size, as it always was, but
+        # not in the counters: a rehash at login rewrites it
+        try:
+            credentials_size = os.path.getsize(folder + "/" + gloutils.PASSWORD_FILENAME)
+        except FileNotFoundError:
+            credentials_size = 0
+        return gloutils.StatsPayload(count=stats["count"],
+                                     size=stats["size"] + credentials_size)
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                mail_id: str | None = None) -> str:
+        folder = self._folder(username)
+        mail_id = mail_id or new_mail_id()
+        data = self._encode_mail(mail_id, payload)
+        with self._mailbox_lock(folder):
+            location = self._place_mail(folder, mail_id, data)
+            self._record_delivery(folder, mail_id, payload, len(data), location)
+        return mail_id
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     mail_id: str | None = None) -> str:
+        # The mail is serialized and written once, then hard linked into
+        # each mailbox; a copy is written where linking is not possible
+        mail_id = mail_id or new_mail_id()
+        data = json.dumps(payload).encode('utf-8')
+        tmp_path = self._root + "/." + mail_id + ".tmp"
+        self._write_synced(tmp_path, data)
+        try:
+            for username in dict.fromkeys(usernames):
+                folder = self._folder(username)
+                with self._mailbox_lock(folder):
+                    try:
+                        os.link(tmp_path, folder + "/" + mail_id)
+                    except OSError:
+                        self._write_mail(folder, mail_id, data)
+                    self._record_delivery(folder, mail_id, payload, len(data))
+        finally:
+            os.remove(tmp_path)
+        return mail_id
+
+    def deliver_stream(self, usernames: list[str], payload: gloutils.StreamedEmailPayload,
+                       recv_chunk: Callable[[], bytes], lost: bool = False,
+                       mail_id: str | None = None) -> str:
+        # The parts are appended to a single blob as they arrive, the blob is
+        # then linked next to the mail file of each mailbox
+        mail_id = mail_id or new_mail_id()
+        blob_path = self._root + "/." + mail_id + BLOB_SUFFIX + ".tmp"
+        try:
+            sizes = []
+            with open(blob_path, 'wb') as f:
+                for _ in range(1 + len(payload.get("attachments", []))):
+                    size = 0
+                    for chunk in iter(recv_chunk, b""):
+                        f.write(chunk)
+                        size += len(chunk)
+                    sizes.append(size)
+                f.flush()
+                os.fsync(f.fileno())
+
+            mail = stream_metadata(payload, sizes)
+            data = self._encode_mail(mail_id, mail)
+            size = len(data) + sum(sizes)
+            for username in dict.fromkeys(usernames):
+                folder = self._folder(username)
+                with self._mailbox_lock(folder):
+                    self._link_blob(blob_path, folder, mail_id)
+                    location = self._place_mail(folder, mail_id, data)
+                    self._record_delivery(folder, mail_id, mail, size, location)
+            if lost:
+                folder = self._root + "/" + gloutils.SERVER_LOST_DIR
+                self._link_blob(blob_path, folder, mail_id)
+                self._write_mail(folder, mail_id, json.dumps(mail).encode('utf-8'))
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(blob_path)
+        return mail_id
+
+    def read_stream(self, username: str, mail_id: str) -> Iterator[bytes]:
+        mail = self.get_mail(username, mail_id)
+        return self._read_blob(self._folder(username), mail_id, mail)
+
+    @staticmethod
+    def _read_blob(folder: str, mail_id: str,
+                   mail: gloutils.EmailContentPayload | None) -> Iterator[bytes]:
+        """Parcourt par morceaux le contenu reçu en flux d'un courriel du dossier."""
+        if mail is None or not mail.get("streamed"):
+            return
+        sizes = [mail["content_size"]] + [attachment["size"]
+                                          for attachment in mail["attachments"]]
+        with open(folder + "/" + mail_id + BLOB_SUFFIX, 'rb') as f:
+            for size in sizes:
+                while size > 0:
+                    chunk = f.read(min(size, STREAM_READ_SIZE))
+                    if not chunk:
+                        # Truncated blob, end the part early
+                        break
+                    size -= len(chunk)
+                    yield chunk
+                yield b""
+
+    def search_ids(self, username: str, terms: list[str]) -> set[str]:
+        folder = self._folder(username)
+        path = folder + "/" + gloutils.SEARCH_FILENAME
+        with self._search_guard:
+            lock = self._search_locks.setdefault(folder, threading.Lock())
+        with lock:
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                with self._mailbox_lock(folder):
+                    if not os.path.exists(path):
+                        self._rebuild_search(username)
+                f = open(path, 'rb')
+            with f:
+                inode = os.fstat(f.fileno()).st_ino
+                with self._search_guard:
+                    cached = self._search_cache.pop(folder, None)
+                if cached is None or cached[0] != inode:
+                    position, postings = 0, {}
+                else:
+                    _, position, postings = cached
+                f.seek(position)
+                data = f.read()
+            # Only complete lines, a delivery may be appending the last one
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].decode('utf-8').splitlines():
+                mail_id, _, line_terms = line.partition("\t")
+                for term in line_terms.split():
+                    postings.setdefault(term, set()).add(mail_id)
+            with self._search_guard:
+                self._search_cache[folder] = (inode, position + end, postings)
+                while len(self._search_cache) > SEARCH_CACHE_FOLDERS:
+                    self._search_cache.popitem(last=False)
+
+            matches = sorted((postings.get(term, set()) for term in terms), key=len)
+            return set.intersection(*matches) if matches else set()
+
+    def store_lost(self, payload: gloutils.EmailContentPayload,
+                   mail_id: str | None = None) -> str:
+        mail_id = mail_id or new_mail_id()
+        self._write_mail(self._root + "/" + gloutils.SERVER_LOST_DIR, mail_id,
+                         json.dumps(payload).encode('utf-8'))
+        return mail_id
+
+    def iter_lost(self) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        folder = self._root + "/" + gloutils.SERVER_LOST_DIR
+        for file in sorted(os.listdir(folder)):
+            mail = self._read_mail_file(folder, file)
+            if mail is not None:
+                yield file, mail
+
+    def read_lost_stream(self, mail_id: str) -> Iterator[bytes]:
+        folder = self._root + "/" + gloutils.SERVER_LOST_DIR
+        return self._read_blob(folder, mail_id, self._read_mail_file(folder, mail_id))
+
+    def verify_stats(self) -> list[tuple[str, dict | None, dict]]:
+        drifts = []
+        for user in self.users():
+            folder = self._folder(user)
+            with self._mailbox_lock(folder):
+                stored = self._load_stats(folder)
+                actual = self._compute_stats(folder)
+                if stored != actual:
+                    drifts.append((user, stored, actual))
+                    self._write_json(folder, gloutils.STATS_FILENAME, actual)
+        return drifts
+
+    def users(self) -> list[str]:
+        return sorted(name for name in os.listdir(self._root)
+                      if self._folder(name) is not None
+                      and os.path.isdir(self._root + "/" + name))
+
+    def iter_mails(self, username: str
+                   ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        folder = self._folder(username)
+        for file in sorted(os.listdir(folder)):
+            if self._is_mail_file(file):
+                mail = self.get_mail(username, file)
+                if mail is not None:
+                    yield file, mail
+
+
+class SegmentStorage(DirectoryStorage):
+    """
+    Stockage dans un dossier par utilisateur dont les courriels sont
+    ajoutés, compressés, à la fin de fichiers segments.
+
+    Chaque enregistrement d'un segment est formé de l'entête
+    _RECORD_HEADER, de l'identifiant du courriel et de ses champs en JSON
+    compact compressé avec zlib. Un segment est fermé une fois qu'il
+    atteint SEGMENT_MAX_SIZE octets. L'entrée d'index de chaque courriel
+    donne son segment et sa position dans celui-ci.
+
+    Les courriels écrits un par fichier par DirectoryStorage restent
+    lisibles; `compact` les réécrit dans des segments.
+    """
+
+    # Format version, mail id length and compressed data length of a record
+    _RECORD_HEADER = struct.Struct("!BBI")
+    _RECORD_VERSION = 1
+    # Fields stored by position; any other field (streamed mails) follows
+    # them in a dict
+    _RECORD_FIELDS = ("sender", "destination", "subject", "date", "content")
+    # Preset zlib dictionary of strings found in most records, which mostly
+    # benefits short mails. Part of the record format: a new dictionary needs
+    # a new _RECORD_VERSION.
+    _RECORD_ZDICT = ("Mon, Tue, Wed, Thu, Fri, Sat, Sun, Jan Feb Mar Apr May Jun Jul"
+                     " Aug Sep Oct Nov Dec +0000\",\"" "@" + gloutils.SERVER_DOMAIN
+                     + "\",\"Bonjour,\\n").encode('utf-8')
+
+    def __init__(self, root: str = gloutils.SERVER_DATA_DIR) -> None:
+        super().__init__(root)
+        # Mail locations read from the index of each folder, with the
+        # version of the index they were read from
+        self._location_cache: dict[str, tuple[Hashable, dict[str, tuple[int, int]]]] = {}
+
+    @staticmethod
+    def _segment_path(folder: str, number: int) -> str:
+        """Chemin du segment numéro `number` d'un dossier."""
+        return f"{folder}/segment-{number:06d}{SEGMENT_SUFFIX}"
+
+    @staticmethod
+    def _segments(folder: str) -> list[int]:
+        """Numéros des segments d'un dossier, dans l'ordre de création."""
+        return sorted(int(match.group(1)) for match in map(SEGMENT_PATTERN.fullmatch,
+                                                           os.listdir(folder))
+                      if match)
+
+    def _encode_mail(self, mail_id: str, payload: gloutils.EmailContentPayload) -> bytes:
+        values = [payload[field] for field in self._RECORD_FIELDS]
+        extra = {key: value for key, value in payload.items()
+                 if key not in self._RECORD_FIELDS}
+        if extra:
+            values.append(extra)
+        compressor = zlib.compressobj(6, zdict=self._RECORD_ZDICT)
+        # Lone surrogates are kept as is, json.loads reads them back from bytes
+        data = compressor.compress(json.dumps(values, ensure_ascii=False,
+                                              separators=(",", ":")).encode('utf-8',
+                                                                            'surrogatepass'))
+        data += compressor.flush()
+        name = mail_id.encode('ascii')
+        return self._RECORD_HEADER.pack(self._RECORD_VERSION, len(name), len(data)) + name + data
+
+    def _decode_mail(self, data: bytes) -> gloutils.EmailContentPayload:
+        """
+        Décode les données compressées d'un enregistrement.
+
+        Lève ValueError, TypeError ou zlib.error si elles sont corrompues.
+        """
+        decompressor = zlib.decompressobj(zdict=self._RECORD_ZDICT)
+        values = json.loads(decompressor.decompress(data) + decompressor.flush())
+        payload = dict(zip(self._RECORD_FIELDS, values))
+        if len(values) > len(self._RECORD_FIELDS):
+            payload.update(values[-1])
+        return payload
+
+    def _read_record(self, f) -> tuple[str, bytes] | None:
+        """
+        Lit l'enregistrement à la position courante d'un segment: son
+        identifiant et ses données compressées. Retourne None à la fin du
+        segment ou si l'enregistrement est tronqué.
+        """
+        header = f.read(self._RECORD_HEADER.size)
+        if len(header) < self._RECORD_HEADER.size:
+            return None
+        version, id_length, length = self._RECORD_HEADER.unpack(header)
+        if version != self._RECORD_VERSION:
+            return None
+        body = f.read(id_length + length)
+        if len(body) < id_length + length:
+            return None
+        try:
+            return body[:id_length].decode('ascii'), body[id_length:]
+        except UnicodeDecodeError:
+            return None
+
+    def _iter_records(self, folder: str) -> Iterator[tuple[int, int, int, str, bytes]]:
+        """
+        Parcourt les enregistrements des segments d'un dossier: numéro du
+        segment, position et longueur de l'enregistrement, identifiant et
+        données compressées du courriel.
+        """
+        for number in self._segments(folder):
+            with open(self._segment_path(folder, number), 'rb') as f:
+                offset = 0
+                # A record torn by a crash ends the scan of its segment; the
+                # index still locates the records appended after it
+                while (record := self._read_record(f)) is not None:
+                    end = f.tell()
+                    yield number, offset, end - offset, *record
+                    offset = end
+
+    def _place_mail(self, folder: str, mail_id: str, data: bytes) -> dict:
+        numbers = self._segments(folder)
+        number = numbers[-1] if numbers else 1
+        with contextlib.suppress(FileNotFoundError):
+            size = os.path.getsize(self._segment_path(folder, number))
+            if size and size + len(data) > SEGMENT_MAX_SIZE:
+                number += 1
+        with open(self._segment_path(folder, number), 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return {"segment": number, "offset": offset}
+
+    def _locations(self, folder: str) -> dict[str, tuple[int, int]]:
+        """Segment et position de chaque courriel du dossier rangé dans un segment."""
+        try:
+            index = os.stat(folder + "/" + gloutils.INDEX_FILENAME)
+            version = index.st_ino, index.st_mtime_ns, index.st_size
+        except OSError:
+            version = None
+        cached = self._location_cache.get(folder)
+        if version is not None and cached is not None and cached[0] == version:
+            return cached[1]
+        locations = {entry["id"]: (entry["segment"], entry["offset"])
+                     for entry in self._read_index(folder) if "segment" in entry}
+        self._location_cache[folder] = (version, locations)
+        return locations
+
+    def _read_mail_at(self, folder: str, mail_id: str, number: int, offset: int
+                      ) -> gloutils.EmailContentPayload:
+        """
+        Lit le courriel rangé à une position d'un segment.
+
+        Lève OSError, ValueError, TypeError ou zlib.error si
+        l'enregistrement est absent ou corrompu.
+        """
+        with open(self._segment_path(folder, number), 'rb') as f:
+            f.seek(offset)
+            record = self._read_record(f)
+        if record is None or record[0] != mail_id:
+            raise ValueError("No such record")
+        return self._decode_mail(record[1])
+
+    def _scan_mails(self, folder: str) -> list[dict]:
+        # A mail found both in a file and in a segment, or twice in segments,
+        # was being compacted: the last record wins
+        entries = {entry["id"]: entry for entry in super()._scan_mails(folder)}
+        for number, offset, length, mail_id, data in self._iter_records(folder):
+            try:
+                mail = self._decode_mail(data)
+                entries[mail_id] = {"id": mail_id,
+                                    "sender": mail["sender"],
+                                    "subject": mail["subject"],
+                                    "date": mail["date"],
+                                    "size": length + self._blob_size(folder, mail_id),
+                                    "segment": number,
+                                    "offset": offset}
+            except (ValueError, TypeError, KeyError, zlib.error):
+                # Unreadable record, leave it out of the index
+                continue
+        return list(entries.values())
+
+    def _stored_sizes(self, folder: str) -> dict[str, int]:
+        sizes = super()._stored_sizes(folder)
+        for _, _, length, mail_id, _ in self._iter_records(folder):
+            sizes[mail_id] = length + self._blob_size(folder, mail_id)
+        return sizes
+
+    def get_mail(self, username: str, mail_id: str
+                 ) -> gloutils.EmailContentPayload | None:
+        if not (NAME_PATTERN.fullmatch(mail_id) and self._is_mail_file(mail_id)):
+            return None
+        folder = self._folder(username)
+        # A compaction may move the mail between the index and segment reads,
+        # the second attempt reads the new index
+        for _ in range(2):
+            location = self._locations(folder).get(mail_id)
+            if location is None:
+                return super().get_mail(username, mail_id)
+            try:
+                return self._read_mail_at(folder, mail_id, *location)
+            except (OSError, ValueError, TypeError, zlib.error):
+                self._location_cache.pop(folder, None)
+        return None
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     mail_id: str | None = None) -> str:
+        # The record is compressed once and appended to each mailbox
+        mail_id = mail_id or new_mail_id()
+        data = self._encode_mail(mail_id, payload)
+        for username in dict.fromkeys(usernames):
+            folder = self._folder(username)
+            with self._mailbox_lock(folder):
+                location = self._place_mail(folder, mail_id, data)
+                self._record_delivery(folder, mail_id, payload, len(data), location)
+        return mail_id
+
+    def iter_mails(self, username: str
+                   ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        # From the oldest to the newest, following the index
+        for entry in reversed(self._read_index(self._folder(username))):
+            mail = self.get_mail(username, entry["id"])
+            if mail is not None:
+                yield entry["id"], mail
+
+    def compact(self, username: str) -> tuple[int, int, int]:
+        """
+        Réécrit tous les courriels d'un compte, dans l'ordre d'arrivée, dans
+        de nouveaux segments, puis supprime les fichiers de courriels
+        réécrits et les anciens segments, dont les enregistrements illisibles
+        sont abandonnés. Les contenus reçus en flux restent en place.
+
+        Les nouveaux segments sont écrits dans des fichiers temporaires et
+        ne prennent leur nom qu'une fois tous écrits: une erreur en cours de
+        route laisse le dossier inchangé.
+
+        Retourne le nombre de courriels réécrits et l'espace occupé par les
+        courriels, hors contenus reçus en flux, avant et après.
+        """
+        folder = self._folder(username)
+        with self._mailbox_lock(folder):
+            # A full scan also recovers records missing from the index
+            entries = self._rebuild_index(folder)
+            old_segments = self._segments(folder)
+            old_files = [file for file in os.listdir(folder) if self._is_mail_file(file)]
+            before = (sum(os.path.getsize(self._segment_path(folder, number))
+                          for number in old_segments)
+                      + sum(os.path.getsize(folder + "/" + file) for file in old_files))
+            if not entries and not old_segments and not old_files:
+                return 0, 0, 0
+
+            number = (old_segments[-1] if old_segments else 0) + 1
+            new_segments = [number]
+            compacted = []
+
+            def tmp_path(number: int) -> str:
+                return f"{folder}/.segment-{number:06d}{SEGMENT_SUFFIX}.tmp"
+
+            try:
+                f = open(tmp_path(number), 'wb')
+                try:
+                    for entry in reversed(entries):
+                        mail = self.get_mail(username, entry["id"])
+                        if mail is None:
+                            continue
+                        data = self._encode_mail(entry["id"], mail)
+                        if f.tell() and f.tell() + len(data) > SEGMENT_MAX_SIZE:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            f.close()
+                            number += 1
+                            new_segments.append(number)
+                            f = open(tmp_path(number), 'wb')
+                        entry.update(segment=number, offset=f.tell(),
+                                     size=len(data) + self._blob_size(folder, entry["id"]))
+                        f.write(data)
+                        compacted.append(entry)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+            except BaseException:
+                for new in new_segments:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(tmp_path(new))
+                raise
+            for new in new_segments:
+                os.replace(tmp_path(new), self._segment_path(folder, new))
+
+            compacted.reverse()
+            self._write_index(folder, compacted)
+            self._location_cache.pop(folder, None)
+            compacted_ids = {entry["id"] for entry in compacted}
+            for file in old_files:
+                if file in compacted_ids:
+                    os.remove(folder + "/" + file)
+            for old in old_segments:
+                os.remove(self._segment_path(folder, old))
+            self._write_json(folder, gloutils.STATS_FILENAME, self._compute_stats(folder))
+            after = sum(os.path.getsize(self._segment_path(folder, number))
+                        for number in new_segments)
+        return len(compacted), before, after
+
+
+class SQLiteStorage(MailboxStorage):
+    """
+    Stockage dans une base de données SQLite.
+
+    Les courriels sont indexés par (utilisateur, heure d'arrivée) et les
+    compteurs de statistiques sont mis à jour dans la même transaction
+    que chaque livraison. Les courriels perdus sont rangés sous
+    l'utilisateur SERVER_LOST_DIR.
+
+    Le contenu d'un courriel reçu en flux est découpé dans la table
+    `chunks` et partagé par tous ses destinataires; la table `streams`
+    conserve la taille de ses parties.
+
+    La table `terms` est l'index inversé des courriels de chaque compte.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            credentials TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS mails (
+            user TEXT NOT NULL,
+            id TEXT NOT NULL,
+            arrival INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            date TEXT NOT NULL,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (user, id)
+        );
+        CREATE INDEX IF NOT EXISTS mails_by_arrival ON mails (user, arrival DESC);
+        CREATE TABLE IF NOT EXISTS stats (
+            user TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS streams (
+            id TEXT PRIMARY KEY,
+            content_size INTEGER NOT NULL,
+            attachments TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chunks (
+            id TEXT NOT NULL,
+            part INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (id, part, seq)
+        );
+        CREATE TABLE IF NOT EXISTS terms (
+            user TEXT NOT NULL,
+            term TEXT NOT NULL,
+            id TEXT NOT NULL,
+            PRIMARY KEY (user, term, id)
+        ) WITHOUT ROWID;
+    """
+    # Bumped when existing databases need a migration, see __init__
+    _SCHEMA_VERSION = 1
+
+    def __init__(self, path: str = gloutils.SERVER_DATABASE) -> None:
+        """Crée la base et ses tables au besoin."""
+        self._path = path
+        # One connection per thread and per process, sqlite3 connections
+        # cannot be shared across threads nor survive a fork
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(self._SCHEMA)
+            version, = connection.execute("PRAGMA user_version").fetchone()
+            if version < 1:
+                # Databases created before the inverted index
+                for user, mail_id, sender, subject, content in connection.execute(
+                        "SELECT user, id, sender, subject, content FROM mails"
+                        " WHERE user != ?", (gloutils.SERVER_LOST_DIR,)).fetchall():
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO terms (user, term, id) VALUES (?, ?, ?)",
+                        [(user, term, mail_id) for term in mail_terms(
+                            {"sender": sender, "subject": subject, "content": content})])
+            connection.execute(f"PRAGMA user_version = {self._SCHEMA_VERSION}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connexion à la base du fil et du processus courants."""
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def user_exists(self, username: str) -> bool:
+        row = self._connection().execute(
+            "SELECT 1 FROM users WHERE name = ?", (username,)).fetchone()
+        return row is not None
+
+    def create_user(self, username: str, credentials: dict) -> bool:
+        if username == gloutils.SERVER_LOST_DIR:
+            return False
+        try:
+            with self._connection() as connection:
+                connection.execute("INSERT INTO users (name, credentials) VALUES (?, ?)",
+                                   (username, json.dumps(credentials)))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def get_credentials(self, username: str) -> dict | None:
+        row = self._connection().execute(
+            "SELECT credentials FROM users WHERE name = ?", (username,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def update_credentials(self, username: str, credentials: dict) -> None:
+        with self._connection() as connection:
+            connection.execute("UPDATE users SET credentials = ? WHERE name = ?",
+                               (json.dumps(credentials), username))
+
+    def mailbox_version(self, username: str) -> Hashable:
+        # Mails are never deleted, the counter grows with every delivery
+        row = self._connection().execute(
+            "SELECT count FROM stats WHERE user = ?", (username,)).fetchone()
+        return row[0] if row else 0
+
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: int | None = None) -> tuple[list[dict], int]:
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT id, sender, subject, date, size FROM mails WHERE user = ?"
+            " ORDER BY arrival DESC, id DESC LIMIT ? OFFSET ?",
+            (username, -1 if limit is None else limit, offset)).fetchall()
+        total, = connection.execute(
+            "SELECT count FROM stats WHERE user = ?", (username,)).fetchone() or (0,)
+        entries = [{"id": mail_id, "sender": sender, "subject": subject,
+                    "date": date, "size": size}
+                   for mail_id, sender, subject, date, size in rows]
+        return entries, total
+
+    _MAIL_COLUMNS = ("m.sender, m.destination, m.subject, m.date, m.content,"
+                     " s.content_size, s.attachments FROM mails m"
+                     " LEFT JOIN streams s ON s.id = m.id")
+
+    @staticmethod
+    def _mail_payload(row: tuple) -> gloutils.EmailContentPayload:
+        """Courriel d'une rangée lue avec les colonnes _MAIL_COLUMNS."""
+        sender, destination, subject, date, content, content_size, attachments = row
+        payload = gloutils.EmailContentPayload(sender=sender, destination=destination,
+                                               subject=subject, date=date, content=content)
+        if content_size is not None:
+            payload.update(streamed=True, content_size=content_size,
+                           attachments=json.loads(attachments))
+        return payload
+
+    def get_mail(self, username: str, mail_id: str
+                 ) -> gloutils.EmailContentPayload | None:
+        row = self._connection().execute(
+            "SELECT " + self._MAIL_COLUMNS + " WHERE m.user = ? AND m.id = ?",
+            (username, mail_id)).fetchone()
+        return None if row is None else self._mail_payload(row)
+
+    def get_stats(self, username: str) -> gloutils.StatsPayload:
+        # The credentials weigh what the password file of a folder does
+        row = self._connection().execute(
+            "SELECT COALESCE(s.count, 0), COALESCE(s.size, 0) + LENGTH(u.credentials)"
+            " FROM users u LEFT JOIN stats s ON s.user = u.name WHERE u.name = ?",
+            (username,)).fetchone()
+        count, size = row or (0, 0)
+        return gloutils.StatsPayload(count=count, size=size)
+
+    @staticmethod
+    def _insert_mails(connection: sqlite3.Connection, usernames: list[str], mail_id: str,
+                      payload: gloutils.EmailContentPayload, size: int) -> None:
+        """
+        Insère un courriel dans la boîte de chaque compte et met leurs
+        compteurs et leur index inversé à jour, dans la transaction en cours.
+        """
+        usernames = list(dict.fromkeys(usernames))
+        terms = mail_terms(payload)
+        connection.executemany(
+            "INSERT OR IGNORE INTO terms (user, term, id) VALUES (?, ?, ?)",
+            [(username, term, mail_id) for username in usernames
+             if username != gloutils.SERVER_LOST_DIR for term in terms])
+        connection.executemany(
+            "INSERT INTO mails (user, id, arrival, sender, destination, subject,"
+            " date, content, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(username, mail_id, arrival_time(mail_id, payload["date"]),
+              payload["sender"], payload["destination"], payload["subject"],
+              payload["date"], payload["content"], size) for username in usernames])
+        connection.executemany(
+            "INSERT INTO stats (user, count, size) VALUES (?, 1, ?)"
+            " ON CONFLICT (user) DO UPDATE SET count = count + 1,"
+            " size = size + excluded.size", [(username, size) for username in usernames])
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                mail_id: str | None = None) -> str:
+        return self.deliver_many([username], payload, mail_id)
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     mail_id: str | None = None) -> str:
+        # Every mailbox is written in a single transaction
+        mail_id = mail_id or new_mail_id()
+        with self._connection() as connection:
+            self._insert_mails(connection, usernames, mail_id, payload, mail_size(payload))
+        return mail_id
+
+    def deliver_stream(self, usernames: list[str], payload: gloutils.StreamedEmailPayload,
+                       recv_chunk: Callable[[], bytes], lost: bool = False,
+                       mail_id: str | None = None) -> str:
+        # Chunks are committed as they arrive so that a slow sender never
+        # holds the write lock; they are dropped if the stream is cut
+        mail_id = mail_id or new_mail_id()
+        connection = self._connection()
+        sizes = []
+        try:
+            for part in range(1 + len(payload.get("attachments", []))):
+                size = 0
+                for seq, chunk in enumerate(iter(recv_chunk, b"")):
+                    with connection:
+                        connection.execute(
+                            "INSERT OR IGNORE INTO chunks (id, part, seq, data)"
+                            " VALUES (?, ?, ?, ?)", (mail_id, part, seq, bytes(chunk)))
+                    size += len(chunk)
+                sizes.append(size)
+        except BaseException:
+            with connection:
+                connection.execute("DELETE FROM chunks WHERE id = ?", (mail_id,))
+            raise
+
+        mail = stream_metadata(payload, sizes)
+        if lost:
+            usernames = list(usernames) + [gloutils.SERVER_LOST_DIR]
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO streams (id, content_size, attachments)"
+                " VALUES (?, ?, ?)", (mail_id, sizes[0], json.dumps(mail["attachments"])))
+            self._insert_mails(connection, usernames, mail_id, mail,
+                               mail_size(mail) + sum(sizes))
+        return mail_id
+
+    def read_stream(self, username: str, mail_id: str) -> Iterator[bytes]:
+        row = self._connection().execute(
+            "SELECT s.attachments FROM mails m JOIN streams s ON s.id = m.id"
+            " WHERE m.user = ? AND m.id = ?", (username, mail_id)).fetchone()
+        if row is None:
+            return
+        for part in range(1 + len(json.loads(row[0]))):
+            # One query per chunk: the generator may be resumed by another
+            # thread, which must use its own connection
+            for seq in itertools.count():
+                chunk = self._connection().execute(
+                    "SELECT data FROM chunks WHERE id = ? AND part = ? AND seq = ?",
+                    (mail_id, part, seq)).fetchone()
+                if chunk is None:
+                    break
+                yield chunk[0]
+            yield b""
+
+    @staticmethod
+    def _terms_query(username: str, terms: list[str]) -> tuple[str, list[str]]:
+        """Requête des identifiants des courriels contenant tous les termes, et ses paramètres."""
+        query = " INTERSECT ".join(["SELECT id FROM terms WHERE user = ? AND term = ?"]
+                                   * len(terms))
+        return query, [value for term in terms for value in (username, term)]
+
+    def search_ids(self, username: str, terms: list[str]) -> set[str]:
+        if not terms:
+            return set()
+        query, parameters = self._terms_query(username, terms)
+        return {mail_id for mail_id, in self._connection().execute(query, parameters)}
+
+    def _matching_headers(self, username: str, terms: list[str]) -> list[dict]:
+        if not terms:
+            return super()._matching_headers(username, terms)
+        # Only the headers of the matching mails are read
+        query, parameters = self._terms_query(username, terms)
+        rows = self._connection().execute(
+            "SELECT id, sender, subject, date, size FROM mails WHERE user = ? AND id IN ("
+            + query + ") ORDER BY arrival DESC, id DESC", [username, *parameters]).fetchall()
+        return [{"id": mail_id, "sender": sender, "subject": subject,
+                 "date": date, "size": size}
+                for mail_id, sender, subject, date, size in rows]
+
+    def store_lost(self, payload: gloutils.EmailContentPayload,
+                   mail_id: str | None = None) -> str:
+        return self.deliver(gloutils.SERVER_LOST_DIR, payload, mail_id)
+
+    def iter_lost(self) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        return self.iter_mails(gloutils.SERVER_LOST_DIR)
+
+    def read_lost_stream(self, mail_id: str) -> Iterator[bytes]:
+        return self.read_stream(gloutils.SERVER_LOST_DIR, mail_id)
+
+    def verify_stats(self) -> list[tuple[str, dict | None, dict]]:
+        drifts = []
+        with self._connection() as connection:
+            stored = {user: {"count": count, "size": size} for user, count, size
+                      in connection.execute("SELECT user, count, size FROM stats")}
+            actual = {user: {"count": count, "size": size} for user, count, size
+                      in connection.execute("SELECT user, COUNT(*), SUM(size)"
+                                            " FROM mails GROUP BY user")}
+            for user in sorted(set(self.users()) | set(stored) | set(actual)):
+                if user == gloutils.SERVER_LOST_DIR:
+                    continue
+                counters = actual.get(user, {"count": 0, "size": 0})
+                if stored.get(user, {"count": 0, "size": 0}) != counters:
+                    drifts.append((user, stored.get(user), counters))
+                    connection.execute(
+                        "INSERT OR REPLACE INTO stats (user, count, size) VALUES (?, ?, ?)",
+                        (user, counters["count"], counters["size"]))
+        return drifts
+
+    def users(self) -> list[str]:
+        return [name for name, in self._connection().execute(
+            "SELECT name FROM users ORDER BY name")]
+
+    def iter_mails(self, username: str
+                   ) -> Iterator[tuple[str, gloutils.EmailContentPayload]]:
+        for mail_id, *row in self._connection().execute(
+                "SELECT m.id, " + self._MAIL_COLUMNS + " WHERE m.user = ?"
+                " ORDER BY m.arrival", (username,)).fetchall():
+            yield mail_id, self._mail_payload(row)
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+            self._local.pid = None
+
+
+def open_storage(engine: str) -> MailboxStorage:
+    """Ouvre le stockage par défaut du moteur `directory`, `segment` ou `sqlite`."""
+    if engine == "sqlite":
+        return SQLiteStorage()
+    if engine == "segment":
+        return SegmentStorage()
+    return DirectoryStorage()
+
+
+def migrate(source: MailboxStorage, dest: MailboxStorage) -> tuple[int, int]:
+    """
+    Copie les comptes, leurs courriels et les courriels perdus de
+    `source` dans `dest`, en conservant les identifiants des courriels. Les
+    comptes et les courriels perdus déjà présents dans `dest` sont
+    ignorés.
+
+    Retourne le nombre de comptes et de courriels copiés, courriels perdus
+    compris.
+    """
+    nb_users = nb_mails = 0
+    for user in source.users():
+        credentials = source.get_credentials(user)
+        if credentials is None or not dest.create_user(user, credentials):
+            continue
+        nb_users += 1
+        for mail_id, payload in source.iter_mails(user):
+            if payload.get("streamed"):
+                chunks = source.read_stream(user, mail_id)
+                dest.deliver_stream([user], payload, functools.partial(next, chunks),
+                                    mail_id=mail_id)
+            else:
+                dest.deliver(user, payload, mail_id)
+            nb_mails += 1
+    present = {mail_id for mail_id, _ in dest.iter_lost()}
+    for mail_id, payload in source.iter_lost():
+        if mail_id in present:
+            continue
+        if payload.get("streamed"):
+            chunks = source.read_lost_stream(mail_id)
+            dest.deliver_stream([], payload, functools.partial(next, chunks),
+                                lost=True, mail_id=mail_id)
+        else:
+            dest.store_lost(payload, mail_id)
+        nb_mails += 1
+    return nb_users, nb_mails
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Migre un dossier de données du serveur vers une base SQLite.")
+    parser.add_argument("--source", default=gloutils.SERVER_DATA_DIR,
+                        help="Dossier de données à migrer.")
+    parser.add_argument("--database", default=gloutils.SERVER_DATABASE,
+                        help="Base SQLite de destination.")
+    args = parser.parse_args(sys.argv[1:])
+    if not os.path.isdir(args.source):
+        parser.error(f"{args.source} n'est pas un dossier")
+
+    source = DirectoryStorage(args.source)
+    dest = SQLiteStorage(args.database)
+    try:
+        nb_users, nb_mails = migrate(source, dest)
+    finally:
+        dest.close()
+    print(f"{nb_users} compte(s) et {nb_mails} courriel(s) migré(s) vers {args.database}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -8,9 +8,13 @@ import datetime
 
 APP_PORT = 5321
 SERVER_DATA_DIR = "glo_server_data"
+SERVER_DATABASE = "glo_server_data.sqlite3"
 SERVER_LOST_DIR = "LOST"
 SERVER_DOMAIN = "glo2000.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INDEX_FILENAME = "index"
+STATS_FILENAME = "stats"
+SEARCH_FILENAME = "search"
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -20,7 +24,15 @@ CLIENT_USE_CHOICE = """Menu principal
 1. Consultation de courriels
 2. Envoi de courriels
 3. Statistiques
-4. Se déconnecter"""
+4. Recherche de courriels
+5. Se déconnecter"""
+
+CAPABILITY_STREAMING = "streaming"
+SUPPORTED_CAPABILITIES = [CAPABILITY_STREAMING]
+
+INBOX_PAGE_SIZE = 20
+BATCH_MAX_REQUESTS = 100
+NOTIFICATION_SUBJECT_LENGTH = 200
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
 
@@ -35,6 +47,8 @@ Date : {date}
 STATS_DISPLAY = """Nombre de messages : {count}
 Taille du dossier : {size} octets"""
 
+NOTIFICATION_DISPLAY = "Nouveau courriel de {sender} : {subject}"
+
 
 class Headers(enum.IntEnum):
     """
@@ -55,6 +69,17 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    NEGOTIATION = enum.auto()
+
+    BATCH = enum.auto()
+
+    SEARCH = enum.auto()
+
+    SUBSCRIBE = enum.auto()
+    NOTIFICATION = enum.auto()
+
+    METRICS = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -68,7 +93,12 @@ class AuthPayload(TypedDict, total=True):
 
 
 class EmailContentPayload(TypedDict, total=True):
-    """Payload pour les transferts de courriels."""
+    """
+    Payload pour les transferts de courriels.
+
+    `destination` peut contenir plusieurs adresses séparées par des
+    virgules.
+    """
     sender: str
     destination: str
     subject: str
@@ -76,14 +106,105 @@ class EmailContentPayload(TypedDict, total=True):
     content: str
 
 
+class AttachmentInfo(TypedDict, total=False):
+    """Description d'une pièce jointe: son nom et sa taille en octets."""
+    name: str
+    size: int
+
+
+class StreamedEmailPayload(EmailContentPayload, total=False):
+    """
+    Payload pour les courriels dont le contenu est transmis en flux.
+
+    Si `streamed` est vrai, `content` est vide: le corps du courriel, de
+    `content_size` octets en UTF-8, suit le message en morceaux
+    (voir glosocket.send_chunk), puis chaque pièce jointe de
+    `attachments`, dans l'ordre. Un morceau vide termine chaque partie.
+
+    Nécessite la capacité CAPABILITY_STREAMING, négociée avec l'entête
+    `NEGOTIATION`.
+    """
+    streamed: bool
+    content_size: int
+    attachments: list[AttachmentInfo]
+
+
+class RecipientStatus(TypedDict, total=False):
+    """
+    État de la livraison à un destinataire: `delivered` indique le succès,
+    `error_message` la cause d'un échec.
+    """
+    address: str
+    delivered: bool
+    error_message: str
+
+
+class DeliveryReportPayload(TypedDict, total=False):
+    """
+    Payload de la réponse à un envoi de courriel.
+
+    `statuses` contient l'état de chaque destinataire, dans l'ordre de
+    `destination`. Si un destinataire n'a pas reçu le courriel, l'entête
+    est ERROR et `error_message` résume les échecs.
+    """
+    error_message: str
+    statuses: list[RecipientStatus]
+
+
+class EmailListRequestPayload(TypedDict, total=False):
+    """
+    Payload optionnel pour les requêtes de consultation.
+
+    Sélectionne `limit` courriels à partir de la position `offset` de la
+    liste. Sans payload, la liste complète est retournée.
+    """
+    offset: int
+    limit: int
+
+
+class SearchPayload(TypedDict, total=False):
+    """
+    Payload pour les requêtes de recherche.
+
+    Sélectionne les courriels contenant tous les mots de `query` dans leur
+    expéditeur, leur sujet ou leur corps, sans égard à la casse ni aux
+    accents. `sender` filtre sur une partie de l'adresse de l'expéditeur,
+    `since` et `until` (AAAA-MM-JJ, inclus) sur la date d'arrivée. La
+    réponse est un EmailListPayload, paginé avec `offset` et `limit`
+    comme pour la consultation.
+    """
+    query: str
+    sender: str
+    since: str
+    until: str
+    offset: int
+    limit: int
+
+
 class EmailListPayload(TypedDict, total=True):
-    """Payload pour les consulation de courriel."""
+    """
+    Payload pour les consulation de courriel.
+
+    `email_ids` contient l'identifiant stable de chaque courriel de
+    `email_list`, dans le même ordre. `offset` est la position du premier
+    élément de la page et `total` le nombre de courriels du dossier, ou
+    de résultats pour une recherche.
+    """
     email_list: list[str]
+    email_ids: list[str]
+    offset: int
+    total: int
 
 
-class EmailChoicePayload(TypedDict, total=True):
-    """Payload pour le choix du courriel à consulter."""
+class EmailChoicePayload(TypedDict, total=False):
+    """
+    Payload pour le choix du courriel à consulter.
+
+    `email_id` désigne le courriel par son identifiant stable, `choice` par
+    son numéro dans la liste (anciens clients).
+    """
     choice: int
+    email_id: str
 
 
 class StatsPayload(TypedDict, total=True):
@@ -92,16 +213,84 @@ class StatsPayload(TypedDict, total=True):
     size: int
 
 
+class NegotiationPayload(TypedDict, total=False):
+    """
+    Payload pour la négociation des options de connexion.
+
+    Le client liste les encodages qu'il supporte par ordre de préférence,
+    le serveur répond avec l'encodage retenu seul dans la liste. Il en va
+    de même pour les algorithmes de compression des trames
+    `compressions`, la liste de la réponse étant vide si aucun n'est
+    retenu. Enfin, le client liste ses capacités optionnelles et le
+    serveur répond avec celles qu'il supporte aussi.
+    """
+    encodings: list[str]
+    compressions: list[str]
+    capabilities: list[str]
+
+
+class NotificationPayload(TypedDict, total=False):
+    """
+    Payload des notifications envoyées par le serveur, avec l'entête
+    `NOTIFICATION`, aux clients abonnés avec l'entête `SUBSCRIBE` quand un
+    courriel est livré dans leur dossier.
+
+    Une notification n'a pas de `request_id` et peut précéder la réponse à
+    n'importe quelle requête, mais jamais s'insérer entre une réponse et
+    les morceaux d'un contenu en flux qui la suivent. Le sujet est tronqué
+    à NOTIFICATION_SUBJECT_LENGTH caractères.
+    """
+    email_id: str
+    sender: str
+    subject: str
+    date: str
+
+
+class MetricsPayload(TypedDict, total=False):
+    """
+    Payload pour les mesures du serveur, réservées aux administrateurs.
+
+    La requête peut activer (`profile` vrai) ou arrêter l'échantillonnage
+    des requêtes avec cProfile. La réponse contient les mesures du
+    processus serveur dans `metrics` (voir glometrics.Metrics.snapshot)
+    et, à l'arrêt de l'échantillonnage, le rapport du profil dans
+    `report`.
+    """
+    profile: bool
+    metrics: dict
+    report: list[str]
+
+
+class BatchPayload(TypedDict, total=False):
+    """
+    Payload pour les lots de requêtes.
+
+    Le client place ses requêtes dans `requests`, au plus
+    BATCH_MAX_REQUESTS; le serveur répond avec une réponse par requête,
+    dans le même ordre, dans `replies`.
+    """
+    requests: list["GloMessage"]
+    replies: list["GloMessage"]
+
+
 class GloMessage(TypedDict, total=False):
     """
     Classe à utiliser pour générer des messages.
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    Le client peut numéroter ses requêtes avec `request_id`; la réponse
+    porte alors le même numéro, ce qui permet d'envoyer plusieurs
+    requêtes sans attendre chaque réponse.
     """
     header: Headers
     payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+                   EmailListRequestPayload, EmailListPayload,
+                   EmailChoicePayload, StatsPayload, NegotiationPayload,
+                   BatchPayload, DeliveryReportPayload, StreamedEmailPayload,
+                   SearchPayload, NotificationPayload, MetricsPayload]
+    request_id: int
 
 
 def get_current_utc_time() -> str: